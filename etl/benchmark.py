@@ -0,0 +1,436 @@
+import argparse
+import copy
+import os
+import time
+import tracemalloc
+from datetime import timedelta
+from math import radians, sin, cos, sqrt, atan2
+
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+from sqlalchemy import text
+
+from Database.database import DBExtractor
+from main import (compute_age, detect_large_amounts, detect_night_transactions, detect_geolocation,
+                  detect_operation_rate, detect_small_sums, detect_none_type)
+from models.parallel import score_transactions
+from models.realtime import RealtimeScorer, verify_replay
+from models.dimensions import CityDistances, ClientAttributes
+from models.pipeline import (FeatureFrame, FeaturePipeline, add_client_age, add_geolocation, add_operation_rate,
+                             add_small_sums, default_pipeline)
+from models.risk_model import RiskPlan, RiskScoringModel
+from models.sweeps import parameter_grid, run_sweeps, sweep_column
+
+RISK_JSON = os.path.join(os.path.dirname(__file__), 'config', 'risk_criteria.json')
+
+
+def make_transactions(n_rows: int = 200_000, n_clients: int = 500, seed: int = 42) -> pd.DataFrame:
+    """
+    Генерирует синтетический DataFrame в формате fetch_merged_transactions() для замеров производительности.
+
+    Параметры:
+    - n_rows: количество транзакций;
+    - n_clients: количество клиентов;
+    - seed: зерно генератора случайных чисел.
+    """
+    rng = np.random.default_rng(seed)
+
+    client_id = rng.integers(1, n_clients + 1, n_rows)
+    birth_date = pd.to_datetime('1925-01-01') + pd.to_timedelta(rng.integers(0, 30_000, n_clients + 1), unit='D')
+
+    # Транзакции за месяц; часть клиентов совершает серии операций с интервалом в несколько минут
+    start = np.datetime64('2025-05-01T00:00:00', 's').astype('int64')
+    seconds = rng.integers(0, 31 * 24 * 3600, n_rows)
+    burst = rng.random(n_rows) < 0.3
+    seconds[burst] = (seconds[burst] // 7200) * 7200 + rng.integers(0, 1800, burst.sum())
+    date_time = pd.to_datetime(start + seconds, unit='s')
+
+    amount = np.where(rng.random(n_rows) < 0.6,
+                      rng.integers(500, 10_000, n_rows),
+                      rng.integers(10_000, 120_000, n_rows)).astype(float)
+
+    t_types = np.array(['Оплата услуг', 'Перевод', 'Пополнение', 'Снятие наличных', 'Неизвестно'])
+    t_type = t_types[rng.choice(len(t_types), n_rows, p=[0.3, 0.3, 0.2, 0.15, 0.05])]
+
+    # 90% операций из "домашнего" региона клиента, 10% — из случайной точки
+    home_lat = rng.uniform(43, 65, n_clients + 1)
+    home_lon = rng.uniform(30, 90, n_clients + 1)
+    away = rng.random(n_rows) < 0.1
+    lat = np.where(away, rng.uniform(-40, 70, n_rows), home_lat[client_id])
+    lon = np.where(away, rng.uniform(-120, 150, n_rows), home_lon[client_id])
+
+    return pd.DataFrame({
+        'transaction_id': np.arange(1, n_rows + 1),
+        'client_id': client_id,
+        'birth_date': birth_date[client_id].date,
+        'date_time': date_time,
+        'amount': amount,
+        't_type': t_type,
+        'sender_latitude': lat.round(4),
+        'sender_longitude': lon.round(4),
+        'blacklist': rng.random(n_rows) < 0.05,
+    })
+
+
+def make_cities(n_cities: int = 300, seed: int = 42) -> pd.DataFrame:
+    """Генерирует справочник городов в формате fetch_cities()."""
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'city_id': np.arange(1, n_cities + 1),
+        'latitude': rng.uniform(-40, 70, n_cities).round(6),
+        'longitude': rng.uniform(-120, 150, n_cities).round(6),
+        'created_at': pd.Timestamp('2025-05-01'),
+    })
+
+
+def legacy_detect_geolocation(df: pd.DataFrame, distance_km: float = 500, max_hours: float = 1) -> pd.DataFrame:
+    """Эталонная (построчная) реализация detect_geolocation — для сравнения скорости и результата."""
+    def haversine(lat1, lon1, lat2, lon2):
+        lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
+        a = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+        return 6371 * 2 * atan2(sqrt(a), sqrt(1 - a))
+
+    df = df.copy()
+    df['date_time'] = pd.to_datetime(df['date_time'])
+    df = df.sort_values(['client_id', 'date_time'])
+    df['prev_lat'] = df.groupby('client_id')['sender_latitude'].shift()
+    df['prev_lon'] = df.groupby('client_id')['sender_longitude'].shift()
+    df['prev_time'] = df.groupby('client_id')['date_time'].shift()
+    df['distance_km'] = df.apply(
+        lambda row: haversine(row.prev_lat, row.prev_lon, row.sender_latitude, row.sender_longitude)
+        if pd.notnull(row.prev_lat) else 0,
+        axis=1
+    )
+    df['hours_diff'] = (df['date_time'] - df['prev_time']).dt.total_seconds() / 3600
+    df['risk_geolocation_change'] = ((df['distance_km'] > distance_km) & (df['hours_diff'] <= max_hours)).astype(int)
+    return df
+
+
+def legacy_detect_operation_rate(df: pd.DataFrame, n_threshold: int = 7, time_window: int = 120) -> pd.DataFrame:
+    """Эталонная (квадратичная) реализация detect_operation_rate."""
+    df = df.copy()
+    df['date_time'] = pd.to_datetime(df['date_time'])
+    df = df.sort_values(['client_id', 'date_time'])
+    df['oper_rate'] = 0
+    for client_id, group_df in df.groupby('client_id', sort=False):
+        times = group_df['date_time']
+        idxs = group_df.index
+        for i, current_time in enumerate(times):
+            window_mask = (times >= current_time - timedelta(minutes=time_window)) & (times <= current_time)
+            if window_mask.sum() > n_threshold:
+                df.loc[idxs[i], 'oper_rate'] = 1
+    return df
+
+
+def legacy_detect_small_sums(df: pd.DataFrame, min_amt: float = 0, max_amt: float = 10000,
+                             total_threshold: float = 20000, time_window: int = 60) -> pd.DataFrame:
+    """Эталонная (квадратичная) реализация detect_small_sums."""
+    df = df.copy()
+    df['date_time'] = pd.to_datetime(df['date_time'])
+    df = df.sort_values(['client_id', 'date_time'])
+    df['small_transactions'] = df['amount'].between(min_amt, max_amt)
+    df['small_sum'] = 0
+    for client_id, group_df in df.groupby('client_id', sort=False):
+        small_df = group_df[group_df['small_transactions']]
+        times = small_df['date_time']
+        idxs = small_df.index
+        for i, current_time in enumerate(times):
+            mask = (times >= current_time - timedelta(minutes=time_window)) & (times <= current_time)
+            if small_df.loc[mask, 'amount'].sum() > total_threshold:
+                df.loc[idxs[i], 'small_sum'] = 1
+    return df
+
+
+def legacy_calculate_scores(model: RiskScoringModel, df: pd.DataFrame) -> pd.DataFrame:
+    """Эталонная (построчная, через apply) реализация RiskScoringModel.calculate_scores."""
+    df = df.copy()
+    df['risk_score'] = 0
+
+    def reasons(row: pd.Series):
+        k = []
+        score_total = 0
+        for col_name, d_info in model.map.items():
+            if not col_name == 'client_age':
+                if row[col_name]:
+                    score_total += d_info['score']
+                    k.append(d_info['reason_flags'])
+            elif row['client_age'] >= 60:
+                k.append(d_info['reason_flags'])
+        k = ', '.join(k)
+        return (k, 0) if not k else (k, score_total)
+
+    df[['reason_flags', 'risk_score']] = df.apply(reasons, axis=1, result_type='expand')
+
+    def high_age(row: pd.Series):
+        current_score = row['risk_score']
+        if row['client_age'] >= 60:
+            score = model.map['client_age']['score']
+            cols_to_check = list(model.map.keys())
+            cols_to_check.remove('client_age')
+            if row[cols_to_check].any():
+                current_score *= score[0]
+            else:
+                current_score += score[1]
+        return int(current_score)
+    df['risk_score'] = df.apply(high_age, axis=1)
+
+    def assign_status(row: pd.Series):
+        if row['risk_score'] >= 80:
+            return 'Подозрительная'
+        elif 50 < row['risk_score'] < 80:
+            return 'Требует проверки'
+        return 'Обычная'
+
+    df['risk_status'] = df.apply(assign_status, axis=1)
+    df['is_suspicious'] = df.apply(lambda x: x['risk_status'] != 'Обычная', axis=1)
+    return df
+
+
+def measure(func, *args, **kwargs) -> tuple:
+    """Выполняет func и возвращает кортеж (результат, длительность в секундах)."""
+    start_time = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start_time
+
+
+def measure_peak(func, *args, **kwargs) -> tuple:
+    """Выполняет func и возвращает кортеж (результат, длительность в секундах, пик памяти в МБ)."""
+    tracemalloc.start()
+    result, duration = measure(func, *args, **kwargs)
+    peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    tracemalloc.stop()
+    return result, duration, peak
+
+
+def report(name: str, n_rows: int, before: float, after: float, same: bool) -> None:
+    """Печатает строки/сек. до и после оптимизации."""
+    print(f'📊 {name}: {n_rows} строк')
+    print(f'---- до:    {before:.2f} сек. ({n_rows / before:,.0f} строк/сек.)')
+    print(f'---- после: {after:.2f} сек. ({n_rows / after:,.0f} строк/сек.), ускорение x{before / after:.1f}')
+    print(f'---- результаты совпадают: {"✅" if same else "❌"}')
+
+
+def bench_geolocation(df: pd.DataFrame) -> None:
+    legacy, before = measure(legacy_detect_geolocation, df)
+    current, after = measure(detect_geolocation, df)
+    same = legacy['risk_geolocation_change'].equals(current['risk_geolocation_change'])
+    report('detect_geolocation', len(df), before, after, same)
+
+
+def bench_operation_rate(df: pd.DataFrame) -> None:
+    legacy, before = measure(legacy_detect_operation_rate, df)
+    current, after = measure(detect_operation_rate, df)
+    same = legacy['oper_rate'].equals(current['oper_rate'])
+    report('detect_operation_rate', len(df), before, after, same)
+
+
+def bench_small_sums(df: pd.DataFrame) -> None:
+    legacy, before = measure(legacy_detect_small_sums, df)
+    current, after = measure(detect_small_sums, df)
+    same = legacy['small_sum'].equals(current['small_sum'])
+    report('detect_small_sums', len(df), before, after, same)
+
+
+def bench_city_distances(df: pd.DataFrame) -> None:
+    df_cities = make_cities()
+    df = df.assign(source_city_id=np.random.default_rng(0).integers(1, len(df_cities) + 1, len(df)))
+    df['sender_latitude'] = df_cities['latitude'].to_numpy()[df['source_city_id'] - 1]
+    df['sender_longitude'] = df_cities['longitude'].to_numpy()[df['source_city_id'] - 1]
+
+    cities, build = measure(CityDistances, df_cities)
+    frame = FeatureFrame(df)
+    (haversine, _), before = measure(add_geolocation, frame)
+    by_coordinates = frame.df.pop('risk_geolocation_change')
+    (lookup, _), after = measure(add_geolocation, frame, cities=cities)
+    same = by_coordinates.equals(frame.df['risk_geolocation_change']) and np.allclose(haversine, lookup)
+    report('add_geolocation: гаверсинус vs матрица городов', len(df), before, after, same)
+    print(f'---- построение матрицы {len(df_cities)}x{len(df_cities)}: {build:.3f} сек.')
+
+
+def bench_client_age(df: pd.DataFrame) -> None:
+    df_clients = (df[['client_id', 'birth_date']].drop_duplicates('client_id')
+                  .assign(home_city_id=0, created_at=pd.Timestamp('2025-05-01')))
+    clients, build = measure(ClientAttributes, df_clients)
+    frame = FeatureFrame(df)
+    _, before = measure(add_client_age, frame)
+    per_row = frame.df.pop('client_age')
+    _, after = measure(add_client_age, frame, clients=clients)
+    report('add_client_age: по строкам vs по клиентам', len(df), before, after,
+           np.array_equal(per_row.to_numpy(), frame.df['client_age'].to_numpy()))
+    print(f'---- расчёт возраста {len(df_clients)} клиентов: {build:.3f} сек.')
+
+
+def pipe_chain(df: pd.DataFrame) -> pd.DataFrame:
+    """Цепочка .pipe из отдельных детекторов: каждый копирует DF и заново приводит типы/сортирует."""
+    return (df.pipe(compute_age).pipe(detect_large_amounts).pipe(detect_night_transactions)
+            .pipe(detect_geolocation).pipe(detect_operation_rate).pipe(detect_small_sums).pipe(detect_none_type))
+
+
+def bench_pipeline(df: pd.DataFrame) -> None:
+    chained, before, peak_before = measure_peak(pipe_chain, df)
+    fused, after, peak_after = measure_peak(default_pipeline().run, df)
+    same = chained.equals(fused)
+    report('FeaturePipeline vs .pipe', len(df), before, after, same)
+    print(f'---- пик памяти: {peak_before:.0f} МБ -> {peak_after:.0f} МБ')
+
+
+def bench_scoring(df: pd.DataFrame) -> None:
+    features = default_pipeline().run(df)
+    model = RiskScoringModel(RISK_JSON)
+    legacy, before = measure(legacy_calculate_scores, model, features)
+    current, after = measure(model.calculate_scores, features)
+    current['reason_flags'] = model.render_reasons(current['reason_mask'])
+    columns = ['risk_score', 'reason_flags', 'risk_status', 'is_suspicious']
+    report('RiskScoringModel.calculate_scores', len(df), before, after, legacy[columns].equals(current[columns]))
+
+
+def bench_parallel(df: pd.DataFrame, workers: int = None) -> None:
+    model = RiskScoringModel(RISK_JSON)
+    serial, before = measure(score_transactions, df, model, workers=1)
+    parallel, after = measure(score_transactions, df, model, workers=workers or os.cpu_count())
+    report(f'score_transactions, {workers or os.cpu_count()} процессов', len(df), before, after, serial.equals(parallel))
+
+
+def what_if_variants(model: RiskScoringModel, n_configs: int = 50, seed: int = 42) -> dict:
+    """Варианты правил: веса текущего JSON-файла, умноженные на случайные коэффициенты 0.5..1.5."""
+    rng = np.random.default_rng(seed)
+    variants = {}
+    for k in range(n_configs):
+        config = copy.deepcopy(model.config)
+        for group in ('priority', 'secondary'):
+            for info in config.get(group, {}).values():
+                info['score'] = int(round(info['score'] * rng.uniform(0.5, 1.5)))
+        variants[f'variant_{k}'] = config
+    return variants
+
+
+def loop_configurations(model: RiskScoringModel, df: pd.DataFrame, variants: dict) -> pd.DataFrame:
+    """Прежний способ: полный calculate_scores() для каждого варианта."""
+    labels = model.calculate_scores(df)['is_suspicious'].to_numpy()
+    rows = {}
+    for name, config in variants.items():
+        variant = copy.copy(model)
+        variant.plan = RiskPlan.from_config(config)
+        scored = variant.calculate_scores(df)
+        predicted = scored['is_suspicious'].to_numpy()
+        counts = scored['risk_status'].value_counts()
+        rows[name] = [counts.get(status, 0) for status in RiskScoringModel.STATUSES] + [
+            (predicted & labels).sum(), (predicted & ~labels).sum(), (~predicted & labels).sum(), (~predicted & ~labels).sum()]
+    return pd.DataFrame.from_dict(rows, orient='index', columns=[*RiskScoringModel.STATUSES, 'tp', 'fp', 'fn', 'tn'])
+
+
+def bench_what_if(df: pd.DataFrame, n_configs: int = 50) -> None:
+    features = default_pipeline().run(df)
+    model = RiskScoringModel(RISK_JSON)
+    variants = what_if_variants(model, n_configs)
+    looped, before = measure(loop_configurations, model, features, variants)
+    batched, after = measure(model.score_configurations, features, variants)
+    report(f'score_configurations, {n_configs} вариантов', len(df), before, after,
+           np.array_equal(looped.to_numpy(dtype=np.int64), batched.to_numpy()))
+
+
+SWEEP_GRIDS = {
+    'oper_rate': (add_operation_rate, {'n_threshold': [5, 6, 7, 8, 9], 'time_window': [30, 60, 120, 240]}),
+    'small_sum': (add_small_sums, {'total_threshold': [10000, 15000, 20000, 30000], 'time_window': [30, 60, 120]}),
+    'risk_geolocation_change': (add_geolocation, {'distance_km': [300, 500, 1000], 'max_hours': [0.5, 1, 2]}),
+}
+
+
+def loop_sweeps(df: pd.DataFrame) -> pd.DataFrame:
+    """Прежний способ: отдельный прогон шага конвейера для каждого набора параметров."""
+    result = FeatureFrame(df, sort=True).df
+    for column, (step, grid) in SWEEP_GRIDS.items():
+        for params in parameter_grid(step, grid):
+            result[sweep_column(column, params)] = FeaturePipeline().register(step, **params).run(df)[column]
+    return result
+
+
+def bench_sweeps(df: pd.DataFrame) -> None:
+    looped, before = measure(loop_sweeps, df)
+    swept, after = measure(run_sweeps, df, operation_rate=SWEEP_GRIDS['oper_rate'][1],
+                           small_sums=SWEEP_GRIDS['small_sum'][1], geolocation=SWEEP_GRIDS['risk_geolocation_change'][1])
+    columns = [name for name in swept.columns if name not in df.columns]
+    report(f'run_sweeps, {len(columns)} наборов параметров', len(df), before, after,
+           looped[columns].equals(swept[columns]))
+
+
+def bench_realtime(df: pd.DataFrame) -> None:
+    model = RiskScoringModel(RISK_JSON)
+    scorer = RealtimeScorer(model)
+    transactions = FeatureFrame(df, sort=True).df.to_dict('records')
+    latency = np.empty(len(transactions))
+    for i, transaction in enumerate(transactions):
+        start_time = time.perf_counter_ns()
+        scorer.score(transaction)
+        latency[i] = (time.perf_counter_ns() - start_time) / 1000
+    p50, p99 = np.percentile(latency, [50, 99])
+    print(f'📊 RealtimeScorer.score: {len(transactions)} транзакций')
+    print(f'---- {len(transactions) / latency.sum() * 1e6:,.0f} транзакций/сек., '
+          f'задержка p50 {p50:.1f} мкс, p99 {p99:.1f} мкс, max {latency.max():.1f} мкс')
+    print(f'---- результаты совпадают с пакетным режимом: {"✅" if verify_replay(df, model).empty else "❌"}')
+
+
+def bench_binary_copy(n_rows: int = 1_000_000) -> None:
+    """
+    Извлечение n_rows строк в формате fetch_merged_transactions() (генерируются в PostgreSQL через generate_series):
+    pd.read_sql против двоичного COPY с разбором в numpy-столбцы. Нужна БД из переменных окружения DB_*.
+    """
+    load_dotenv()
+    extractor = DBExtractor(dbname=os.getenv('DB_NAME'), user=os.getenv('DB_USER'), password=os.getenv('DB_PASS'),
+                            host=os.getenv('DB_HOST'), port=os.getenv('DB_PORT'))
+    sql = f"""
+        SELECT
+            i AS transaction_id,
+            (i % 5000 + 1)::int AS client_id,
+            (i % 7000 + 1)::int AS account_id,
+            TIMESTAMP '2025-05-01' + i * INTERVAL '2.5 seconds' AS date_time,
+            ((i::bigint * 7919) % 20000000 / 100.0)::numeric(15, 2) AS amount,
+            (i % 5 + 1)::int AS transaction_type_id,
+            (i % 300 + 1)::int AS source_city_id,
+            (i * 31 % 300 + 1)::int AS destination_city_id,
+            (i % 30 + 1)::int AS source_region_id,
+            (i * 31 % 30 + 1)::int AS destination_region_id
+        FROM generate_series(1, {int(n_rows)}) AS i
+    """
+    legacy, before = measure(pd.read_sql, text(sql), extractor.engine)
+    current, after = measure(extractor.fetch_query_binary, sql, 'generate_series')
+    report('COPY BINARY против pd.read_sql', n_rows, before, after, legacy.equals(current))
+
+
+BENCHMARKS = {
+    'geolocation': bench_geolocation,
+    'operation_rate': bench_operation_rate,
+    'small_sums': bench_small_sums,
+    'pipeline': bench_pipeline,
+    'scoring': bench_scoring,
+    'parallel': bench_parallel,
+    'city_distances': bench_city_distances,
+    'client_age': bench_client_age,
+    'what_if': bench_what_if,
+    'sweeps': bench_sweeps,
+    'realtime': bench_realtime,
+}
+
+# Замеры, которым нужна БД (переменные окружения DB_*)
+DB_BENCHMARKS = {
+    'binary_copy': bench_binary_copy,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Замеры производительности этапов ETL на синтетических данных.')
+    parser.add_argument('bench', nargs='?', choices=[*BENCHMARKS, *DB_BENCHMARKS, 'all'], default='all')
+    parser.add_argument('--rows', type=int, default=200_000, help='Количество транзакций.')
+    parser.add_argument('--clients', type=int, default=500, help='Количество клиентов.')
+    args = parser.parse_args()
+
+    # Замеры с БД запускаются только по имени: они не используют синтетический DataFrame
+    if args.bench in DB_BENCHMARKS:
+        DB_BENCHMARKS[args.bench](args.rows)
+        raise SystemExit
+
+    df_bench = make_transactions(args.rows, args.clients)
+    for name, bench in BENCHMARKS.items():
+        if args.bench in (name, 'all'):
+            bench(df_bench)
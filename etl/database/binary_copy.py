@@ -0,0 +1,109 @@
+import io
+
+import numpy as np
+import pandas as pd
+
+# Заголовок двоичного формата COPY: сигнатура, флаги (int32) и длина расширения заголовка (int32)
+SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+HEADER_SIZE = len(SIGNATURE) + 8
+
+# Начало отсчёта timestamp в двоичном формате PostgreSQL (микросекунды от 2000-01-01)
+PG_EPOCH_US = 946_684_800_000_000
+
+# OID типа -> (big-endian тип поля в потоке COPY, тип столбца в DataFrame)
+FIXED_TYPES = {
+    16: ('?', np.bool_),          # bool
+    21: ('>i2', np.int64),        # int2
+    23: ('>i4', np.int64),        # int4
+    20: ('>i8', np.int64),        # int8
+    700: ('>f4', np.float64),     # float4
+    701: ('>f8', np.float64),     # float8
+    1114: ('>i8', 'datetime64[ns]'),  # timestamp
+}
+NUMERIC_OID = 1700
+FLOAT8_OID = 701
+
+
+def copy_select(cursor, sql: str) -> tuple:
+    """
+    Запрос для двоичного COPY и типы его столбцов.
+
+    Все поля двоичного COPY должны быть фиксированной длины, поэтому numeric (переменная длина в потоке)
+    передаётся иначе. numeric(p, scale) — масштабированным целым round(x * 10^scale)::int8, которое делится
+    на 10^scale при разборе; получается то же float64, что и у pd.read_sql(coerce_float=True).
+    numeric без масштаба (или с масштабом больше 18) приводится к float8 в БД: при общем масштабе
+    значения с большим числом знаков (например, координаты городов) потеряли бы точность.
+    Возвращает (SQL, [(столбец, OID, масштаб numeric или None)]).
+    """
+    sql = sql.strip().rstrip(';')
+    cursor.execute(f"SELECT * FROM ({sql}) AS q LIMIT 0")
+
+    columns, select = [], []
+    for column in cursor.description:
+        name, oid = column.name, column.type_code
+        if oid == NUMERIC_OID and column.scale is not None and 0 <= column.scale <= 18:
+            select.append(f'round(q.{name} * 1e{column.scale})::int8 AS {name}')
+            columns.append((name, oid, column.scale))
+        elif oid == NUMERIC_OID:
+            select.append(f'q.{name}::float8 AS {name}')
+            columns.append((name, FLOAT8_OID, None))
+        elif oid in FIXED_TYPES:
+            select.append(f'q.{name}')
+            columns.append((name, oid, None))
+        else:
+            raise ValueError(f"Столбец '{name}': тип с OID {oid} не поддерживается двоичным чтением.")
+    return f"SELECT {', '.join(select)} FROM ({sql}) AS q", columns
+
+
+def row_dtype(columns: list) -> np.dtype:
+    """Структурный big-endian dtype строки COPY: число полей (int16), затем для каждого поля длина (int32) и значение."""
+    fields = [('_n', '>i2')]
+    for name, oid, scale in columns:
+        field = '>i8' if oid == NUMERIC_OID else FIXED_TYPES[oid][0]
+        fields += [(f'_len_{name}', '>i4'), (name, field)]
+    return np.dtype(fields)
+
+
+def decode_copy_binary(buffer, columns: list) -> pd.DataFrame:
+    """
+    Разбирает поток COPY ... WITH BINARY в DataFrame одним np.frombuffer по структурному dtype строки,
+    без Python-объектов на каждую ячейку. NULL (поле другой длины) не поддерживается — ошибка (ValueError).
+    """
+    data = memoryview(buffer)
+    if bytes(data[:len(SIGNATURE)]) != SIGNATURE:
+        raise ValueError("Поток не в двоичном формате COPY.")
+    extension = int.from_bytes(data[len(SIGNATURE) + 4:HEADER_SIZE], 'big')
+    start = HEADER_SIZE + extension
+
+    dtype = row_dtype(columns)
+    body = len(data) - start - 2  # в конце — признак конца потока (int16 = -1)
+    if body % dtype.itemsize or int.from_bytes(data[len(data) - 2:], 'big', signed=True) != -1:
+        raise ValueError("Строки потока COPY разной длины (NULL или поле переменной длины).")
+    rows = np.frombuffer(data, dtype=dtype, count=body // dtype.itemsize, offset=start)
+
+    if len(rows) and (rows['_n'] != len(columns)).any():
+        raise ValueError("Число полей в строке потока COPY не совпадает с запросом.")
+    frame = {}
+    for name, oid, scale in columns:
+        if len(rows) and (rows[f'_len_{name}'] != dtype[name].itemsize).any():
+            raise ValueError(f"Столбец '{name}' содержит NULL — двоичное чтение не поддерживает NULL.")
+        values = rows[name]
+        if oid == NUMERIC_OID:
+            frame[name] = values.astype(np.int64) / 10 ** scale
+        elif oid == 1114:
+            frame[name] = ((values.astype(np.int64) + PG_EPOCH_US) * 1000).view('datetime64[ns]')
+        else:
+            frame[name] = values.astype(FIXED_TYPES[oid][1])
+    return pd.DataFrame(frame, copy=False)
+
+
+def read_copy_binary(connection, sql: str) -> pd.DataFrame:
+    """
+    Выполняет sql через COPY (...) TO STDOUT WITH BINARY на DBAPI-соединении psycopg2
+    и возвращает DataFrame с типизированными столбцами: int64, datetime64[ns], float64, bool.
+    """
+    with connection.cursor() as cursor:
+        query, columns = copy_select(cursor, sql)
+        buffer = io.BytesIO()
+        cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH BINARY", buffer)
+    return decode_copy_binary(buffer.getbuffer(), columns)
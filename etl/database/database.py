@@ -1,15 +1,32 @@
 from sqlalchemy import create_engine, text
 from sqlalchemy.exc import SQLAlchemyError
 from etl.config.logger_config import setup_logger
-import pandas as pd
+from etl.database.binary_copy import read_copy_binary
+from etl.database.snapshot import ColumnSnapshot
 import numpy as np
+import pandas as pd
+import psycopg2
+import io
 import os
 import time
+from typing import Iterator
 
 logger = setup_logger('config/etl.log')
 
 
 class DBExtractor:
+    # Ожидаемый порядок и набор столбцов витрины
+    DATAMART_COLUMNS = [
+        'transaction_id', 'client_id', 'client_name', 'client_age', 'account_id',
+        'date_time', 'amount', 't_type', 'is_receipt',
+        'sender_country', 'sender_city', 'sender_region', 'sender_latitude', 'sender_longitude',
+        'recipient_country', 'recipient_city', 'recipient_region', 'recipient_latitude', 'recipient_longitude',
+        'is_suspicious', 'risk_score', 'reason_mask', 'risk_status'
+    ]
+
+    # Режимы загрузки витрины: название -> метод загрузки одной части
+    LOAD_METHODS = {'copy': '_copy_chunk', 'insert': '_insert_chunk'}
+
     def __init__(self, dbname, user, password, host, port):
         try:
             conn_str = f"postgresql+psycopg2://{user}:{password}@{host}:{port}/{dbname}"
@@ -39,13 +56,16 @@ class DBExtractor:
             logger.error(f"Ошибка при чтении файла {full_path}: {str(e)}")
             raise
 
-    def _fetch_df(self, path: str, info: str) -> pd.DataFrame:
-        """Выполняет SQL и возвращает результат в DataFrame."""
-        sql = self._load_sql(path)
+    def _fetch_df(self, path: str, info: str, params: dict = None) -> pd.DataFrame:
+        """Выполняет SQL из файла (с параметрами params, если они заданы) и возвращает результат в DataFrame."""
+        return self.fetch_query(self._load_sql(path), info, params)
+
+    def fetch_query(self, sql: str, info: str, params: dict = None) -> pd.DataFrame:
+        """Выполняет SQL-запрос (например, сгенерированный) и возвращает результат в DataFrame."""
         try:
             start_time = time.perf_counter()
 
-            df = pd.read_sql(sql, self.engine)
+            df = pd.read_sql(text(sql) if params else sql, self.engine, params=params)
             duration = time.perf_counter() - start_time
 
             logger.info(f"Успешно извлечено {len(df)} записей из {info} таблиц схемы 'core'.")
@@ -57,72 +77,591 @@ class DBExtractor:
             logger.error("Ошибка при извлечении данных: %s", str(e))
             raise
 
-    def fetch_merged_transactions(self) -> pd.DataFrame:
+    def fetch_query_binary(self, sql: str, info: str) -> pd.DataFrame:
+        """
+        Выполняет SQL-запрос через COPY (...) TO STDOUT WITH BINARY и разбирает поток сразу в numpy-столбцы
+        (read_copy_binary()): без кортежей строк, Decimal и datetime на каждую ячейку, как в pd.read_sql.
+        Столбцы numeric приходят как float64, timestamp — как datetime64[ns]; NULL не поддерживается.
+        """
+        start_time = time.perf_counter()
+        connection = self.engine.raw_connection()
+        try:
+            df = read_copy_binary(connection, sql)
+            connection.commit()
+        except Exception as e:
+            connection.rollback()
+            logger.error("Ошибка при двоичном извлечении данных: %s", str(e))
+            raise
+        finally:
+            connection.close()
+        duration = time.perf_counter() - start_time
+
+        logger.info(f"Успешно извлечено {len(df)} записей из {info} таблиц схемы 'core' (COPY BINARY).")
+        print(f"✅ Успешно извлечено {len(df)} записей из {info} таблиц схемы 'core' (COPY BINARY) "
+              f"за {duration:.2f} секунд.")
+        return df
+
+    def fetch_merged_transactions(self, binary: bool = False) -> pd.DataFrame:
+        """Извлекает транзакции; binary=True — через двоичный COPY (fetch_query_binary())."""
+        if binary:
+            return self.fetch_query_binary(self._load_sql('sql/fetch_merged_transactions.sql'), 'base_info')
         return self._fetch_df('sql/fetch_merged_transactions.sql', 'base_info')
 
-    def fetch_merged_info(self) -> pd.DataFrame:
-        return self._fetch_df('sql/fetch_merged_info.sql', 'additional_info')
+    def fetch_transactions_snapshot(self, directory: str,
+                                    path: str = 'sql/fetch_merged_transactions.sql') -> pd.DataFrame:
+        """
+        Извлекает транзакции (результат fetch_merged_transactions()) через локальный колоночный снимок
+        в каталоге directory (ColumnSnapshot, np.memmap).
+
+        Версия снимка — max id, число строк и max(created_at) core.transactions:
+        - таблица не менялась — снимок читается с диска без запроса выборки;
+        - добавлены только транзакции с id больше сохранённого — извлекаются и дописываются только они;
+        - иначе (строки удалены или изменены) — снимок создаётся заново.
+        """
+        start_time = time.perf_counter()
+        snapshot = ColumnSnapshot(directory)
+        known = snapshot.version
+        with self.engine.connect() as connection:
+            current = connection.execute(text(self._load_sql('sql/fetch_transactions_version.sql')),
+                                         {'max_id': known['max_id'] if known else -1}).mappings().one()
+        if current['max_id'] is None:
+            return self.fetch_merged_transactions()
+
+        # Строки снимка в БД не менялись: их столько же и max(created_at) тот же
+        is_prefix = known is not None and (int(current['known_rows']), str(current['known_created_at'])) \
+            == (known['rows'], known['max_created_at'])
+
+        if is_prefix and (int(current['total_rows']), int(current['max_id'])) == (known['rows'], known['max_id']):
+            action = 'снимок актуален'
+        else:
+            sql = self._load_sql(path).strip().rstrip(';')
+            query = text(f"SELECT * FROM ({sql}) AS q WHERE transaction_id > :after_id AND transaction_id <= :max_id")
+            max_id = int(current['max_id'])
+            version = {'max_id': max_id, 'max_created_at': str(current['max_created_at'])}
+            action = None
+            if is_prefix:
+                df_new = pd.read_sql(query, self.engine, params={'after_id': known['max_id'], 'max_id': max_id})
+                try:
+                    snapshot.append(df_new, {**version, 'rows': snapshot.rows + len(df_new)})
+                    action = f'дописано {len(df_new)} новых строк'
+                except ValueError as e:
+                    # Типы новых строк несовместимы со снимком (например, NULL в целочисленном столбце)
+                    logger.warning(f"Снимок транзакций {directory} создаётся заново: {e}")
+            if action is None:
+                df_new = pd.read_sql(query, self.engine, params={'after_id': -1, 'max_id': max_id})
+                snapshot.write(df_new, {**version, 'rows': len(df_new)})
+                action = 'снимок создан заново'
+
+        df = snapshot.load()
+        duration = time.perf_counter() - start_time
+        logger.info(f"Снимок транзакций {directory}: {action}, {len(df)} записей за {duration:.2f} секунд.")
+        print(f"✅ Снимок транзакций: {action}, {len(df)} записей за {duration:.2f} секунд.")
+        return df
+
+    def iter_merged_transactions(self, chunk_rows: int = 100_000, path: str = 'sql/fetch_merged_transactions.sql',
+                                 ordered: bool = True) -> Iterator[pd.DataFrame]:
+        """
+        Потоково извлекает результат SQL частями примерно по chunk_rows строк через именованный
+        серверный курсор (stream_results), не загружая всю выборку в память.
+
+        Строки упорядочены по (client_id, date_time), а границы частей проходят только между клиентами:
+        вся история клиента всегда попадает в одну часть, поэтому признаки можно считать по частям.
+        Часть клиента, история которого продолжается в следующих партиях, копится списком и склеивается
+        один раз, когда клиент заканчивается; история одного клиента целиком держится в памяти,
+        поэтому часть бывает больше chunk_rows — не меньше истории самого крупного клиента.
+        При ordered=False строки отдаются в порядке таблицы ровно по chunk_rows, без сортировки в БД
+        (для сброса на диск по частям, SpillPartitions).
+        """
+        sql = self._load_sql(path).strip().rstrip(';')
+        query = text(f"SELECT * FROM ({sql}) AS q" + (" ORDER BY client_id, date_time" if ordered else ""))
+
+        start_time = time.perf_counter()
+        total_rows = 0
+        print(f"⚙️ Потоковое извлечение из {path} частями по {chunk_rows} строк ...")
+        try:
+            with self.engine.connect().execution_options(stream_results=True, max_row_buffer=chunk_rows) as connection:
+                result = connection.execute(query)
+                columns = list(result.keys())
+                # Строки последнего клиента, которые могут продолжиться в следующей партии
+                carry, carry_client = [], None
+
+                for rows in result.partitions(chunk_rows):
+                    df = pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+                    if not ordered:
+                        total_rows += len(df)
+                        yield df
+                        continue
+
+                    client_ids = df['client_id'].to_numpy()
+                    head = 0
+                    if carry and client_ids[0] == carry_client:
+                        head = int(np.searchsorted(client_ids, carry_client, side='right'))
+                        carry.append(df.iloc[:head])
+                        if head == len(df):
+                            # Вся партия — продолжение того же клиента
+                            continue
+
+                    split = int(np.searchsorted(client_ids, client_ids[-1], side='left'))
+                    ready = carry + [df.iloc[head:split]]
+                    carry, carry_client = [df.iloc[split:]], client_ids[-1]
+                    part = pd.concat(ready, ignore_index=True)
+                    if len(part):
+                        total_rows += len(part)
+                        yield part
+
+                if carry:
+                    part = pd.concat(carry, ignore_index=True)
+                    total_rows += len(part)
+                    yield part
+        except Exception as e:
+            logger.error("Ошибка при потоковом извлечении данных: %s", str(e))
+            raise
+
+        duration = time.perf_counter() - start_time
+        logger.info(f"Потоково извлечено {total_rows} записей из {path} за {duration:.2f} секунд.")
+        print(f"✅ Потоково извлечено {total_rows} записей за {duration:.2f} секунд.")
+
+    def count_rows(self, path: str = 'sql/fetch_merged_transactions.sql') -> int:
+        """Число строк результата SQL из файла (для оценки объёма извлечения)."""
+        sql = self._load_sql(path).strip().rstrip(';')
+        with self.engine.connect() as connection:
+            return int(connection.execute(text(f"SELECT COUNT(*) FROM ({sql}) AS q")).scalar())
+
+    def fetch_new_transactions(self, last_id: int = 0, lookback_minutes: int = 120, client_ids=None) -> pd.DataFrame:
+        """
+        Извлекает транзакции с id > last_id и историю тех же клиентов в пределах lookback_minutes (мин.).
+        Столбец is_delta отмечает строки, которые нужно записать в витрину.
+
+        Параметры:
+        - last_id: водяной знак — id последней обработанной транзакции;
+        - lookback_minutes: не меньше самого длинного окна детекторов (в т.ч. max_hours геолокации);
+        - client_ids: только эти клиенты (None — все клиенты с новыми транзакциями).
+        """
+        params = {'last_id': int(last_id), 'lookback_minutes': int(lookback_minutes)}
+        if client_ids is None:
+            return self._fetch_df('sql/fetch_merged_transactions_delta.sql', 'delta_base_info', params=params)
+
+        sql = self._load_sql('sql/fetch_merged_transactions_delta.sql').strip().rstrip(';')
+        return self.fetch_query(f"SELECT * FROM ({sql}) AS q WHERE client_id = ANY(:client_ids)", 'delta_base_info',
+                                params={**params, 'client_ids': [int(i) for i in client_ids]})
+
+    def fetch_transactions_after(self, last_id: int) -> pd.DataFrame:
+        """Извлекает только транзакции с id > last_id, без истории клиентов (она берётся из core.client_risk_state)."""
+        return self._fetch_df('sql/fetch_new_transactions.sql', 'new_base_info', params={'last_id': int(last_id)})
+
+    def create_client_state(self):
+        """Создаёт таблицу состояния клиентов core.client_risk_state, если её ещё нет."""
+        try:
+            with self.engine.begin() as connection:
+                connection.execute(text(self._load_sql('sql/creating_client_risk_state.sql')))
+        except SQLAlchemyError as e:
+            logger.error("Ошибка при создании таблицы core.client_risk_state: %s", str(e))
+            raise
+
+    def fetch_client_state(self, client_ids) -> pd.DataFrame:
+        """Извлекает состояние указанных клиентов из core.client_risk_state (массивы — списками)."""
+        return self._fetch_df('sql/fetch_client_risk_state.sql', 'client_risk_state',
+                              params={'client_ids': [int(i) for i in client_ids]})
+
+    def fetch_dimension(self, table: str) -> pd.DataFrame:
+        """Извлекает справочник core.<table> (sql/fetch_<table>.sql) для DimensionCache."""
+        return self._fetch_df(f'sql/fetch_{table}.sql', table)
+
+    def table_versions(self, tables: list, schema: str = 'core') -> dict:
+        """
+        Версии справочников одним запросом: {таблица: (количество строк, max(created_at))}.
+        Позволяет не перечитывать справочник, если он не менялся.
+        """
+        sql = ' UNION ALL '.join(
+            f"SELECT '{table}' AS table_name, COUNT(*) AS cnt, MAX(created_at) AS max_created_at FROM {schema}.{table}"
+            for table in tables
+        )
+        with self.engine.connect() as connection:
+            rows = connection.execute(text(sql)).all()
+        return {table: (int(count), pd.Timestamp(max_created_at) if max_created_at is not None else None)
+                for table, count, max_created_at in rows}
+
+    def fetch_merged_info(self, transaction_ids=None) -> pd.DataFrame:
+        """
+        Извлекает справочную информацию для витрины.
+        Если передан transaction_ids — только для указанных транзакций.
+        """
+        if transaction_ids is None:
+            return self._fetch_df('sql/fetch_merged_info.sql', 'additional_info')
+
+        sql = self._load_sql('sql/fetch_merged_info.sql').strip().rstrip(';')
+        try:
+            df = pd.read_sql(text(f"SELECT * FROM ({sql}) AS info WHERE transaction_id = ANY(:ids)"),
+                             self.engine, params={'ids': [int(i) for i in transaction_ids]})
+            logger.info(f"Успешно извлечено {len(df)} записей из additional_info таблиц схемы 'core'.")
+            return df
+        except Exception as e:
+            logger.error("Ошибка при извлечении данных: %s", str(e))
+            raise
+
+    def get_watermark(self, schema: str, pipeline: str = 'risk_scoring') -> int:
+        """Возвращает id последней обработанной транзакции (0, если водяного знака ещё нет)."""
+        with self.engine.connect() as connection:
+            last_id = connection.execute(
+                text(f"SELECT last_transaction_id FROM {schema}.etl_watermark WHERE pipeline_name = :pipeline"),
+                {'pipeline': pipeline}
+            ).scalar()
+        return int(last_id) if last_id is not None else 0
+
+    def save_watermark(self, schema: str, last_id: int, last_date_time=None, pipeline: str = 'risk_scoring'):
+        """Сохраняет водяной знак: id и время последней обработанной транзакции."""
+        try:
+            with self.engine.begin() as connection:
+                self._write_watermark(connection, schema, last_id, last_date_time, pipeline)
+            logger.info(f"Водяной знак '{pipeline}' обновлён: last_transaction_id = {last_id}")
+        except SQLAlchemyError as e:
+            logger.error(f"Ошибка при сохранении водяного знака '{pipeline}': %s", str(e))
+            raise
+
+    @staticmethod
+    def _write_watermark(connection, schema: str, last_id: int, last_date_time, pipeline: str):
+        connection.execute(text(f"""
+            INSERT INTO {schema}.etl_watermark (pipeline_name, last_transaction_id, last_date_time, updated_at)
+            VALUES (:pipeline, :last_id, :last_date_time, now())
+            ON CONFLICT (pipeline_name) DO UPDATE SET
+                last_transaction_id = EXCLUDED.last_transaction_id,
+                last_date_time = EXCLUDED.last_date_time,
+                updated_at = EXCLUDED.updated_at
+        """), {'pipeline': pipeline, 'last_id': int(last_id), 'last_date_time': last_date_time})
+
+    def create_datamart(self, incremental: bool = False):
+        """
+        Функция выполняет DDL-скрипт по созданию таблицы витрины
 
-    def create_datamart(self):
-        """Функция выполняет DDL-скрипт по созданию таблицы витрины"""
-        sql = self._load_sql('sql/sql_data_mart.sql')
+        Параметры:
+        - incremental: False — пересоздать схему витрины с нуля (DROP SCHEMA ... CASCADE),
+          True — сохранить существующую витрину и создать только недостающие объекты.
+        """
+        scripts = ['sql/sql_data_mart.sql'] if incremental else ['sql/sql_data_mart_drop.sql', 'sql/sql_data_mart.sql']
         try:
             with self.engine.begin() as conn:
-                conn.execute(text(sql))
-            logger.info(f"DDL-скрипт успешно выполнен: 'sql_data_mart.sql'")
+                for path in scripts:
+                    conn.execute(text(self._load_sql(path)))
+            logger.info(f"DDL-скрипты успешно выполнены: {scripts}")
             print(f'✅ Таблица витрины данных успешно создана!')
         except SQLAlchemyError as e:
-            logger.error(f"Ошибка при выполнении DDL-скрипта 'sql_data_mart.sql': %s", str(e))
+            logger.error(f"Ошибка при выполнении DDL-скриптов {scripts}: %s", str(e))
             raise
 
-    def load_datamart(self, df, schema, table):
-        """Функция загружает финальные данные в витрину"""
+    def load_reasons(self, df_reasons: pd.DataFrame, schema: str, table: str = 'reasons'):
+        """Функция заполняет справочник причин риска (бит маски reason_mask -> текст причины)"""
+        try:
+            with self.engine.begin() as connection:
+                connection.execute(text(f"DELETE FROM {schema}.{table}"))
+                df_reasons.to_sql(name=table, con=connection, schema=schema, if_exists='append', index=False)
+            logger.info(f"Справочник причин {schema}.{table} обновлён: {len(df_reasons)} записей")
+        except SQLAlchemyError as e:
+            logger.error(f"Ошибка при загрузке справочника причин {schema}.{table}: %s", str(e))
+            raise
+
+    def check_reason_bits(self, df_reasons: pd.DataFrame, schema: str, table: str = 'reasons'):
+        """
+        Проверяет перед инкрементальным запуском, что биты reason_mask остались за теми же признаками.
+        Маски уже загруженных строк витрины расшифровываются по новому справочнику причин, поэтому
+        признак, удалённый из правил или сменивший бит (порядок в JSON-файле), — ошибка (ValueError):
+        нужна полная перезагрузка. Новые признаки в конце файла, тексты причин и веса менять можно.
+        """
+        with self.engine.connect() as connection:
+            stored = connection.execute(text(f"SELECT bit, feature_column FROM {schema}.{table}")).fetchall()
+        bits = dict(zip(df_reasons['bit'], df_reasons['feature_column']))
+        changed = [column for bit, column in stored if bits.get(bit) != column]
+        if changed:
+            raise ValueError(f"Биты reason_mask признаков {changed} изменились в правилах риска — "
+                             f"инкрементальный запуск исказит причины уже загруженных строк, нужна полная перезагрузка.")
+
+    def load_datamart(self, df, schema, table, method: str = 'copy', chunk_size: int = 100_000):
+        """
+        Функция загружает финальные данные в витрину
+
+        Параметры:
+        - method: 'copy' — потоковая загрузка через COPY FROM STDIN (CSV из буфера в памяти),
+          'insert' — многострочные INSERT через to_sql (запасной режим);
+        - chunk_size: количество строк в одной части.
+
+        Часть, которую не удалось загрузить, пропускается; возвращается количество таких частей.
+        """
+        if method not in self.LOAD_METHODS:
+            raise ValueError(f"Неизвестный режим загрузки '{method}', ожидается один из {list(self.LOAD_METHODS)}")
         if df.empty:
             logger.info(f"DataFrame пуст — загрузка в витрину пропущена.")
-            return
+            return 0
         df['date_time'] = pd.to_datetime(df['date_time'])
 
-        # Ожидаемый порядок и набор столбцов
-        expected_columns = [
-            'transaction_id', 'client_id', 'client_name', 'client_age', 'account_id',
-            'date_time', 'amount', 't_type', 'is_receipt',
-            'sender_country', 'sender_city', 'sender_region', 'sender_latitude', 'sender_longitude',
-            'recipient_country', 'recipient_city', 'recipient_region', 'recipient_latitude', 'recipient_longitude',
-            'is_suspicious', 'risk_score', 'reason_flags', 'risk_status'
-        ]
-
-        # Проверка структуры
-        if set(df.columns) != set(expected_columns):
-            logger.error("Столбцы в DataFrame не соответствуют ожидаемой структуре таблицы витрины")
-
-        df = df[expected_columns]
+        df = self._prepare_datamart(df)
 
         # Разбиваем на куски
-        chunk_size = 10_000
-        chunks = np.array_split(df, max(len(df) // chunk_size, 1))
+        n_chunks = -(-len(df) // chunk_size)
+        load_chunk = getattr(self, self.LOAD_METHODS[method])
 
-        logger.info(f"Загрузка {len(df)} строк в {len(chunks)} частях по {chunk_size} строк")
-        print(f'⚙️ Загрузка {len(df)} строк в {len(chunks)} частях по {chunk_size} строк:')
+        logger.info(f"Загрузка {len(df)} строк ({method}) в {n_chunks} частях по {chunk_size} строк")
+        print(f'⚙️ Загрузка {len(df)} строк ({method}) в {n_chunks} частях по {chunk_size} строк:')
 
         total_time = 0
-        for i, chunk in enumerate(chunks, start=1):
+        loaded_rows = 0
+        failed_chunks = 0
+        for i, start in enumerate(range(0, len(df), chunk_size), start=1):
+            chunk = df.iloc[start:start + chunk_size]
             try:
                 start_time = time.perf_counter()
-                with self.engine.begin() as connection:
-                    chunk.to_sql(
-                        name=table,
-                        con=connection,
-                        schema=schema,
-                        if_exists='append',
-                        index=False,
-                        method='multi'
-                    )
+                load_chunk(chunk, schema, table)
                 duration = time.perf_counter() - start_time
                 total_time += duration
-                logger.info(f"✅ Загружена часть {i}/{len(chunks)} ({len(chunk)} строк)")
-                print(f"---- [+] Загружен {i}-ый сет по {chunk_size} строк за {duration:.2f} секунд.")
-            except SQLAlchemyError as e:
-                logger.error(f"❌ Ошибка при загрузке части {i}/{len(chunks)}: {e}")
+                loaded_rows += len(chunk)
+                logger.info(f"✅ Загружена часть {i}/{n_chunks} ({len(chunk)} строк, {len(chunk) / duration:.0f} строк/сек.)")
+                print(f"---- [+] Загружен {i}-ый сет из {len(chunk)} строк за {duration:.2f} секунд "
+                      f"({len(chunk) / duration:,.0f} строк/сек.).")
+            except (SQLAlchemyError, psycopg2.Error) as e:
+                logger.error(f"❌ Ошибка при загрузке части {i}/{n_chunks}: {e}")
+                failed_chunks += 1
                 continue
 
-        print(f"📦 Загрузка завершена. Среднее время загрузки: {total_time / len(chunks)}")
\ No newline at end of file
+        if total_time:
+            print(f"📦 Загрузка завершена: {loaded_rows} строк за {total_time:.2f} секунд "
+                  f"({loaded_rows / total_time:,.0f} строк/сек.).")
+        if failed_chunks:
+            print(f"❌ Не загружено частей: {failed_chunks} из {n_chunks}.")
+        return failed_chunks
+
+    def insert_datamart_select(self, scored_sql: str, schema: str, table: str, core: str = 'core'):
+        """
+        Строит витрину одним INSERT ... SELECT внутри PostgreSQL: оценённые транзакции из scored_sql
+        (compile_scoring_sql()) дополняются справочной информацией (sql/fetch_merged_info.sql) и типом транзакции.
+        Данные транзакций не передаются в Python.
+        """
+        info_sql = self._load_sql('sql/fetch_merged_info.sql').strip().rstrip(';')
+        info_columns = {'client_name', 'is_receipt'}
+        select = []
+        for column in self.DATAMART_COLUMNS:
+            if column == 't_type':
+                select.append('tt.t_type')
+            elif column in info_columns or column.startswith(('sender_', 'recipient_')):
+                select.append(f'info.{column}')
+            else:
+                select.append(f's.{column}')
+
+        sql = f"""
+            INSERT INTO {schema}.{table} ({', '.join(self.DATAMART_COLUMNS)})
+            SELECT {', '.join(select)}
+            FROM ({scored_sql}) AS s
+            JOIN ({info_sql}) AS info
+                ON info.transaction_id = s.transaction_id
+            JOIN {core}.transaction_types AS tt
+                ON tt.id = s.transaction_type_id
+        """
+        start_time = time.perf_counter()
+        print(f"⚙️ Построение витрины {schema}.{table} внутри БД (INSERT ... SELECT) ...")
+        try:
+            with self.engine.begin() as connection:
+                rows = connection.execute(text(sql)).rowcount
+            duration = time.perf_counter() - start_time
+            logger.info(f"Витрина {schema}.{table} построена в БД: {rows} строк за {duration:.2f} секунд.")
+            print(f"📦 Загрузка завершена: {rows} строк за {duration:.2f} секунд ({rows / max(duration, 1e-9):,.0f} строк/сек.).")
+        except SQLAlchemyError as e:
+            logger.error(f"Ошибка при построении витрины {schema}.{table} в БД: %s", str(e))
+            raise
+
+    def upsert_datamart(self, df, schema, table, chunk_size: int = 100_000):
+        """
+        Функция сливает новые и пересчитанные транзакции в существующую витрину по transaction_id.
+
+        Данные через COPY загружаются во временную таблицу, затем одним запросом
+        INSERT ... ON CONFLICT (transaction_id) DO UPDATE переносятся в витрину.
+        Строки, у которых ничего не изменилось, не перезаписываются.
+        """
+        if df.empty:
+            logger.info(f"DataFrame пуст — обновление витрины пропущено.")
+            return
+        df['date_time'] = pd.to_datetime(df['date_time'])
+        df = self._prepare_datamart(df)
+
+        print(f'⚙️ Обновление витрины: {len(df)} строк (upsert по transaction_id):')
+        start_time = time.perf_counter()
+        connection = self.engine.raw_connection()
+        try:
+            with connection.cursor() as cursor:
+                changed = self._merge_datamart(cursor, df, schema, table, chunk_size)
+            connection.commit()
+        except (SQLAlchemyError, psycopg2.Error) as e:
+            connection.rollback()
+            logger.error(f"❌ Ошибка при обновлении витрины {schema}.{table}: {e}")
+            raise
+        finally:
+            connection.close()
+
+        duration = time.perf_counter() - start_time
+        logger.info(f"Витрина {schema}.{table} обновлена: {len(df)} строк в дельте, {changed} вставлено/изменено")
+        print(f"📦 Обновление завершено за {duration:.2f} секунд ({len(df) / duration:,.0f} строк/сек.): "
+              f"вставлено/изменено {changed} строк.")
+
+    def transactions_watermark(self) -> tuple:
+        """(max id, max date_time) транзакций core.transactions — водяной знак перезагрузки внутри БД."""
+        with self.engine.connect() as connection:
+            last_id, last_date_time = connection.execute(
+                text("SELECT MAX(id), MAX(date_time) FROM core.transactions")).one()
+        return (int(last_id), last_date_time) if last_id is not None else None
+
+    def save_reload_watermark(self, schema: str, last_id: int, last_date_time, client_state: bool = True,
+                              lookback_minutes: int = 120):
+        """
+        Завершает полную перезагрузку витрины: водяной знак 'risk_scoring' и, при client_state=True,
+        пересчитанное по core.transactions с id <= last_id состояние клиентов с водяным знаком
+        'client_risk_state' — одной транзакцией. Следующий инкрементальный запуск продолжает с last_id,
+        а не пересчитывает всю историю.
+        """
+        try:
+            with self.engine.begin() as connection:
+                if client_state:
+                    connection.execute(text(self._load_sql('sql/creating_client_risk_state.sql')))
+                    self._rebuild_client_state(connection, last_id, lookback_minutes)
+                    self._write_watermark(connection, schema, last_id, last_date_time, 'client_risk_state')
+                self._write_watermark(connection, schema, last_id, last_date_time, 'risk_scoring')
+            logger.info(f"Водяной знак после полной перезагрузки: last_transaction_id = {last_id}"
+                        f"{', состояние клиентов пересчитано' if client_state else ''}")
+        except SQLAlchemyError as e:
+            logger.error("Ошибка при сохранении водяного знака после полной перезагрузки: %s", str(e))
+            raise
+
+    def upsert_incremental(self, df, df_state, schema, table, last_id: int, last_date_time,
+                           lookback_minutes: int = 120, rebuild_clients=(), chunk_size: int = 100_000):
+        """
+        Завершает инкрементальный запуск одной транзакцией: upsert витрины (как upsert_datamart()),
+        обновление состояния клиентов core.client_risk_state и водяные знаки 'risk_scoring'
+        и 'client_risk_state'. При ошибке не меняется ничего — витрина, состояние и водяные знаки
+        всегда согласованы.
+
+        Параметры:
+        - df_state: строки нового состояния клиентов (build_client_state()) — обновляются только эти клиенты;
+          None — состояние пересчитывается целиком по core.transactions с id <= last_id
+          (первый запуск или состояние не соответствует водяному знаку);
+        - last_id, last_date_time: новый водяной знак;
+        - lookback_minutes: глубина истории в состоянии (сохраняется вместе с ним);
+        - rebuild_clients: клиенты, состояние которых пересчитывается в БД по core.transactions
+          (их история извлекалась из core.transactions, а не из состояния).
+        """
+        df['date_time'] = pd.to_datetime(df['date_time'])
+        df = self._prepare_datamart(df)
+
+        print(f'⚙️ Обновление витрины: {len(df)} строк (upsert по transaction_id) и состояния клиентов:')
+        start_time = time.perf_counter()
+        try:
+            with self.engine.begin() as connection:
+                cursor = connection.connection.cursor()
+                changed = self._merge_datamart(cursor, df, schema, table, chunk_size) if not df.empty else 0
+
+                if df_state is None:
+                    self._rebuild_client_state(connection, last_id, lookback_minutes)
+                else:
+                    cursor.execute("CREATE TEMP TABLE stage_client_state ("
+                                   "client_id INTEGER, transaction_id INTEGER, date_time TIMESTAMP, "
+                                   "amount NUMERIC(15, 2), source_city_id INTEGER) ON COMMIT DROP")
+                    for start in range(0, len(df_state), chunk_size):
+                        self._copy_to(cursor, df_state.iloc[start:start + chunk_size], 'stage_client_state')
+                    connection.execute(text(self._load_sql('sql/upsert_client_risk_state.sql')),
+                                       {'lookback_minutes': int(lookback_minutes)})
+                    if len(rebuild_clients):
+                        self._rebuild_client_state(connection, last_id, lookback_minutes, rebuild_clients)
+
+                for pipeline in ('risk_scoring', 'client_risk_state'):
+                    self._write_watermark(connection, schema, last_id, last_date_time, pipeline)
+        except (SQLAlchemyError, psycopg2.Error) as e:
+            logger.error(f"❌ Ошибка при обновлении витрины {schema}.{table} и состояния клиентов: {e}")
+            raise
+
+        duration = time.perf_counter() - start_time
+        if df_state is None:
+            state = 'пересчитано целиком'
+        else:
+            state = f'{df_state["client_id"].nunique()} клиентов, пересчитано в БД {len(rebuild_clients)}'
+        logger.info(f"Витрина {schema}.{table} обновлена: {len(df)} строк в дельте, {changed} вставлено/изменено; "
+                    f"состояние клиентов: {state}; last_transaction_id = {last_id}")
+        print(f"📦 Обновление завершено за {duration:.2f} секунд: вставлено/изменено {changed} строк, "
+              f"состояние клиентов: {state}.")
+
+    def _rebuild_client_state(self, connection, last_id: int, lookback_minutes: int, client_ids=None):
+        """Пересчитывает состояние клиентов client_ids (None — всех) по core.transactions с id <= last_id."""
+        connection.execute(text(self._load_sql('sql/rebuild_client_risk_state.sql')),
+                           {'last_id': int(last_id), 'lookback_minutes': int(lookback_minutes),
+                            'all_clients': client_ids is None,
+                            'client_ids': [int(i) for i in client_ids] if client_ids is not None else []})
+
+    def _merge_datamart(self, cursor, df: pd.DataFrame, schema: str, table: str, chunk_size: int) -> int:
+        """
+        Загружает подготовленную витрину во временную таблицу через COPY и сливает её в {schema}.{table}
+        (INSERT ... ON CONFLICT) в текущей транзакции. Возвращает число вставленных/изменённых строк.
+        """
+        columns = ', '.join(self.DATAMART_COLUMNS)
+        updates = [col for col in self.DATAMART_COLUMNS if col != 'transaction_id']
+        merge_sql = f"""
+            INSERT INTO {schema}.{table} AS t ({columns})
+            SELECT {columns} FROM stage_datamart
+            ON CONFLICT (transaction_id) DO UPDATE SET
+                {', '.join(f'{col} = EXCLUDED.{col}' for col in updates)}
+            WHERE ({', '.join(f't.{col}' for col in updates)})
+                IS DISTINCT FROM ({', '.join(f'EXCLUDED.{col}' for col in updates)})
+        """
+        cursor.execute(f"CREATE TEMP TABLE stage_datamart (LIKE {schema}.{table}) ON COMMIT DROP")
+        for start in range(0, len(df), chunk_size):
+            self._copy_to(cursor, df.iloc[start:start + chunk_size], 'stage_datamart')
+        cursor.execute(merge_sql)
+        return cursor.rowcount
+
+    def _prepare_datamart(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Проверяет набор столбцов и приводит их к порядку таблицы витрины."""
+        if set(df.columns) != set(self.DATAMART_COLUMNS):
+            logger.error("Столбцы в DataFrame не соответствуют ожидаемой структуре таблицы витрины")
+
+        return df[self.DATAMART_COLUMNS]
+
+    @staticmethod
+    def _copy_to(cursor, chunk: pd.DataFrame, target: str):
+        """
+        Передаёт DataFrame в таблицу target через COPY FROM STDIN из CSV-буфера в памяти.
+        Целочисленные столбцы с NULL (float64 после pd.read_sql) пишутся как Int64 — '12', а не '12.0',
+        иначе COPY в столбец INTEGER завершается ошибкой.
+        """
+        integral = {}
+        for column in chunk.columns:
+            values = chunk[column]
+            if values.dtype.kind == 'f':
+                present = values.to_numpy()[values.notna().to_numpy()]
+                if np.isfinite(present).all() and (present == np.trunc(present)).all():
+                    integral[column] = values.astype('Int64')
+        if integral:
+            chunk = chunk.assign(**integral)
+
+        buffer = io.StringIO()
+        chunk.to_csv(buffer, index=False, header=False)
+        buffer.seek(0)
+
+        columns = ', '.join(chunk.columns)
+        cursor.copy_expert(f"COPY {target} ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+    def _copy_chunk(self, chunk: pd.DataFrame, schema: str, table: str):
+        """Загружает часть витрины через COPY FROM STDIN из CSV-буфера в памяти."""
+        connection = self.engine.raw_connection()
+        try:
+            with connection.cursor() as cursor:
+                self._copy_to(cursor, chunk, f'{schema}.{table}')
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+
+    def _insert_chunk(self, chunk: pd.DataFrame, schema: str, table: str):
+        """Загружает часть витрины многострочными INSERT (to_sql, method='multi')."""
+        with self.engine.begin() as connection:
+            chunk.to_sql(
+                name=table,
+                con=connection,
+                schema=schema,
+                if_exists='append',
+                index=False,
+                method='multi'
+            )
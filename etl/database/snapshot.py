@@ -0,0 +1,112 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+
+class ColumnSnapshot:
+    """
+    Локальный колоночный снимок выборки: по одному файлу сырых значений на столбец ({столбец}.bin)
+    и meta.json с числом строк, типами столбцов и версией источника.
+
+    Снимок читается через np.memmap без разбора и копирования на стороне Python (страницы подгружает ОС),
+    а новые строки дописываются в конец файлов (append()). meta.json заменяется атомарно после записи
+    данных, поэтому прерванная запись не портит снимок: лишние байты в конце файлов не читаются.
+    Поддерживаются столбцы без object-типов (числа, даты, bool); столбец, целиком состоящий из NULL,
+    хранится как float64 с NaN.
+    """
+    META = 'meta.json'
+
+    def __init__(self, path: str):
+        self.path = path
+        self.meta = None
+        meta_path = os.path.join(path, self.META)
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                self.meta = json.load(f)
+
+    @property
+    def rows(self) -> int:
+        return self.meta['rows'] if self.meta else 0
+
+    @property
+    def version(self) -> dict:
+        """Версия источника, с которой совпадает снимок (например, max id и max(created_at))."""
+        return self.meta['version'] if self.meta else None
+
+    def _column_path(self, column: str) -> str:
+        return os.path.join(self.path, f'{column}.bin')
+
+    def _write_meta(self, meta: dict) -> None:
+        tmp_path = os.path.join(self.path, self.META + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, os.path.join(self.path, self.META))
+        self.meta = meta
+
+    @staticmethod
+    def _values(df: pd.DataFrame, column: str) -> np.ndarray:
+        """
+        Столбец df; целиком из NULL (nullable-столбец в выборке без значений приходит как object) —
+        float64 с NaN, как у pd.read_sql для целочисленного столбца с NULL.
+        """
+        values = df[column]
+        if values.dtype == object and values.isna().all():
+            return np.full(len(values), np.nan)
+        return values.to_numpy()
+
+    def _columns(self, df: pd.DataFrame) -> dict:
+        """
+        {столбец: массив} с типами снимка; тип, который нельзя привести без потерь (например, NULL
+        в целочисленном столбце снимка), — ошибка (ValueError): снимок нужно создать заново (write()).
+        """
+        arrays = {}
+        for column, dtype in self.meta['dtypes'].items():
+            values = self._values(df, column)
+            if values.dtype != np.dtype(dtype):
+                if not np.can_cast(values.dtype, dtype, casting='safe'):
+                    raise ValueError(f"Столбец '{column}': тип {values.dtype} несовместим с типом снимка {dtype}.")
+                values = values.astype(dtype)
+            arrays[column] = values
+        return arrays
+
+    def write(self, df: pd.DataFrame, version: dict) -> None:
+        """Создаёт снимок заново из df с версией источника version."""
+        dtypes = {column: self._values(df, column).dtype for column in df.columns}
+        objects = [column for column, dtype in dtypes.items() if dtype.kind == 'O']
+        if objects:
+            raise ValueError(f"Столбцы {objects} имеют тип object и не поддерживаются снимком.")
+
+        os.makedirs(self.path, exist_ok=True)
+        # Старый снимок становится недействительным до того, как его файлы перезаписываются
+        if os.path.exists(os.path.join(self.path, self.META)):
+            os.remove(os.path.join(self.path, self.META))
+        self.meta = {'rows': 0, 'dtypes': {column: dtype.str for column, dtype in dtypes.items()}, 'version': None}
+        for column in dtypes:
+            open(self._column_path(column), 'wb').close()
+        self.append(df, version)
+
+    def append(self, df: pd.DataFrame, version: dict) -> None:
+        """Дописывает строки df в конец снимка и обновляет версию источника."""
+        arrays = self._columns(df)
+        for column, values in arrays.items():
+            with open(self._column_path(column), 'r+b') as f:
+                # Обрезаем хвост прерванной записи: файл должен заканчиваться на последней строке снимка
+                f.truncate(self.rows * values.dtype.itemsize)
+                f.seek(0, os.SEEK_END)
+                np.ascontiguousarray(values).tofile(f)
+        self._write_meta({**self.meta, 'rows': self.rows + len(df), 'version': version})
+
+    def load(self) -> pd.DataFrame:
+        """
+        Снимок в DataFrame поверх np.memmap (mode='c': изменения массивов остаются в памяти процесса
+        и не попадают в файлы).
+        """
+        columns = {}
+        for column, dtype in self.meta['dtypes'].items():
+            if self.rows:
+                columns[column] = np.memmap(self._column_path(column), dtype=dtype, mode='c', shape=(self.rows,))
+            else:
+                columns[column] = np.empty(0, dtype=dtype)
+        return pd.DataFrame(columns, copy=False)
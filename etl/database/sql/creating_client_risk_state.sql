@@ -0,0 +1,22 @@
+-- ===================================================================
+-- Состояние клиентов для инкрементального скоринга: всё, что нужно детекторам
+-- из истории клиента, чтобы оценить только новые транзакции.
+--   - last_*: последняя транзакция клиента (смена геолокации);
+--   - recent_times / recent_amounts: транзакции клиента за lookback минут до последней
+--     (окна частоты операций и мелких сумм), по возрастанию времени;
+--   - lookback_minutes: глубина истории, с которой состояние построено (DM_LOOKBACK_MINUTES) —
+--     при большей глубине состояния клиента недостаточно.
+-- ===================================================================
+CREATE TABLE IF NOT EXISTS core.client_risk_state (
+    client_id                INTEGER PRIMARY KEY,
+    last_transaction_id      INTEGER NOT NULL,
+    last_date_time           TIMESTAMP NOT NULL,
+    last_city_id             INTEGER NOT NULL,
+    recent_times             TIMESTAMP[] NOT NULL,
+    recent_amounts           NUMERIC(15, 2)[] NOT NULL,
+    lookback_minutes         INTEGER NOT NULL DEFAULT 0,
+    updated_at               TIMESTAMP NOT NULL DEFAULT now()
+);
+
+-- Таблица из предыдущей версии: глубина истории неизвестна (0), такое состояние пересчитывается
+ALTER TABLE core.client_risk_state ADD COLUMN IF NOT EXISTS lookback_minutes INTEGER NOT NULL DEFAULT 0;
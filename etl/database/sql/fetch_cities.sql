@@ -0,0 +1,11 @@
+-- ===================================================================
+-- 1. Справочник городов: координаты (матрица расстояний для смены геолокации), название и страна
+-- ===================================================================
+SELECT
+    city_id,
+    city_name,
+    latitude,
+    longitude,
+    country_id,
+    created_at
+FROM core.cities;
@@ -0,0 +1,13 @@
+-- ===================================================================
+-- Состояние клиентов с новыми транзакциями (загружается вместо их истории из core.transactions)
+-- ===================================================================
+SELECT
+    client_id,
+    last_transaction_id,
+    last_date_time,
+    last_city_id,
+    recent_times,
+    recent_amounts,
+    lookback_minutes
+FROM core.client_risk_state
+WHERE client_id = ANY(:client_ids);
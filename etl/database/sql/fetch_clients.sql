@@ -0,0 +1,10 @@
+-- ===================================================================
+-- 1. Атрибуты клиентов, которые рассчитываются один раз на клиента (возраст, домашний город), и ФИО для витрины
+-- ===================================================================
+SELECT
+    client_id,
+    full_name,
+    birth_date,
+    geolocation_id AS home_city_id,
+    created_at
+FROM core.clients;
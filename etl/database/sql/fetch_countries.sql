@@ -0,0 +1,9 @@
+-- ===================================================================
+-- 1. Справочник стран: название и признак страны из чёрного списка
+-- ===================================================================
+SELECT
+    country_id,
+    country_name,
+    blacklist,
+    created_at
+FROM core.countries;
@@ -10,6 +10,8 @@ SELECT
     src_region.region_name AS sender_region,
     src_city.city_name AS sender_city,
     src_country.country_name AS sender_country,
+    src_city.latitude AS sender_latitude,
+    src_city.longitude AS sender_longitude,
     dst_region.region_name AS recipient_region,
     dst_city.city_name AS recipient_city,
     dst_country.country_name AS recipient_country,
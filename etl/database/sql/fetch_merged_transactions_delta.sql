@@ -0,0 +1,33 @@
+-- ===================================================================
+-- 1. Извлекаем из схемы core только новые транзакции (id > :last_id) и, для корректного расчёта
+--    оконных признаков и смены геолокации, историю тех же клиентов в пределах :lookback_minutes
+--    до первой и после последней новой транзакции клиента.
+--    is_delta = TRUE для строк, признаки которых могли измениться (новые транзакции и более поздние
+--    транзакции тех же клиентов) — только они записываются в витрину.
+-- ===================================================================
+WITH new_tx AS (
+    SELECT
+        client_id,
+        MIN(date_time) AS min_date_time,
+        MAX(date_time) AS max_date_time
+    FROM core.transactions
+    WHERE id > :last_id
+    GROUP BY client_id
+)
+SELECT
+    t.id AS transaction_id,
+    t.client_id,
+    t.account_id,
+    t.date_time,
+    t.amount,
+    t.transaction_type_id,
+    t.source_city_id,
+    t.destination_city_id,
+    t.source_region_id,
+    t.destination_region_id,
+    t.date_time >= n.min_date_time AS is_delta
+FROM core.transactions AS t
+JOIN new_tx AS n
+    ON t.client_id = n.client_id
+    AND t.date_time >= n.min_date_time - make_interval(mins => :lookback_minutes)
+    AND t.date_time <= n.max_date_time + make_interval(mins => :lookback_minutes);
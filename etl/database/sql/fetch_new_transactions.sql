@@ -0,0 +1,18 @@
+-- ===================================================================
+-- 1. Извлекаем из схемы core только новые транзакции (id > :last_id) — без истории клиентов:
+--    история берётся из core.client_risk_state.
+-- ===================================================================
+SELECT
+    t.id AS transaction_id,
+    t.client_id,
+    t.account_id,
+    t.date_time,
+    t.amount,
+    t.transaction_type_id,
+    t.source_city_id,
+    t.destination_city_id,
+    t.source_region_id,
+    t.destination_region_id,
+    TRUE AS is_delta
+FROM core.transactions AS t
+WHERE t.id > :last_id;
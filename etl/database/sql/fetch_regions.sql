@@ -0,0 +1,8 @@
+-- ===================================================================
+-- 1. Справочник регионов
+-- ===================================================================
+SELECT
+    region_id,
+    region_name,
+    created_at
+FROM core.regions;
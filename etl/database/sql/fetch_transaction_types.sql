@@ -0,0 +1,9 @@
+-- ===================================================================
+-- 1. Справочник типов транзакций
+-- ===================================================================
+SELECT
+    id,
+    t_type,
+    is_receipt,
+    created_at
+FROM core.transaction_types;
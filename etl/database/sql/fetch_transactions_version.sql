@@ -0,0 +1,11 @@
+-- ===================================================================
+-- Версия core.transactions для локального снимка выборки: число строк и max(created_at)
+-- среди уже сохранённых в снимке (id <= :max_id) и по всей таблице
+-- ===================================================================
+SELECT
+    COUNT(*) FILTER (WHERE id <= :max_id) AS known_rows,
+    MAX(created_at) FILTER (WHERE id <= :max_id) AS known_created_at,
+    COUNT(*) AS total_rows,
+    MAX(id) AS max_id,
+    MAX(created_at) AS max_created_at
+FROM core.transactions;
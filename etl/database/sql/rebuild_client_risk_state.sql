@@ -0,0 +1,42 @@
+-- ===================================================================
+-- Пересчёт core.client_risk_state по транзакциям с id <= :last_id: последняя транзакция клиента
+-- и его транзакции за :lookback_minutes до неё. :all_clients = TRUE — все клиенты, иначе только
+-- клиенты из :client_ids. Транзакции без типа или страны получателя не учитываются —
+-- как в DimensionCache.enrich_transactions().
+-- ===================================================================
+DELETE FROM core.client_risk_state
+WHERE :all_clients OR client_id = ANY(:client_ids);
+
+INSERT INTO core.client_risk_state
+    (client_id, last_transaction_id, last_date_time, last_city_id, recent_times, recent_amounts, lookback_minutes,
+     updated_at)
+SELECT
+    t.client_id,
+    (array_agg(t.id ORDER BY t.date_time DESC, t.id DESC))[1],
+    MAX(t.date_time),
+    (array_agg(t.source_city_id ORDER BY t.date_time DESC, t.id DESC))[1],
+    array_agg(t.date_time ORDER BY t.date_time, t.id)
+        FILTER (WHERE t.date_time >= t.client_last_date_time - make_interval(mins => :lookback_minutes)),
+    array_agg(t.amount ORDER BY t.date_time, t.id)
+        FILTER (WHERE t.date_time >= t.client_last_date_time - make_interval(mins => :lookback_minutes)),
+    :lookback_minutes,
+    now()
+FROM (
+    SELECT
+        t.id,
+        t.client_id,
+        t.date_time,
+        t.amount,
+        t.source_city_id,
+        MAX(t.date_time) OVER (PARTITION BY t.client_id) AS client_last_date_time
+    FROM core.transactions AS t
+    JOIN core.transaction_types AS tt
+        ON t.transaction_type_id = tt.id
+    JOIN core.cities AS dst_city
+        ON t.destination_city_id = dst_city.city_id
+    JOIN core.countries AS dst_country
+        ON dst_city.country_id = dst_country.country_id
+    WHERE t.id <= :last_id
+        AND (:all_clients OR t.client_id = ANY(:client_ids))
+) AS t
+GROUP BY t.client_id;
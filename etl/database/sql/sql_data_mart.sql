@@ -1,8 +1,3 @@
--- ===================================================================
--- 0. Удаляем схему data_mart со всем содержимым
--- ===================================================================
-DROP SCHEMA IF EXISTS data_mart CASCADE;
-
 -- ===================================================================
 -- 1. Создаём схему data_mart
 -- ===================================================================
@@ -44,6 +39,39 @@ CREATE TABLE IF NOT EXISTS data_mart.data_table (
     -- Анализ риска
     is_suspicious            BOOLEAN,
     risk_score               INTEGER,
-    reason_flags             VARCHAR,
+    reason_mask              INTEGER,
     risk_status              VARCHAR
 );
+
+-- ===================================================================
+-- 3. Создаём справочник причин риска: бит маски reason_mask -> текст причины
+-- ===================================================================
+CREATE TABLE IF NOT EXISTS data_mart.reasons (
+    bit                      SMALLINT PRIMARY KEY,
+    mask                     INTEGER NOT NULL,
+    reason                   VARCHAR NOT NULL,
+    feature_column           VARCHAR
+);
+
+-- ===================================================================
+-- 4. Создаём представление витрины с текстом причин (собирается только при запросе)
+-- ===================================================================
+CREATE OR REPLACE VIEW data_mart.data_table_reasons AS
+SELECT
+    t.*,
+    COALESCE((
+        SELECT string_agg(r.reason, ', ' ORDER BY r.bit)
+        FROM data_mart.reasons AS r
+        WHERE t.reason_mask & r.mask <> 0
+    ), '') AS reason_flags
+FROM data_mart.data_table AS t;
+
+-- ===================================================================
+-- 5. Создаём таблицу водяных знаков инкрементальной загрузки: последняя обработанная транзакция
+-- ===================================================================
+CREATE TABLE IF NOT EXISTS data_mart.etl_watermark (
+    pipeline_name            VARCHAR PRIMARY KEY,
+    last_transaction_id      BIGINT NOT NULL,
+    last_date_time           TIMESTAMP,
+    updated_at               TIMESTAMP NOT NULL DEFAULT now()
+);
@@ -0,0 +1,4 @@
+-- ===================================================================
+-- 0. Удаляем схему data_mart со всем содержимым
+-- ===================================================================
+DROP SCHEMA IF EXISTS data_mart CASCADE;
@@ -0,0 +1,26 @@
+-- ===================================================================
+-- Обновление core.client_risk_state по строкам нового состояния клиентов (временная таблица
+-- stage_client_state: транзакции клиента за :lookback_minutes до последней) — по одной записи на клиента.
+-- ===================================================================
+INSERT INTO core.client_risk_state AS s
+    (client_id, last_transaction_id, last_date_time, last_city_id, recent_times, recent_amounts, lookback_minutes,
+     updated_at)
+SELECT
+    client_id,
+    (array_agg(transaction_id ORDER BY date_time DESC, transaction_id DESC))[1],
+    MAX(date_time),
+    (array_agg(source_city_id ORDER BY date_time DESC, transaction_id DESC))[1],
+    array_agg(date_time ORDER BY date_time, transaction_id),
+    array_agg(amount ORDER BY date_time, transaction_id),
+    :lookback_minutes,
+    now()
+FROM stage_client_state
+GROUP BY client_id
+ON CONFLICT (client_id) DO UPDATE SET
+    last_transaction_id = EXCLUDED.last_transaction_id,
+    last_date_time = EXCLUDED.last_date_time,
+    last_city_id = EXCLUDED.last_city_id,
+    recent_times = EXCLUDED.recent_times,
+    recent_amounts = EXCLUDED.recent_amounts,
+    lookback_minutes = EXCLUDED.lookback_minutes,
+    updated_at = EXCLUDED.updated_at;
@@ -1,37 +1,38 @@
 from dotenv import load_dotenv
 import os
 import pandas as pd
-from datetime import datetime, timedelta
-from math import radians, sin, cos, sqrt, atan2
 
 from Database.database import DBExtractor
 from models.risk_model import RiskScoringModel
+from models.pipeline import (FeatureFrame, default_pipeline, add_client_age, add_large_amounts,
+                             add_night_transactions, add_geolocation, add_operation_rate, add_small_sums,
+                             add_none_type)
+from models.dimensions import DimensionCache, CityDistances, ClientAttributes
+from models.client_state import state_history, history_clients, build_client_state
+from models.spill import SpillPartitions, partitions_for_budget
+from models.parallel import score_transactions
+from models.sql_features import compile_pipeline_sql, compile_scoring_sql, verify_sql_scores
 import time
 
 
 # Вспомогательные функции
-def compute_age(df: pd.DataFrame, is_read: bool = False) -> pd.DataFrame:
+def compute_age(df: pd.DataFrame, is_read: bool = False, clients: ClientAttributes = None) -> pd.DataFrame:
     '''
     Функция добавляет к DF столбец 'client_age': возраст клиента.
 
     Параметры:
     - is_read: True — вывод информации для проверки работы функции,
-    False - для использования в рабочих целях (добавление столбца 'client_age' в DF).
+    False - для использования в рабочих целях (добавление столбца 'client_age' в DF);
+    - clients: справочник клиентов (DimensionCache.clients) — возраст по 'client_id' для DF
+    из fetch_merged_transactions(), где нет 'birth_date'; None — по 'birth_date' каждой строки.
     '''
-    df = df.copy()
-    df['birth_date'] = pd.to_datetime(df['birth_date'])
-
-    today = datetime.today()
-    age = today.year - df['birth_date'].dt.year
-
-    # Если ДР ещё не наступил в этом году - вычитаем 1
-    before_birthday = (today.month < df['birth_date'].dt.month) | \
-                      ((today.month == df['birth_date'].dt.month) & (today.day < df['birth_date'].dt.day))
-    age -= before_birthday.astype(int)
-    df.insert(4, 'client_age', age)
+    frame = FeatureFrame(df, sort=False)
+    add_client_age(frame, clients=clients)
+    df = frame.df
 
     if is_read:
-        df = df.groupby('client_id')[['birth_date', 'client_age']].first().reset_index()
+        columns = [column for column in ('birth_date', 'client_age') if column in df.columns]
+        df = df.groupby('client_id')[columns].first().reset_index()
 
     return df
 
@@ -47,9 +48,9 @@ def detect_large_amounts(df: pd.DataFrame, threshold: float = 100_000, is_read:
     - is_read: True — вывод информации для проверки работы функции,
     False - для использования в рабочих целях (добавление столбца 'risk_big_sum' в DF).
     """
-    df = df.copy()
-
-    df['risk_big_sum'] = (df['amount'] > threshold).astype(int)
+    frame = FeatureFrame(df, sort=False)
+    add_large_amounts(frame, threshold=threshold)
+    df = frame.df
 
     if is_read:
         df = df[['client_id', 'amount', 'risk_big_sum']]
@@ -66,9 +67,9 @@ def detect_night_transactions(df: pd.DataFrame, start_hour: int = 0, end_hour: i
     - is_read: True — вывод информации для проверки работы функции,
     False - для использования в рабочих целях (добавление столбца 'risk_night_time' в DF).
     """
-    df = df.copy()
-    df['date_time'] = pd.to_datetime(df['date_time'])
-    df['risk_night_time'] = df['date_time'].dt.hour.between(start_hour, end_hour).astype(int)
+    frame = FeatureFrame(df, sort=False)
+    add_night_transactions(frame, start_hour=start_hour, end_hour=end_hour)
+    df = frame.df
 
     if is_read:
         df = df[['client_id', 'date_time', 'risk_night_time']]
@@ -76,7 +77,8 @@ def detect_night_transactions(df: pd.DataFrame, start_hour: int = 0, end_hour: i
     return df
 
 
-def detect_geolocation(df: pd.DataFrame, distance_km: float = 500, max_hours: float = 1, is_read=False) -> pd.DataFrame:
+def detect_geolocation(df: pd.DataFrame, distance_km: float = 500, max_hours: float = 1, is_read=False,
+                       cities: CityDistances = None) -> pd.DataFrame:
     """
     Признак: 'Резкое изменение геолокации (изменение > distance_km (км.))'
     Функция добавляет к DF булев столбец 'risk_geolocation_change': TRUE если геопозиция совершенной транзакции
@@ -85,45 +87,19 @@ def detect_geolocation(df: pd.DataFrame, distance_km: float = 500, max_hours: fl
     Параметры:
     - distance_km, max_hours: ограничения дистанции и времени;
     - is_read: True — вывод информации для проверки работы функции,
-    False - для использования в рабочих целях (добавление столбца 'risk_geolocation_change' в DF).
+    False - для использования в рабочих целях (добавление столбца 'risk_geolocation_change' в DF);
+    - cities: справочник городов (DimensionCache.cities) — расстояния по 'source_city_id' для DF
+    из fetch_merged_transactions(); None — по координатам 'sender_latitude'/'sender_longitude'.
     """
+    # Все вычисления выполняются над столбцами-массивами, без построчного apply
+    frame = FeatureFrame(df)
+    distance, hours_diff = add_geolocation(frame, distance_km=distance_km, max_hours=max_hours, cities=cities)
+    df = frame.df
 
-    def haversine(lat1: int, lon1: int, lat2: int, lon2: int) -> float:
-        """
-        Вычисляет расстояние между двумя точками по координатам (в км).
-
-        Параметры:
-        - lat1, lat2: широты геолокации,
-        - lon1, lon2: долготы геолокации
-        """
-        R = 6371
-        lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
-        dlat = lat2 - lat1
-        dlon = lon2 - lon1
-        a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
-        c = 2 * atan2(sqrt(a), sqrt(1 - a))
-        return R * c
-
-    df = df.copy()
-    df['date_time'] = pd.to_datetime(df['date_time'])
-    df = df.sort_values(['client_id', 'date_time'])
-
-    df['prev_lat'] = df.groupby('client_id')['sender_latitude'].shift()
-    df['prev_lon'] = df.groupby('client_id')['sender_longitude'].shift()
-    df['prev_time'] = df.groupby('client_id')['date_time'].shift()
-
-    df['distance_km'] = df.apply(
-        lambda row: haversine(row.prev_lat, row.prev_lon, row.sender_latitude, row.sender_longitude)
-        if pd.notnull(row.prev_lat) else 0,
-        axis=1
-    )
-    df['hours_diff'] = (df['date_time'] - df['prev_time']).dt.total_seconds() / 3600
-    df['risk_geolocation_change'] = ((df['distance_km'] > distance_km) & (df['hours_diff'] <= max_hours)).astype(int)
-
-    if not is_read:
-        df.drop(columns=['prev_lat', 'prev_lon', 'prev_time', 'distance_km', 'hours_diff'], axis=1, inplace=True)
-    else:
-        df.drop(columns=['birth_date', 't_type', 'amount', 'blacklist'], axis=1, inplace=True)
+    if is_read:
+        df['distance_km'] = distance
+        df['hours_diff'] = hours_diff
+        df.drop(columns=['birth_date', 't_type', 'amount', 'blacklist'], errors='ignore', inplace=True)
 
     return df
 
@@ -142,20 +118,9 @@ def detect_operation_rate(df: pd.DataFrame, n_threshold: int = 7, time_window: i
     - is_read: True — вывод информации для проверки работы функции,
     False - для использования в рабочих целях (добавление столбца 'oper_rate' в DF).
     """
-    df = df.copy()
-    df['date_time'] = pd.to_datetime(df['date_time'])
-    df = df.sort_values(['client_id', 'date_time'])
-    df['oper_rate'] = 0
-
-    for client_id, group_df in df.groupby('client_id', sort=False):
-        times = group_df['date_time']
-        idxs = group_df.index
-
-        for i, current_time in enumerate(times):
-            window_start = current_time - timedelta(minutes=time_window)
-            window_mask = (times >= window_start) & (times <= current_time)
-            if window_mask.sum() > n_threshold:
-                df.loc[idxs[i], 'oper_rate'] = 1
+    frame = FeatureFrame(df)
+    add_operation_rate(frame, n_threshold=n_threshold, time_window=time_window)
+    df = frame.df
 
     if is_read:
         df = df[['client_id', 'date_time', 'oper_rate']]
@@ -177,29 +142,14 @@ def detect_small_sums(df: pd.DataFrame, min_amt: float = 0, max_amt: float = 100
     - is_read: True — вывод информации для проверки работы функции,
     False - для использования в рабочих целях (добавление столбца 'oper_rate' в DF).
     """
-    df = df.copy()
-    df['date_time'] = pd.to_datetime(df['date_time'])
-    df = df.sort_values(['client_id', 'date_time'])
-    df['small_transactions'] = df['amount'].between(min_amt, max_amt)
-    df['small_sum'] = 0
-
-    for client_id, group_df in df.groupby('client_id', sort=False):
-        small_df = group_df[group_df['small_transactions']]
-        times = small_df['date_time']
-        idxs = small_df.index
-
-        for i, current_time in enumerate(times):
-            window_start = current_time - timedelta(minutes=time_window)
-            mask = (times >= window_start) & (times <= current_time)
-            window_sum = small_df.loc[mask, 'amount'].sum()
-
-            if window_sum > total_threshold:
-                df.loc[idxs[i], 'small_sum'] = 1
+    frame = FeatureFrame(df)
+    small = add_small_sums(frame, min_amt=min_amt, max_amt=max_amt,
+                           total_threshold=total_threshold, time_window=time_window)
+    df = frame.df
 
     if is_read:
+        df['small_transactions'] = small
         df = df[['client_id', 'date_time', 'amount', 'small_transactions', 'small_sum']]
-    else:
-        df.drop(['small_transactions'], axis=1, inplace=True)
 
     return df
 
@@ -213,9 +163,9 @@ def detect_none_type(df: pd.DataFrame, is_read: bool = False) -> pd.DataFrame:
     - is_read: True — вывод информации для проверки работы функции,
     False - для использования в рабочих целях (добавление столбца 'oper_rate' в DF).
     """
-    df = df.copy()
-
-    df['none_type'] = df['t_type'].apply(lambda x: x in ['Неизвестно', 'Unknown', 'Other', ''] or not x).astype(int)
+    frame = FeatureFrame(df, sort=False)
+    add_none_type(frame)
+    df = frame.df
 
     if is_read:
         df = df[['client_id', 't_type', 'none_type']]
@@ -223,6 +173,115 @@ def detect_none_type(df: pd.DataFrame, is_read: bool = False) -> pd.DataFrame:
     return df
 
 
+def build_datamart(dimensions: DimensionCache, df_calculated_risks: pd.DataFrame) -> pd.DataFrame:
+    """
+    Дополняет оценённые транзакции справочной информацией из кэша справочников
+    и оставляет только поля витрины.
+    """
+    df_data_mart = dimensions.datamart_info(df_calculated_risks)
+
+    # Убираем лишние поля, не нужные в витрине
+    df_data_mart.drop([
+       'birth_date', 'transaction_type_id', 'source_city_id', 'destination_city_id', 'source_region_id',
+       'destination_region_id', 'risk_geolocation_change', 'small_sum', 'none_type',
+       'blacklist', 'risk_big_sum', 'risk_night_time', 'oper_rate'], axis=1, inplace=True, errors='ignore')
+    return df_data_mart
+
+
+def extraction_watermark(df: pd.DataFrame, last_id: int = 0, previous: tuple = None) -> tuple:
+    """
+    Водяной знак (max transaction_id, max date_time) по извлечённым транзакциям с id > last_id — до enrich_transactions(),
+    чтобы отброшенные строки не извлекались повторно. previous — водяной знак предыдущих частей выборки.
+    """
+    extracted = df[df['transaction_id'].to_numpy() > last_id]
+    if extracted.empty:
+        return previous
+    watermark = (int(extracted['transaction_id'].max()), extracted['date_time'].max())
+    if previous is None:
+        return watermark
+    return max(watermark[0], previous[0]), max(watermark[1], previous[1])
+
+
+def save_reload_watermark(extractor: DBExtractor, schema: str, watermark: tuple, failed_chunks: int = 0,
+                          client_state: bool = True, lookback_minutes: int = 120) -> None:
+    """
+    Сохраняет водяной знак полной перезагрузки. Если часть витрины не загрузилась, водяной знак не сохраняется:
+    иначе инкрементальный запуск продолжил бы после потерянных транзакций, и они не попали бы в витрину.
+    """
+    if failed_chunks:
+        print(f"❌ {failed_chunks} частей витрины не загружены — водяной знак не сохранён, "
+              f"следующий инкрементальный запуск пересчитает всю историю.")
+    elif watermark:
+        extractor.save_reload_watermark(schema, *watermark, client_state, lookback_minutes)
+
+
+def stream_to_datamart(extractor: DBExtractor, dimensions: DimensionCache, risk_model: RiskScoringModel,
+                       schema: str, table: str, stream_rows: int, load_method: str = 'copy',
+                       chunk_size: int = 100_000, workers: int = 1) -> tuple:
+    """
+    Потоковый режим: история транзакций читается серверным курсором частями по ~stream_rows строк
+    (границы частей — между клиентами), и каждая часть проходит признаки, скоринг и загрузку в витрину.
+    Пиковая память определяется размером части, а не объёмом всей истории.
+    Возвращает водяной знак загруженной истории (extraction_watermark()) и количество незагруженных частей витрины.
+    """
+    extractor.create_datamart()
+    extractor.load_reasons(risk_model.reason_table(), schema)
+
+    pipeline = default_pipeline(dimensions.cities, dimensions.clients)
+    watermark, failed_chunks = None, 0
+    for df_chunk in extractor.iter_merged_transactions(stream_rows):
+        watermark = extraction_watermark(df_chunk, previous=watermark)
+        df_chunk = dimensions.enrich_transactions(df_chunk)
+        df_calculated_risks = score_transactions(df_chunk, risk_model, workers=workers, pipeline=pipeline, copy=False)
+        df_data_mart = build_datamart(dimensions, df_calculated_risks)
+        failed_chunks += extractor.load_datamart(df_data_mart, schema, table, method=load_method, chunk_size=chunk_size)
+    return watermark, failed_chunks
+
+
+def spill_to_datamart(extractor: DBExtractor, dimensions: DimensionCache, risk_model: RiskScoringModel,
+                      schema: str, table: str, memory_mb: float, spill_dir: str = None, read_rows: int = 100_000,
+                      load_method: str = 'copy', chunk_size: int = 100_000, workers: int = 1) -> tuple:
+    """
+    Режим вне памяти (out-of-core): история транзакций читается серверным курсором без сортировки в БД
+    и сбрасывается на диск в части по хэшу client_id (SpillPartitions). Число частей подбирается так,
+    чтобы обработка одной части укладывалась в memory_mb; затем части по одной сортируются по
+    (client_id, date_time) и проходят признаки, скоринг и загрузку в витрину.
+    Возвращает водяной знак загруженной истории (extraction_watermark()) и количество незагруженных частей витрины.
+    """
+    extractor.create_datamart()
+    extractor.load_reasons(risk_model.reason_table(), schema)
+
+    pipeline = default_pipeline(dimensions.cities, dimensions.clients)
+    total_rows = extractor.count_rows()
+    spill, watermark, failed_chunks = None, None, 0
+    try:
+        start_time = time.perf_counter()
+        for df_chunk in extractor.iter_merged_transactions(read_rows, ordered=False):
+            if spill is None:
+                row_bytes = df_chunk.memory_usage(deep=True).sum() / len(df_chunk)
+                spill = SpillPartitions(partitions_for_budget(total_rows, row_bytes, memory_mb), spill_dir)
+            spill.write(df_chunk)
+            watermark = extraction_watermark(df_chunk, previous=watermark)
+        if spill is None:
+            return None, 0
+        spill.finalize()
+        print(f"✅ {total_rows} строк сброшено на диск в {spill.n_parts} частей "
+              f"за {time.perf_counter() - start_time:.2f} секунд.")
+
+        for part, df_part in enumerate(spill, start=1):
+            print(f"⚙️ Часть {part}: {len(df_part)} строк")
+            df_part = dimensions.enrich_transactions(df_part)
+            df_calculated_risks = score_transactions(df_part, risk_model, workers=workers, pipeline=pipeline,
+                                                     copy=False)
+            df_data_mart = build_datamart(dimensions, df_calculated_risks)
+            failed_chunks += extractor.load_datamart(df_data_mart, schema, table, method=load_method,
+                                                     chunk_size=chunk_size)
+    finally:
+        if spill is not None:
+            spill.close()
+    return watermark, failed_chunks
+
+
 def main():
     # 1. Подгружаем параметры из окружения
     load_dotenv()
@@ -234,48 +293,164 @@ def main():
     RISK_JSON = os.getenv('RISK_JSON')
     DM_SHEMA = os.getenv('DM_SHEMA')
     DM_TABLE = os.getenv('DM_TABLE')
+    DM_MODE = os.getenv('DM_MODE', 'full')
+    DM_LOAD_METHOD = os.getenv('DM_LOAD_METHOD', 'copy')
+    DM_CHUNK_SIZE = int(os.getenv('DM_CHUNK_SIZE', 100_000))
+    DM_LOOKBACK_MINUTES = int(os.getenv('DM_LOOKBACK_MINUTES', 120))
+    DM_STREAM_ROWS = int(os.getenv('DM_STREAM_ROWS', 0))
+    DM_WORKERS = int(os.getenv('DM_WORKERS', 1))
+    DM_ENGINE = os.getenv('DM_ENGINE', 'python')
+    DM_VERIFY_SQL = os.getenv('DM_VERIFY_SQL', '0') == '1'
+    DM_CLIENT_STATE = os.getenv('DM_CLIENT_STATE', '1') == '1'
+    DM_SPILL_MEMORY_MB = float(os.getenv('DM_SPILL_MEMORY_MB', 0))
+    DM_SPILL_DIR = os.getenv('DM_SPILL_DIR') or None
+    DM_SNAPSHOT_DIR = os.getenv('DM_SNAPSHOT_DIR')
+    DM_BINARY_COPY = os.getenv('DM_BINARY_COPY', '0') == '1'
+
+    # В режиме 'incremental' витрина и водяной знак сохраняются между запусками
+    incremental = DM_MODE == 'incremental'
 
     extractor = DBExtractor(dbname=DB_NAME, user=DB_USER, password=DB_PASS, host=DB_HOST, port=DB_PORT)
 
-    # 2. Загружаем данные из схемы core и дополняем DataFrame булевыми столбцами: True, если признак выполняется
-    df_transactions = extractor.fetch_merged_transactions()
-    df_main = (
-        df_transactions
-
-        # Добавляем возраст клиентов
-        .pipe(compute_age)
-
-        # Добавляем колонки с приоритетными признаками
-        .pipe(detect_large_amounts)
-        .pipe(detect_night_transactions)
-        .pipe(detect_geolocation)
+    # Справочники (клиенты, типы, города, страны, регионы) загружаются один раз в кэш процесса
+    dimensions = DimensionCache().refresh(extractor)
+
+    # Режим вне памяти: транзакции сбрасываются на диск по частям, каждая часть укладывается в DM_SPILL_MEMORY_MB
+    if DM_SPILL_MEMORY_MB and not incremental:
+        watermark, failed_chunks = spill_to_datamart(
+            extractor, dimensions, RiskScoringModel(RISK_JSON), DM_SHEMA, DM_TABLE, DM_SPILL_MEMORY_MB,
+            spill_dir=DM_SPILL_DIR, read_rows=DM_STREAM_ROWS or 100_000, load_method=DM_LOAD_METHOD,
+            chunk_size=DM_CHUNK_SIZE, workers=DM_WORKERS)
+        save_reload_watermark(extractor, DM_SHEMA, watermark, failed_chunks, DM_CLIENT_STATE, DM_LOOKBACK_MINUTES)
+        return
+
+    # Потоковый режим полной перезагрузки: память ограничена размером части DM_STREAM_ROWS
+    if DM_STREAM_ROWS and not incremental:
+        watermark, failed_chunks = stream_to_datamart(
+            extractor, dimensions, RiskScoringModel(RISK_JSON), DM_SHEMA, DM_TABLE, DM_STREAM_ROWS,
+            load_method=DM_LOAD_METHOD, chunk_size=DM_CHUNK_SIZE, workers=DM_WORKERS)
+        save_reload_watermark(extractor, DM_SHEMA, watermark, failed_chunks, DM_CLIENT_STATE, DM_LOOKBACK_MINUTES)
+        return
 
-        # Добавляем колонки с вторичными признаками
-        .pipe(detect_operation_rate)
-        .pipe(detect_small_sums)
-        .pipe(detect_none_type)
-    )
+    # 2. Загружаем данные из схемы core и дополняем DataFrame булевыми столбцами: True, если признак выполняется
+    risk_model = RiskScoringModel(RISK_JSON)
+    pipeline = default_pipeline(dimensions.cities, dimensions.clients)
+
+    # Движок 'database': признаки, скоринг и витрина целиком внутри PostgreSQL (INSERT ... SELECT)
+    if DM_ENGINE == 'database' and not incremental:
+        scored_sql = compile_scoring_sql(pipeline, risk_model)
+        if DM_VERIFY_SQL:
+            mismatches = verify_sql_scores(extractor.fetch_query(scored_sql, 'sql_scores'), risk_model)
+            if not mismatches.empty:
+                raise ValueError(f"Оценки в БД и в Python расходятся для {len(mismatches)} транзакций:\n"
+                                 f"{mismatches.head(10)}")
+            print('✅ Проверка: оценки в БД и в Python совпадают.')
+        # Водяной знак берётся до построения: транзакции, добавленные во время INSERT, пересчитает следующий запуск
+        watermark = extractor.transactions_watermark()
+        extractor.create_datamart()
+        extractor.load_reasons(risk_model.reason_table(), DM_SHEMA)
+        extractor.insert_datamart_select(scored_sql, DM_SHEMA, DM_TABLE)
+        save_reload_watermark(extractor, DM_SHEMA, watermark, 0, DM_CLIENT_STATE, DM_LOOKBACK_MINUTES)
+        return
 
-    # 3. Инициализируем модель риска и рассчитываем: оценку риска, статус риска, причины риска
     start_time = time.perf_counter()
-    risk_model = RiskScoringModel(RISK_JSON)
-    df_calculated_risks = risk_model.calculate_scores(df_main)
+    df_history = None
+    late = ()
+    if incremental:
+        extractor.create_datamart(incremental=True)
+        last_id = extractor.get_watermark(DM_SHEMA)
+        if last_id:
+            # Уже загруженные маски причин должны расшифровываться по правилам этого запуска
+            extractor.check_reason_bits(risk_model.reason_table(), DM_SHEMA)
+        if DM_CLIENT_STATE:
+            extractor.create_client_state()
+        if DM_CLIENT_STATE and last_id and extractor.get_watermark(DM_SHEMA, 'client_risk_state') == last_id:
+            # Только новые транзакции; история клиентов — из их состояния в core.client_risk_state
+            df_transactions = extractor.fetch_transactions_after(last_id)
+            if df_transactions.empty:
+                print(f'✅ Новых транзакций после id = {last_id} нет, витрина актуальна.')
+                return
+            df_state = extractor.fetch_client_state(df_transactions['client_id'].unique())
+            late = history_clients(df_transactions, df_state, DM_LOOKBACK_MINUTES)
+            df_history = state_history(df_state[~df_state['client_id'].isin(late)])
+            if len(late):
+                # Новые транзакции не позже уже учтённых или состояние с меньшей глубиной истории —
+                # только для этих клиентов история извлекается из core.transactions (не новее уже извлечённых строк)
+                print(f'⚠️ У {len(late)} клиентов состояния недостаточно — их история извлекается из core.transactions.')
+                df_late = extractor.fetch_new_transactions(last_id, DM_LOOKBACK_MINUTES, client_ids=late)
+                df_late = df_late[df_late['transaction_id'].to_numpy() <= df_transactions['transaction_id'].max()]
+                df_transactions = pd.concat([df_transactions[~df_transactions['client_id'].isin(late)], df_late],
+                                            ignore_index=True)
+        if df_history is None:
+            # Транзакции после водяного знака и история тех же клиентов за DM_LOOKBACK_MINUTES
+            df_transactions = extractor.fetch_new_transactions(last_id, DM_LOOKBACK_MINUTES)
+            if df_transactions.empty:
+                print(f'✅ Новых транзакций после id = {last_id} нет, витрина актуальна.')
+                return
+    elif DM_ENGINE == 'sql':
+        # Признаки рассчитываются внутри PostgreSQL оконными функциями, в Python приходят готовые флаги
+        df_transactions = extractor.fetch_query(compile_pipeline_sql(pipeline), 'sql_features')
+    elif DM_SNAPSHOT_DIR:
+        # Локальный снимок выборки: запрос к БД — только за транзакциями, добавленными после снимка
+        df_transactions = extractor.fetch_transactions_snapshot(DM_SNAPSHOT_DIR)
+    else:
+        df_transactions = extractor.fetch_merged_transactions(binary=DM_BINARY_COPY)
+    # Водяной знак — по извлечённым транзакциям: строки, которые отбрасывает enrich_transactions()
+    # (неизвестный тип или город), иначе извлекались бы на каждом запуске
+    watermark = extraction_watermark(df_transactions, last_id if incremental else 0)
+    df_transactions = dimensions.enrich_transactions(df_transactions)
+    if incremental and not (df_transactions['transaction_id'] > last_id).any():
+        # Все новые транзакции отброшены — в витрину писать нечего, сдвигаем только водяной знак
+        extractor.save_watermark(DM_SHEMA, *watermark)
+        if df_history is not None:
+            extractor.save_watermark(DM_SHEMA, *watermark, pipeline='client_risk_state')
+        print(f'✅ Новые транзакции до id = {watermark[0]} не найдены в справочниках, витрина актуальна.')
+        return
+    if df_history is not None:
+        df_transactions = pd.concat([df_transactions, df_history], ignore_index=True)
+
+    # 3. Рассчитываем признаки и риск: оценку, статус, причины
+    # Типы и порядок строк приводятся один раз; при DM_WORKERS > 1 клиенты распределяются по процессам
+    if DM_ENGINE == 'sql' and not incremental:
+        df_calculated_risks = risk_model.calculate_scores(df_transactions)
+    else:
+        df_calculated_risks = score_transactions(df_transactions, risk_model, workers=DM_WORKERS, pipeline=pipeline,
+                                             copy=False)
     duration = time.perf_counter() - start_time
     print(f'✅ Данные успешно обработаны за {duration:.2f} секунд., риск оценен.')
 
-    # 4. Забираем с БД справочную информацию, необходимую для витрины, и объединяем с основным DataFrame
-    df_info = extractor.fetch_merged_info()
-    df_data_mart = df_calculated_risks.merge(df_info, on='transaction_id', how='inner')
+    if incremental:
+        # Строки, которые нужно записать в витрину (история нужна только для признаков)
+        # Новое состояние клиентов; None — пересчитать его целиком в БД (оно не соответствовало водяному знаку).
+        # Состояние клиентов late пересчитывается в БД по core.transactions
+        df_state = None
+        if df_history is not None:
+            df_state = build_client_state(df_calculated_risks[~df_calculated_risks['client_id'].isin(late)],
+                                          DM_LOOKBACK_MINUTES)
+        df_calculated_risks = df_calculated_risks[df_calculated_risks.pop('is_delta').to_numpy(dtype=bool)]
+
+    # 4. Дополняем DataFrame справочной информацией, необходимой для витрины
+    df_data_mart = build_datamart(dimensions, df_calculated_risks)
 
     # 5. Заливаем трансформированные данные (df_data_mart) в витрину
     # Создание витрины
-    extractor.create_datamart()
+    if not incremental:
+        extractor.create_datamart()
+    extractor.load_reasons(risk_model.reason_table(), DM_SHEMA)
+
+    if incremental and DM_CLIENT_STATE:
+        # Витрина, состояние клиентов и водяные знаки обновляются одной транзакцией
+        extractor.upsert_incremental(df_data_mart, df_state, DM_SHEMA, DM_TABLE, *watermark, DM_LOOKBACK_MINUTES,
+                                     rebuild_clients=late, chunk_size=DM_CHUNK_SIZE)
+    elif incremental:
+        extractor.upsert_datamart(df_data_mart, DM_SHEMA, DM_TABLE, chunk_size=DM_CHUNK_SIZE)
+        extractor.save_watermark(DM_SHEMA, *watermark)
+    else:
+        failed_chunks = extractor.load_datamart(df_data_mart, DM_SHEMA, DM_TABLE, method=DM_LOAD_METHOD,
+                                                chunk_size=DM_CHUNK_SIZE)
+        # Следующий инкрементальный запуск продолжает с последней загруженной транзакции
+        save_reload_watermark(extractor, DM_SHEMA, watermark, failed_chunks, DM_CLIENT_STATE, DM_LOOKBACK_MINUTES)
 
-    # Убираем лишние поля, не нужные в витрине
-    df_data_mart.drop([
-       'birth_date', 'risk_geolocation_change', 'small_sum', 'none_type',
-       'blacklist', 'risk_big_sum', 'risk_night_time', 'oper_rate'], axis=1, inplace=True)
-    extractor.load_datamart(df_data_mart, DM_SHEMA, DM_TABLE)
 
 if __name__ == '__main__':
     main()
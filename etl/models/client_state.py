@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+
+# Столбцы строк состояния (по одной на транзакцию клиента, которая остаётся в состоянии)
+STATE_COLUMNS = ['client_id', 'transaction_id', 'date_time', 'amount', 'source_city_id']
+
+
+def state_history(df_state: pd.DataFrame) -> pd.DataFrame:
+    """
+    Разворачивает состояние клиентов (core.client_risk_state) в строки истории, которые дописываются
+    к новым транзакциям вместо истории из core.transactions.
+
+    Каждая строка — транзакция из recent_times/recent_amounts с городом последней транзакции
+    (для смены геолокации нужна только последняя). is_delta = False: строки нужны только для признаков,
+    в витрину они не записываются. Остальные атрибуты признакам не нужны и заполняются нейтрально.
+    """
+    history = df_state.explode(['recent_times', 'recent_amounts'], ignore_index=True)
+    return pd.DataFrame({
+        'transaction_id': 0,
+        'client_id': history['client_id'].to_numpy(),
+        'account_id': 0,
+        'date_time': pd.to_datetime(history['recent_times']).to_numpy(),
+        'amount': history['recent_amounts'].to_numpy(dtype=float),
+        'transaction_type_id': 0,
+        'source_city_id': history['last_city_id'].to_numpy(),
+        'destination_city_id': 0,
+        'source_region_id': 0,
+        'destination_region_id': 0,
+        'is_delta': False,
+        't_type': None,
+        'blacklist': False,
+    })
+
+
+def out_of_order_clients(df_new: pd.DataFrame, df_state: pd.DataFrame) -> np.ndarray:
+    """
+    Клиенты, у которых новая транзакция не позже последней учтённой в состоянии.
+    Для них состояния недостаточно: в пакетном режиме новая транзакция входит в окна уже оценённых
+    транзакций, и их признаки нужно пересчитать по истории (fetch_new_transactions()).
+    """
+    first_new = df_new.groupby('client_id')['date_time'].min()
+    last_known = df_state.set_index('client_id')['last_date_time']
+    last_known = pd.to_datetime(last_known.reindex(first_new.index))
+    return first_new.index[(first_new <= last_known).to_numpy()].to_numpy()
+
+
+def history_clients(df_new: pd.DataFrame, df_state: pd.DataFrame, lookback_minutes: int = 120) -> np.ndarray:
+    """
+    Клиенты, история которых берётся из core.transactions (fetch_new_transactions(client_ids=...)), а не из состояния:
+    с транзакциями не по порядку (out_of_order_clients()) и с состоянием, собранным с меньшей глубиной истории,
+    чем lookback_minutes.
+    """
+    shallow = df_state.loc[df_state['lookback_minutes'].to_numpy() < lookback_minutes, 'client_id']
+    shallow = np.intersect1d(shallow.to_numpy(), df_new['client_id'].to_numpy())
+    return np.union1d(out_of_order_clients(df_new, df_state), shallow)
+
+
+def build_client_state(df: pd.DataFrame, lookback_minutes: int = 120) -> pd.DataFrame:
+    """
+    Строки нового состояния клиентов с новыми транзакциями (is_delta): транзакции клиента
+    за lookback_minutes до его последней (она всегда входит). Агрегируются в массивы при записи
+    (DBExtractor.upsert_incremental()).
+
+    Параметры:
+    - df: оценённые транзакции — новые и строки истории из state_history();
+    - lookback_minutes: не меньше самого длинного окна детекторов (в т.ч. max_hours геолокации).
+    """
+    clients = df.loc[df['is_delta'].to_numpy(dtype=bool), 'client_id'].unique()
+    df = df.loc[df['client_id'].isin(clients), STATE_COLUMNS]
+    last_date_time = df.groupby('client_id')['date_time'].transform('max')
+    keep = df['date_time'] >= last_date_time - pd.Timedelta(minutes=lookback_minutes)
+    return df[keep.to_numpy()].reset_index(drop=True)
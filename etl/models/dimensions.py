@@ -0,0 +1,223 @@
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from etl.config.logger_config import setup_logger
+from .kernels import haversine_np
+
+logger = setup_logger('config/etl.log')
+
+
+def lookup_codes(keys: np.ndarray, values, name: str, strict: bool = True):
+    """
+    Переводит идентификаторы values в позиции в отсортированном массиве keys.
+
+    При strict=True неизвестные идентификаторы — ошибка (KeyError), а не тихий промах;
+    при strict=False возвращается кортеж (codes, found), где found — маска найденных значений.
+    """
+    values = np.asarray(values)
+    if values.dtype.kind == 'f':
+        # NULL-идентификаторы (NaN) не совпадают ни с одним ключом
+        values = np.where(np.isnan(values), -1, values)
+    values = values.astype(np.int64)
+    codes = np.searchsorted(keys, values)
+    found = codes < len(keys)
+    found[found] = keys[codes[found]] == values[found]
+    if not strict:
+        return np.where(found, codes, 0), found
+    if not found.all():
+        raise KeyError(f"{name} отсутствуют в справочнике: {np.unique(values[~found])[:10].tolist()}")
+    return codes
+
+
+def table_version(df: pd.DataFrame) -> tuple:
+    """Версия справочника: (количество строк, max(created_at))."""
+    return len(df), pd.Timestamp(df['created_at'].max()) if len(df) else None
+
+
+class Dimension:
+    """
+    Справочник в памяти: отсортированные ключи и столбцы атрибутов в виде numpy-массивов.
+    Атрибуты транзакций получаются индексом по коду ключа (codes() + take()), без join и merge.
+    """
+    def __init__(self, df: pd.DataFrame, key: str, name: str):
+        """
+        Параметры:
+        - df: строки справочника со столбцом created_at;
+        - key: столбец первичного ключа;
+        - name: название справочника (для сообщений об ошибках).
+        """
+        df = df.sort_values(key)
+        self.name = name
+        self.keys = df[key].to_numpy(dtype=np.int64)
+        self.columns = {column: df[column].to_numpy() for column in df.columns if column not in (key, 'created_at')}
+        self.version = table_version(df)
+
+    def is_current(self, version: tuple) -> bool:
+        """Справочник актуален, если версия таблицы в БД не изменилась."""
+        return self.version == version
+
+    def codes(self, values, strict: bool = True):
+        """Переводит идентификаторы в позиции массивов справочника (см. lookup_codes())."""
+        return lookup_codes(self.keys, values, self.name, strict)
+
+    def take(self, column: str, codes: np.ndarray) -> np.ndarray:
+        """Значения атрибута column для массива кодов."""
+        return self.columns[column][codes]
+
+
+class CityDistances(Dimension):
+    """
+    Справочник городов с заранее рассчитанной матрицей расстояний (км) между всеми парами городов.
+
+    Городов немного (сотни), поэтому матрица занимает единицы МБ, а расстояние между
+    городами транзакций — это индексный доступ distances[код; код] вместо формулы гаверсинусов.
+    Версия справочника (количество строк и max(created_at)) позволяет понять, что матрицу нужно пересобрать.
+    """
+    def __init__(self, df_cities: pd.DataFrame):
+        """
+        Параметры:
+        - df_cities: DataFrame со столбцами city_id, latitude, longitude, created_at (core.cities).
+        """
+        super().__init__(df_cities, 'city_id', 'Города')
+        self.city_ids = self.keys
+        self.latitude = self.columns['latitude'] = self.columns['latitude'].astype(np.float64)
+        self.longitude = self.columns['longitude'] = self.columns['longitude'].astype(np.float64)
+        self.distances = haversine_np(self.latitude[:, None], self.longitude[:, None],
+                                      self.latitude[None, :], self.longitude[None, :])
+
+    def coordinates(self, city_ids) -> tuple:
+        """Возвращает (latitude, longitude) для массива city_id."""
+        codes = self.codes(city_ids)
+        return self.latitude[codes], self.longitude[codes]
+
+
+class ClientAttributes(Dimension):
+    """
+    Атрибуты клиентов, рассчитанные один раз на клиента (а не на каждую транзакцию):
+    возраст на дату as_of и домашний город. Значения лежат в компактных массивах в порядке client_id
+    и раздаются транзакциям индексом по коду клиента.
+    """
+    def __init__(self, df_clients: pd.DataFrame, as_of: date = None):
+        """
+        Параметры:
+        - df_clients: DataFrame со столбцами client_id, birth_date, home_city_id, created_at (core.clients);
+        - as_of: дата, на которую считается возраст (по умолчанию — сегодня).
+        """
+        super().__init__(df_clients, 'client_id', 'Клиенты')
+        self.as_of = as_of or date.today()
+        self.client_ids = self.keys
+        self.home_city_id = self.columns['home_city_id'].astype(np.int64)
+
+        # Возраст — как в add_client_age(): если ДР ещё не наступил в этом году, вычитаем 1
+        birth_date = pd.to_datetime(pd.Series(self.columns['birth_date']))
+        age = self.as_of.year - birth_date.dt.year
+        before_birthday = (self.as_of.month < birth_date.dt.month) | \
+                          ((self.as_of.month == birth_date.dt.month) & (self.as_of.day < birth_date.dt.day))
+        age -= before_birthday.astype(int)
+        self.age = age.to_numpy()
+
+    def is_current(self, version: tuple) -> bool:
+        """Кроме версии таблицы, возраст должен быть посчитан на сегодняшнюю дату."""
+        return super().is_current(version) and self.as_of == date.today()
+
+    def age_of(self, client_ids) -> np.ndarray:
+        """Возраст клиента для каждой транзакции."""
+        return self.age[self.codes(client_ids)]
+
+
+class DimensionCache:
+    """
+    Кэш справочников схемы core в памяти процесса: клиенты, типы транзакций, города, страны, регионы.
+
+    Справочники загружаются один раз и перечитываются по отдельности, только если изменилась
+    их версия (количество строк или max(created_at)) — её проверяет один лёгкий запрос.
+    Обогащение транзакций — векторный индексный доступ по уже извлечённым id
+    вместо повторного join в SQL и merge по transaction_id.
+    """
+    # Таблица core -> конструктор справочника по DataFrame из fetch_dimension()
+    TABLES = {
+        'clients': ClientAttributes,
+        'transaction_types': lambda df: Dimension(df, 'id', 'Типы транзакций'),
+        'cities': CityDistances,
+        'countries': lambda df: Dimension(df, 'country_id', 'Страны'),
+        'regions': lambda df: Dimension(df, 'region_id', 'Регионы'),
+    }
+
+    def __init__(self):
+        self.tables = {}
+
+    def refresh(self, extractor) -> 'DimensionCache':
+        """Перечитывает из БД только изменившиеся справочники."""
+        versions = extractor.table_versions(list(self.TABLES))
+        for table, build in self.TABLES.items():
+            cached = self.tables.get(table)
+            if cached is None or not cached.is_current(versions[table]):
+                self.tables[table] = build(extractor.fetch_dimension(table))
+                logger.info(f"Справочник core.{table} загружен в кэш, версия {self.tables[table].version}.")
+        return self
+
+    @property
+    def cities(self) -> CityDistances:
+        return self.tables['cities']
+
+    @property
+    def clients(self) -> ClientAttributes:
+        return self.tables['clients']
+
+    def _country_codes(self, city_codes: np.ndarray) -> tuple:
+        return self.tables['countries'].codes(self.cities.take('country_id', city_codes), strict=False)
+
+    def enrich_transactions(self, df: pd.DataFrame, strict: bool = False) -> pd.DataFrame:
+        """
+        Добавляет к транзакциям атрибуты, нужные признакам: t_type и blacklist (страна получателя).
+        Транзакции без записи в справочниках отбрасываются — как при INNER JOIN;
+        при strict=True это ошибка (KeyError).
+        """
+        types = self.tables['transaction_types']
+        type_codes, type_found = types.codes(df['transaction_type_id'], strict=False)
+        city_codes, city_found = self.cities.codes(df['destination_city_id'], strict=False)
+        country_codes, country_found = self._country_codes(city_codes)
+
+        found = type_found & city_found & country_found
+        if strict and not found.all():
+            raise KeyError(f"Транзакции не найдены в справочниках: {df['transaction_id'][~found].tolist()[:10]}")
+        df = df.assign(t_type=types.take('t_type', type_codes),
+                       blacklist=self.tables['countries'].take('blacklist', country_codes))
+        return self._drop_missing(df, found)
+
+    def datamart_info(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Добавляет к оценённым транзакциям справочную информацию для витрины (то же, что fetch_merged_info.sql):
+        имя клиента, признак поступления, регион/город/страна и координаты отправителя и получателя.
+        Транзакции без записи в справочниках отбрасываются — как при INNER JOIN.
+        """
+        client_codes, found = self.clients.codes(df['client_id'], strict=False)
+        type_codes, type_found = self.tables['transaction_types'].codes(df['transaction_type_id'], strict=False)
+        found &= type_found
+
+        info = {
+            'client_name': self.clients.take('full_name', client_codes),
+            'is_receipt': self.tables['transaction_types'].take('is_receipt', type_codes),
+        }
+        for side, prefix in (('source', 'sender'), ('destination', 'recipient')):
+            region_codes, region_found = self.tables['regions'].codes(df[f'{side}_region_id'], strict=False)
+            city_codes, city_found = self.cities.codes(df[f'{side}_city_id'], strict=False)
+            country_codes, country_found = self._country_codes(city_codes)
+            found &= region_found & city_found & country_found
+
+            info[f'{prefix}_region'] = self.tables['regions'].take('region_name', region_codes)
+            info[f'{prefix}_city'] = self.cities.take('city_name', city_codes)
+            info[f'{prefix}_country'] = self.tables['countries'].take('country_name', country_codes)
+            info[f'{prefix}_latitude'] = self.cities.latitude[city_codes]
+            info[f'{prefix}_longitude'] = self.cities.longitude[city_codes]
+
+        return self._drop_missing(df.assign(**info), found)
+
+    @staticmethod
+    def _drop_missing(df: pd.DataFrame, found: np.ndarray) -> pd.DataFrame:
+        if found.all():
+            return df
+        logger.warning(f"{int((~found).sum())} транзакций не найдены в справочниках и пропущены.")
+        return df[found]
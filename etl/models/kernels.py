@@ -0,0 +1,142 @@
+import numpy as np
+
+# Средний радиус Земли (км)
+EARTH_RADIUS_KM = 6371
+
+
+def haversine_np(lat1: np.ndarray, lon1: np.ndarray, lat2: np.ndarray, lon2: np.ndarray) -> np.ndarray:
+    """
+    Векторизованная формула гаверсинусов: расстояние (км) между парами точек.
+
+    Параметры:
+    - lat1, lat2: массивы широт (в градусах);
+    - lon1, lon2: массивы долгот (в градусах).
+    """
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(x, dtype=np.float64)) for x in (lat1, lon1, lat2, lon2))
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    # Для почти противоположных точек ошибка округления может дать a > 1 (и NaN в sqrt(1 - a))
+    a = np.minimum(a, 1.0)
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return EARTH_RADIUS_KM * c
+
+
+def client_starts(client_ids: np.ndarray) -> np.ndarray:
+    """
+    Возвращает булев массив: True для первой транзакции каждого клиента.
+    Массив client_ids должен быть отсортирован (сгруппирован) по клиентам.
+    """
+    client_ids = np.asarray(client_ids)
+    starts = np.ones(len(client_ids), dtype=bool)
+    starts[1:] = client_ids[1:] != client_ids[:-1]
+    return starts
+
+
+def _geolocation(client_ids: np.ndarray, times_ns: np.ndarray, pair_distance, distance_km: float,
+                 max_hours: float) -> tuple:
+    """
+    Общая часть детекторов смены геолокации: pair_distance(prev, cur) возвращает расстояния (км)
+    между строками prev и cur (индексы предыдущей и текущей транзакции одного клиента).
+    """
+    times_ns = np.asarray(times_ns, dtype=np.int64)
+    n = len(times_ns)
+
+    has_prev = ~client_starts(client_ids)
+    distance = np.zeros(n, dtype=np.float64)
+    hours_diff = np.full(n, np.nan, dtype=np.float64)
+    if n > 1:
+        # Сдвиг на одну строку: предыдущая транзакция есть только внутри одного клиента
+        cur = np.flatnonzero(has_prev)
+        prev = cur - 1
+        distance[cur] = pair_distance(prev, cur)
+        hours_diff[cur] = (times_ns[cur] - times_ns[prev]) / 1e9 / 3600
+
+    flags = ((distance > distance_km) & (hours_diff <= max_hours)).astype(int)
+    return flags, distance, hours_diff
+
+
+def geolocation_change(client_ids: np.ndarray, times_ns: np.ndarray, lat: np.ndarray, lon: np.ndarray,
+                       distance_km: float = 500, max_hours: float = 1) -> tuple:
+    """
+    Считает для каждой транзакции расстояние (км) и время (ч.) до предыдущей транзакции того же клиента
+    и флаг резкой смены геолокации. Входные массивы должны быть отсортированы по (client_id, date_time).
+
+    Возвращает кортеж (flags, distance, hours_diff):
+    - distance: 0 для первой транзакции клиента;
+    - hours_diff: NaN для первой транзакции клиента.
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    return _geolocation(client_ids, times_ns, lambda prev, cur: haversine_np(lat[prev], lon[prev], lat[cur], lon[cur]),
+                        distance_km, max_hours)
+
+
+def city_geolocation_change(client_ids: np.ndarray, times_ns: np.ndarray, city_codes: np.ndarray,
+                            distances: np.ndarray, distance_km: float = 500, max_hours: float = 1) -> tuple:
+    """
+    То же, что geolocation_change, но по кодам городов отправителя: расстояние берётся
+    из заранее рассчитанной матрицы distances[код; код] вместо формулы гаверсинусов.
+    """
+    city_codes = np.asarray(city_codes, dtype=np.int64)
+    return _geolocation(client_ids, times_ns, lambda prev, cur: distances[city_codes[prev], city_codes[cur]],
+                        distance_km, max_hours)
+
+
+def window_bounds(client_ids: np.ndarray, times_ns: np.ndarray, window_ns: int) -> tuple:
+    """
+    Для каждой транзакции находит границы окна [date_time - window; date_time] среди транзакций того же клиента.
+    Входные массивы должны быть отсортированы по (client_id, date_time).
+
+    Возвращает кортеж (left, right) индексов: окно транзакции i — это строки [left[i]; right[i]).
+    Транзакции с тем же временем, что и текущая, входят в окно (как и в исходной реализации с маской).
+    """
+    lefts, right = window_bounds_multi(client_ids, times_ns, [window_ns])
+    return lefts[0], right
+
+
+def window_bounds_multi(client_ids: np.ndarray, times_ns: np.ndarray, windows_ns: list) -> tuple:
+    """
+    То же, что window_bounds, сразу для нескольких длин окна: ключ поиска строится один раз,
+    правая граница от длины окна не зависит и считается один раз.
+
+    Возвращает кортеж (lefts, right): lefts[k] — левые границы для windows_ns[k].
+    """
+    times_ns = np.asarray(times_ns, dtype=np.int64)
+    n = len(times_ns)
+    if n == 0:
+        return [np.zeros(0, dtype=np.int64) for _ in windows_ns], np.zeros(0, dtype=np.int64)
+
+    starts = client_starts(client_ids)
+    codes = np.cumsum(starts) - 1
+    t_min = int(times_ns.min())
+    span = int(times_ns.max()) - t_min + int(max(windows_ns)) + 1
+
+    # Быстрый путь: клиенты "раздвигаются" по оси времени, и окна ищутся одним searchsorted по всему массиву
+    if (int(codes[-1]) + 1) * span < 2 ** 62:
+        key = (times_ns - t_min) + codes * span
+        lefts = [np.searchsorted(key, key - window_ns, side='left') for window_ns in windows_ns]
+        right = np.searchsorted(key, key, side='right')
+        return lefts, right
+
+    # Иначе (очень длинная история и много клиентов) — searchsorted внутри каждого клиента
+    lefts = [np.empty(n, dtype=np.int64) for _ in windows_ns]
+    right = np.empty(n, dtype=np.int64)
+    bounds = np.append(np.flatnonzero(starts), n)
+    for a, b in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+        times = times_ns[a:b]
+        for left, window_ns in zip(lefts, windows_ns):
+            left[a:b] = a + np.searchsorted(times, times - window_ns, side='left')
+        right[a:b] = a + np.searchsorted(times, times, side='right')
+    return lefts, right
+
+
+def window_sums(values: np.ndarray, left: np.ndarray, right: np.ndarray) -> np.ndarray:
+    """Сумма values по окнам [left[i]; right[i]) через префиксные суммы."""
+    prefix = np.concatenate(([0], np.cumsum(values)))
+    return prefix[right] - prefix[left]
+
+
+def to_cents(amount: np.ndarray) -> np.ndarray:
+    """Переводит суммы numeric(15, 2) в целые копейки, чтобы суммирование по окнам было точным."""
+    return np.rint(np.asarray(amount, dtype=np.float64) * 100).astype(np.int64)
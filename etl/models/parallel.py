@@ -0,0 +1,100 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from .pipeline import FeatureFrame, FeaturePipeline, default_pipeline
+from .risk_model import RiskScoringModel
+from .shared import SharedColumns, frame_view, to_shared_columns
+
+# Сколько строк прогоняется через конвейер, чтобы узнать состав и типы новых столбцов
+PROBE_ROWS = 1000
+
+
+def client_partitions(client_ids: np.ndarray, n_parts: int) -> np.ndarray:
+    """
+    Номер части (0..n_parts-1) для каждой строки: хэш client_id по модулю n_parts.
+    Хэш детерминирован между запусками, и все транзакции клиента попадают в одну часть.
+    """
+    return (pd.util.hash_array(np.asarray(client_ids)) % np.uint64(n_parts)).astype(np.int64)
+
+
+def _feature_partition(spec_in: dict, categories: dict, spec_out: dict, start: int, stop: int,
+                       pipeline: FeaturePipeline) -> None:
+    """
+    Задача воркера: подключается к общим блокам, считает признаки для строк [start; stop)
+    (все транзакции клиентов одной части, уже отсортированные) и пишет их в выходные массивы.
+    """
+    block_in = SharedColumns.attach(spec_in)
+    block_out = SharedColumns.attach(spec_out)
+    try:
+        df = pipeline.run(frame_view(block_in, categories, start, stop), copy=False)
+        for name in block_out:
+            block_out[name][start:stop] = df[name].to_numpy()
+        # Представления над разделяемой памятью должны быть освобождены до close()
+        del df
+    finally:
+        block_in.close()
+        block_out.close()
+
+
+def _parallel_features(df: pd.DataFrame, pipeline: FeaturePipeline, workers: int, copy: bool = True) -> pd.DataFrame:
+    """
+    Признаки в пуле процессов. Столбцы транзакций раскладываются в разделяемую память один раз,
+    строки упорядочены по (часть, client_id, date_time), так что каждая часть — непрерывный срез.
+    Воркеры читают свой срез без копирования и пишут признаки в заранее выделенные общие массивы.
+    """
+    base = FeatureFrame(df, sort=True, copy=copy).df
+    n = len(base)
+
+    # Состав, порядок и типы новых столбцов определяем пробным прогоном на нескольких строках
+    probe = pipeline.run(base.iloc[:PROBE_ROWS], copy=True)
+    features = [name for name in probe.columns if name not in base.columns]
+    for name in features:
+        if not isinstance(probe[name].dtype, np.dtype) or probe[name].dtype == object:
+            raise ValueError(f"Признак '{name}' имеет нечисловой тип {probe[name].dtype} "
+                             f"и не может быть записан в разделяемую память.")
+
+    parts = client_partitions(base['client_id'].to_numpy(), workers)
+    order = np.argsort(parts, kind='stable')
+    bounds = np.concatenate(([0], np.cumsum(np.bincount(parts, minlength=workers)))).tolist()
+    tasks = [(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+    block_in, categories = to_shared_columns(base, order)
+    with block_in, SharedColumns.create({name: (probe[name].dtype, n) for name in features}) as block_out:
+        with ProcessPoolExecutor(max_workers=len(tasks)) as pool:
+            futures = [pool.submit(_feature_partition, block_in.spec, categories, block_out.spec, a, b, pipeline)
+                       for a, b in tasks]
+            for future in futures:
+                future.result()
+
+        # Возвращаем признаки в порядок (client_id, date_time) и вставляем на те же позиции, что и конвейер
+        for name in features:
+            values = np.empty(n, dtype=block_out[name].dtype)
+            values[order] = block_out[name]
+            base.insert(probe.columns.get_loc(name), name, values)
+    return base
+
+
+def score_transactions(df: pd.DataFrame, risk_model: RiskScoringModel, workers: int = 1,
+                       pipeline: FeaturePipeline = None, copy: bool = True) -> pd.DataFrame:
+    """
+    Рассчитывает признаки и риск для всех транзакций.
+
+    При workers > 1 клиенты делятся по хэшу client_id на workers частей, и признаки каждой части
+    считаются в отдельном процессе (ProcessPoolExecutor) над общим колоночным блоком в разделяемой
+    памяти (models/shared.py) — DataFrame не сериализуется. Все детекторы считаются внутри клиента,
+    поэтому результат совпадает с последовательным расчётом, включая порядок строк и индекс.
+    Векторизованный скоринг выполняется в основном процессе.
+
+    Параметры:
+    - workers: число процессов (1 — без пула, None — по числу ядер);
+    - pipeline: конвейер признаков (по умолчанию default_pipeline());
+    - copy: False — не копировать df, если он уже отсортирован (исходный DF будет изменён).
+    """
+    pipeline = pipeline or default_pipeline()
+    workers = workers or os.cpu_count()
+    if workers <= 1 or df['client_id'].nunique() < 2:
+        return risk_model.calculate_scores(pipeline.run(df, copy=copy))
+    return risk_model.calculate_scores(_parallel_features(df, pipeline, workers, copy))
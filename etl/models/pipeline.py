@@ -0,0 +1,237 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from .dimensions import CityDistances, ClientAttributes
+from .kernels import (client_starts, geolocation_change, city_geolocation_change, window_bounds, window_sums,
+                      to_cents)
+
+# Значения t_type, которые считаются неизвестной категорией перевода
+UNKNOWN_TYPES = ['Неизвестно', 'Unknown', 'Other', '']
+
+
+class FeatureFrame:
+    """
+    Общее состояние для детекторов признаков: DataFrame, приведённый к нужным типам
+    и (при необходимости) отсортированный по (client_id, date_time, transaction_id) один раз,
+    и кэш numpy-массивов его столбцов.
+
+    Детекторы дописывают свои столбцы прямо в self.df, не копируя его.
+    """
+    def __init__(self, df: pd.DataFrame, sort: bool = True, copy: bool = True):
+        """
+        Параметры:
+        - df: DataFrame в формате fetch_merged_transactions();
+        - sort: True — отсортировать строки по (client_id, date_time); транзакции клиента с одинаковым временем —
+          по transaction_id (если столбец есть), как ORDER BY t.date_time, t.id в SQL-признаках;
+        - copy: False — разрешить изменение переданного DataFrame на месте.
+        """
+        # Типы приводятся один раз: дальше детекторы работают с готовыми массивами
+        normalized = {}
+        for column in ('date_time', 'birth_date'):
+            if column in df.columns and not pd.api.types.is_datetime64_ns_dtype(df[column]):
+                normalized[column] = pd.to_datetime(df[column]).to_numpy('datetime64[ns]')
+        for column in ('amount', 'sender_latitude', 'sender_longitude'):
+            if column in df.columns and df[column].dtype != np.float64:
+                normalized[column] = df[column].to_numpy(dtype=np.float64)
+
+        # Сортировка стабильная, как и sort_values по нескольким столбцам
+        order = None
+        if sort:
+            client_ids = df['client_id'].to_numpy()
+            times = normalized.get('date_time', df['date_time'].to_numpy('datetime64[ns]')).view('int64')
+            ids = df['transaction_id'].to_numpy() if 'transaction_id' in df.columns else None
+            if not self._is_sorted(client_ids, times, ids):
+                order = np.lexsort((times, client_ids) if ids is None else (ids, times, client_ids))
+
+        if order is not None:
+            df = df.take(order)
+        elif copy:
+            df = df.copy()
+        for column, values in normalized.items():
+            df[column] = values if order is None else values[order]
+
+        self.df = df
+        self.is_sorted = sort
+        self._arrays = {}
+
+    @staticmethod
+    def _is_sorted(client_ids: np.ndarray, times: np.ndarray, ids: np.ndarray = None) -> bool:
+        """Проверяет, что строки уже упорядочены по (client_id, date_time) и, если задан ids, по transaction_id."""
+        if len(client_ids) < 2:
+            return True
+        if np.any(client_ids[1:] < client_ids[:-1]):
+            return False
+        unordered = times[1:] < times[:-1]
+        if ids is not None:
+            unordered |= (times[1:] == times[:-1]) & (ids[1:] < ids[:-1])
+        return not np.any(unordered & ~client_starts(client_ids)[1:])
+
+    def array(self, column: str) -> np.ndarray:
+        """Возвращает (и кэширует) numpy-массив столбца."""
+        if column not in self._arrays:
+            if column == 'date_time':
+                self._arrays[column] = self.df['date_time'].to_numpy('datetime64[ns]').view('int64')
+            else:
+                self._arrays[column] = self.df[column].to_numpy()
+        return self._arrays[column]
+
+    def require_sorted(self, step: str) -> None:
+        if not self.is_sorted:
+            raise ValueError(f"Детектор '{step}' требует сортировки по (client_id, date_time).")
+
+
+# Шаги конвейера: каждый дописывает в frame.df свой столбец
+def add_client_age(frame: FeatureFrame, clients: ClientAttributes = None) -> None:
+    """
+    Добавляет столбец 'client_age': возраст клиента на сегодняшний день.
+    Если передан справочник clients, возраст берётся из него по 'client_id' (посчитан один раз на клиента),
+    иначе вычисляется по 'birth_date' каждой строки.
+    """
+    if clients is not None:
+        frame.df.insert(min(4, len(frame.df.columns)), 'client_age', clients.age_of(frame.array('client_id')))
+        return
+
+    birth_date = frame.df['birth_date']
+    today = datetime.today()
+    age = today.year - birth_date.dt.year
+
+    # Если ДР ещё не наступил в этом году - вычитаем 1
+    before_birthday = (today.month < birth_date.dt.month) | \
+                      ((today.month == birth_date.dt.month) & (today.day < birth_date.dt.day))
+    age -= before_birthday.astype(int)
+    frame.df.insert(min(4, len(frame.df.columns)), 'client_age', age)
+
+
+def add_large_amounts(frame: FeatureFrame, threshold: float = 100_000) -> None:
+    """Добавляет столбец 'risk_big_sum': сумма транзакции превышает threshold."""
+    frame.df['risk_big_sum'] = (frame.array('amount') > threshold).astype(int)
+
+
+def add_night_transactions(frame: FeatureFrame, start_hour: int = 0, end_hour: int = 5) -> None:
+    """
+    Добавляет столбец 'risk_night_time': транзакция проводилась в период [start_hour; end_hour].
+    Час берётся из .dt.hour — для времени с часовым поясом это местный час, а не час UTC.
+    """
+    hours = frame.df['date_time'].dt.hour.to_numpy()
+    frame.df['risk_night_time'] = ((hours >= start_hour) & (hours <= end_hour)).astype(int)
+
+
+def add_geolocation(frame: FeatureFrame, distance_km: float = 500, max_hours: float = 1,
+                    cities: CityDistances = None) -> tuple:
+    """
+    Добавляет столбец 'risk_geolocation_change': резкая смена геолокации относительно предыдущей транзакции.
+    Если передан справочник cities, расстояния берутся из матрицы по 'source_city_id',
+    иначе считаются по координатам 'sender_latitude'/'sender_longitude'.
+    Возвращает массивы (distance, hours_diff) для отладочного вывода.
+    """
+    frame.require_sorted('geolocation')
+    if cities is not None:
+        flags, distance, hours_diff = city_geolocation_change(
+            frame.array('client_id'), frame.array('date_time'),
+            cities.codes(frame.array('source_city_id')), cities.distances,
+            distance_km=distance_km, max_hours=max_hours
+        )
+    else:
+        flags, distance, hours_diff = geolocation_change(
+            frame.array('client_id'), frame.array('date_time'),
+            frame.array('sender_latitude'), frame.array('sender_longitude'),
+            distance_km=distance_km, max_hours=max_hours
+        )
+    frame.df['risk_geolocation_change'] = flags
+    return distance, hours_diff
+
+
+def add_operation_rate(frame: FeatureFrame, n_threshold: int = 7, time_window: int = 120) -> None:
+    """Добавляет столбец 'oper_rate': за time_window (мин.) клиент совершил более n_threshold транзакций."""
+    frame.require_sorted('operation_rate')
+    left, right = window_bounds(frame.array('client_id'), frame.array('date_time'),
+                                pd.Timedelta(minutes=time_window).value)
+    frame.df['oper_rate'] = ((right - left) > n_threshold).astype(int)
+
+
+def add_small_sums(frame: FeatureFrame, min_amt: float = 0, max_amt: float = 10000,
+                   total_threshold: float = 20000, time_window: int = 60) -> np.ndarray:
+    """
+    Добавляет столбец 'small_sum': сумма мелких транзакций за time_window (мин.) превысила total_threshold.
+    Окна строятся только по мелким транзакциям; суммы считаются в копейках через префиксные суммы.
+    Возвращает маску мелких транзакций.
+    """
+    frame.require_sorted('small_sums')
+    amount = frame.array('amount')
+    small = (amount >= min_amt) & (amount <= max_amt)
+    left, right = window_bounds(frame.array('client_id')[small], frame.array('date_time')[small],
+                                pd.Timedelta(minutes=time_window).value)
+    window_sum = window_sums(to_cents(amount[small]), left, right)
+
+    small_sum = np.zeros(len(amount), dtype=int)
+    small_sum[small] = window_sum > total_threshold * 100
+    frame.df['small_sum'] = small_sum
+    return small
+
+
+def add_none_type(frame: FeatureFrame) -> None:
+    """
+    Добавляет столбец 'none_type': тип транзакции неизвестен (значение из UNKNOWN_TYPES или пропуск).
+    Пропуском считается и None, и NaN — в исходном detect_none_type() NaN (float) давал 0. Так признак
+    одинаков в SQL (tt.t_type IS NULL) и при DM_WORKERS > 1, где None и NaN не различаются.
+    """
+    t_type = frame.df['t_type']
+    frame.df['none_type'] = (t_type.isin(UNKNOWN_TYPES) | t_type.isna()).astype(int)
+
+
+class FeaturePipeline:
+    """
+    Конвейер признаков: приводит типы и сортирует DataFrame один раз,
+    затем по очереди выполняет зарегистрированные детекторы на общих массивах.
+
+    Использование:
+        pipeline = FeaturePipeline().register(add_client_age).register(add_large_amounts, threshold=100_000)
+        df = pipeline.run(df_transactions)
+    """
+    def __init__(self):
+        self.steps = []
+
+    def register(self, step, **params) -> 'FeaturePipeline':
+        """Добавляет детектор step с параметрами params в конец конвейера."""
+        self.steps.append((step, params))
+        return self
+
+    def run(self, df: pd.DataFrame, copy: bool = True) -> pd.DataFrame:
+        """
+        Рассчитывает все признаки и возвращает DataFrame, отсортированный по (client_id, date_time).
+
+        Параметры:
+        - copy: False — не копировать df, если он уже отсортирован (исходный DF будет изменён).
+        """
+        frame = FeatureFrame(df, sort=True, copy=copy)
+        for step, params in self.steps:
+            step(frame, **params)
+        return frame.df
+
+
+def default_pipeline(cities: CityDistances = None, clients: ClientAttributes = None) -> FeaturePipeline:
+    """
+    Конвейер с набором признаков и порогами, используемыми в main().
+
+    Параметры:
+    - cities: справочник городов с матрицей расстояний (None — смена геолокации считается по координатам);
+    - clients: атрибуты клиентов (None — возраст считается по birth_date каждой транзакции).
+    """
+    return (
+        FeaturePipeline()
+
+        # Возраст клиентов
+        .register(add_client_age, clients=clients)
+
+        # Приоритетные признаки
+        .register(add_large_amounts, threshold=100_000)
+        .register(add_night_transactions, start_hour=0, end_hour=5)
+        .register(add_geolocation, distance_km=500, max_hours=1, cities=cities)
+
+        # Вторичные признаки
+        .register(add_operation_rate, n_threshold=7, time_window=120)
+        .register(add_small_sums, min_amt=0, max_amt=10000, total_threshold=20000, time_window=60)
+        .register(add_none_type)
+    )
@@ -0,0 +1,287 @@
+from collections import deque
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from .dimensions import CityDistances, ClientAttributes, DimensionCache
+from .kernels import haversine_np
+from .parallel import score_transactions
+from .pipeline import (UNKNOWN_TYPES, FeatureFrame, FeaturePipeline, add_client_age, add_large_amounts,
+                       add_night_transactions, add_geolocation, add_operation_rate, add_small_sums, add_none_type,
+                       default_pipeline)
+from .risk_model import RiskScoringModel
+
+
+# Онлайн-детекторы: по одному на шаг конвейера, с теми же параметрами и столбцом признака.
+# Каждый хранит своё состояние по клиентам и обрабатывает транзакцию за O(окна).
+
+class _ClientAge:
+    column = 'client_age'
+
+    def __init__(self, clients: ClientAttributes = None):
+        self.clients = clients
+
+    def __call__(self, client_id, time_ns: int, transaction: dict):
+        if self.clients is not None:
+            return int(self.clients.age_of(np.array([client_id]))[0])
+        # Как в add_client_age(): если ДР ещё не наступил в этом году, вычитаем 1
+        birth_date, today = pd.Timestamp(transaction['birth_date']), date.today()
+        return today.year - birth_date.year - int((today.month, today.day) < (birth_date.month, birth_date.day))
+
+
+class _LargeAmounts:
+    column = 'risk_big_sum'
+
+    def __init__(self, threshold: float = 100_000):
+        self.threshold = threshold
+
+    def __call__(self, client_id, time_ns: int, transaction: dict) -> int:
+        return int(float(transaction['amount']) > self.threshold)
+
+
+class _NightTransactions:
+    column = 'risk_night_time'
+
+    def __init__(self, start_hour: int = 0, end_hour: int = 5):
+        self.start_hour, self.end_hour = start_hour, end_hour
+
+    def __call__(self, client_id, time_ns: int, transaction: dict) -> int:
+        # Местный час, как .dt.hour в add_night_transactions(); time_ns для времени с часовым поясом — UTC
+        return int(self.start_hour <= pd.Timestamp(transaction['date_time']).hour <= self.end_hour)
+
+
+class _Geolocation:
+    """Последнее местоположение и время клиента; расстояние — по матрице городов или по координатам."""
+    column = 'risk_geolocation_change'
+
+    def __init__(self, distance_km: float = 500, max_hours: float = 1, cities: CityDistances = None):
+        self.distance_km, self.max_hours, self.cities = distance_km, max_hours, cities
+        self.last = {}
+
+    def __call__(self, client_id, time_ns: int, transaction: dict) -> int:
+        if self.cities is not None:
+            location = int(self.cities.codes(np.array([transaction['source_city_id']]))[0])
+        else:
+            location = (float(transaction['sender_latitude']), float(transaction['sender_longitude']))
+        previous = self.last.get(client_id)
+        self.last[client_id] = (time_ns, location)
+        if previous is None:
+            return 0
+
+        prev_time, prev_location = previous
+        if self.cities is not None:
+            distance = self.cities.distances[prev_location, location]
+        else:
+            distance = haversine_np(prev_location[0], prev_location[1], location[0], location[1])
+        hours_diff = (time_ns - prev_time) / 1e9 / 3600
+        return int(distance > self.distance_km and hours_diff <= self.max_hours)
+
+
+class _OperationRate:
+    """
+    Кольцевой буфер последних n_threshold + 1 времён транзакций клиента: признак сработал,
+    если после вытеснения старых, чем окно, в буфере остались все n_threshold + 1 транзакций.
+    """
+    column = 'oper_rate'
+
+    def __init__(self, n_threshold: int = 7, time_window: int = 120):
+        self.n_threshold = n_threshold
+        self.window_ns = pd.Timedelta(minutes=time_window).value
+        self.times = {}
+
+    def __call__(self, client_id, time_ns: int, transaction: dict) -> int:
+        times = self.times.get(client_id)
+        if times is None:
+            times = self.times[client_id] = deque(maxlen=self.n_threshold + 1)
+        times.append(time_ns)
+        while times[0] < time_ns - self.window_ns:
+            times.popleft()
+        return int(len(times) > self.n_threshold)
+
+
+class _SmallSums:
+    """Мелкие транзакции клиента за окно (время, сумма в копейках) и их текущая сумма."""
+    column = 'small_sum'
+
+    def __init__(self, min_amt: float = 0, max_amt: float = 10000, total_threshold: float = 20000,
+                 time_window: int = 60):
+        self.min_amt, self.max_amt, self.total_threshold = min_amt, max_amt, total_threshold
+        self.window_ns = pd.Timedelta(minutes=time_window).value
+        self.windows = {}
+        self.sums = {}
+
+    def __call__(self, client_id, time_ns: int, transaction: dict) -> int:
+        amount = float(transaction['amount'])
+        if not self.min_amt <= amount <= self.max_amt:
+            return 0
+
+        window = self.windows.get(client_id)
+        if window is None:
+            window = self.windows[client_id] = deque()
+        total = self.sums.get(client_id, 0)
+        while window and window[0][0] < time_ns - self.window_ns:
+            total -= window.popleft()[1]
+        # Копейки — как to_cents(): округление до ближайшего чётного
+        cents = int(np.rint(amount * 100))
+        window.append((time_ns, cents))
+        self.sums[client_id] = total = total + cents
+        return int(total > self.total_threshold * 100)
+
+
+class _NoneType:
+    column = 'none_type'
+
+    def __call__(self, client_id, time_ns: int, transaction: dict) -> int:
+        t_type = transaction.get('t_type')
+        return int(pd.isna(t_type) or t_type in UNKNOWN_TYPES)
+
+
+# Шаг конвейера -> онлайн-детектор
+REALTIME_STEPS = {
+    add_client_age: _ClientAge,
+    add_large_amounts: _LargeAmounts,
+    add_night_transactions: _NightTransactions,
+    add_geolocation: _Geolocation,
+    add_operation_rate: _OperationRate,
+    add_small_sums: _SmallSums,
+    add_none_type: _NoneType,
+}
+
+
+class RealtimeScorer:
+    """
+    Онлайн-скоринг отдельных транзакций по мере их поступления.
+
+    Детекторы строятся по шагам конвейера (те же параметры, что в пакетном режиме) и хранят компактное
+    состояние по клиентам: последнее местоположение и время, кольцевой буфер времён для частоты операций,
+    мелкие суммы за окно с текущей суммой. Транзакция обрабатывается за O(окна), без DataFrame;
+    риск считается RiskScoringModel.score_one() по текущему плану правил (в т.ч. после reload()).
+
+    Транзакции одного клиента должны поступать в порядке date_time. В отличие от пакетного режима,
+    окно транзакции не включает транзакции с тем же временем, поступившие позже неё.
+    """
+    def __init__(self, risk_model: RiskScoringModel, pipeline: FeaturePipeline = None):
+        """
+        Параметры:
+        - risk_model: модель риска;
+        - pipeline: конвейер признаков, параметры шагов которого используются (по умолчанию default_pipeline()).
+          Шаг без онлайн-реализации — ошибка (ValueError).
+        """
+        self.risk_model = risk_model
+        self.detectors = []
+        for step, params in (pipeline or default_pipeline()).steps:
+            if step not in REALTIME_STEPS:
+                raise ValueError(f"Для шага '{step.__name__}' нет онлайн-реализации.")
+            self.detectors.append(REALTIME_STEPS[step](**params))
+        self.last_time = {}
+
+    def score(self, transaction: dict) -> dict:
+        """
+        Оценивает одну транзакцию и обновляет состояние клиента.
+
+        Параметры:
+        - transaction: словарь с полями client_id, date_time, amount, t_type, blacklist и полями, нужными шагам
+          (source_city_id или sender_latitude/sender_longitude, birth_date без справочника клиентов).
+
+        Возвращает словарь признаков и risk_score, reason_mask, risk_status, is_suspicious.
+        Транзакция клиента раньше уже обработанной — ошибка (ValueError), состояние не меняется.
+        """
+        client_id = transaction['client_id']
+        time_ns = pd.Timestamp(transaction['date_time']).value
+        if time_ns < self.last_time.get(client_id, time_ns):
+            raise ValueError(f"Транзакция клиента {client_id} от {transaction['date_time']} "
+                             f"раньше уже обработанной — порядок по времени нарушен.")
+        self.last_time[client_id] = time_ns
+
+        features = {detector.column: detector(client_id, time_ns, transaction) for detector in self.detectors}
+        # Признаки правил, которые не считаются детекторами (например, blacklist), берутся из самой транзакции
+        features.update(self.risk_model.score_one({**transaction, **features}))
+        return features
+
+
+class MicroBatchScorer:
+    """
+    Векторный скоринг небольших пачек транзакций (микро-батчей) конвейером признаков и calculate_scores().
+
+    Между пачками хранится недавняя история клиентов: транзакции за lookback_minutes до самой поздней
+    и последняя транзакция каждого клиента (для смены геолокации). Пачка считается вместе с историей
+    своих клиентов — как дельта в инкрементальном режиме main(), поэтому признаки совпадают с пакетным расчётом.
+    """
+    def __init__(self, risk_model: RiskScoringModel, pipeline: FeaturePipeline = None, lookback_minutes: int = 120,
+                 dimensions: DimensionCache = None):
+        """
+        Параметры:
+        - risk_model: модель риска;
+        - pipeline: конвейер признаков (по умолчанию default_pipeline());
+        - lookback_minutes: глубина истории, не меньше самого длинного окна детекторов;
+        - dimensions: кэш справочников; если задан, t_type и blacklist берутся из него
+          по transaction_type_id и destination_city_id, как в пакетном режиме.
+        """
+        self.risk_model = risk_model
+        self.pipeline = pipeline or default_pipeline()
+        self.dimensions = dimensions
+        self.lookback = pd.Timedelta(minutes=lookback_minutes)
+        self.history = None
+
+    def score_batch(self, transactions: list) -> pd.DataFrame:
+        """
+        Оценивает пачку транзакций (список словарей, поля — как в RealtimeScorer.score())
+        и запоминает их в истории. Возвращает DataFrame с признаками и оценками в порядке пачки.
+        Если задан кэш справочников, транзакция без записи в нём — ошибка (KeyError), а не пропуск.
+        """
+        batch = pd.DataFrame(transactions)
+        if self.dimensions is not None:
+            batch = self.dimensions.enrich_transactions(batch, strict=True)
+        batch['date_time'] = pd.to_datetime(batch['date_time'])
+        batch['_position'] = np.arange(len(batch))
+
+        # Конвейер дописывает признаки в переданный DataFrame, а в историю попадают только поля транзакций
+        frame = batch.copy(deep=False)
+        if self.history is not None:
+            known = self.history[self.history['client_id'].isin(batch['client_id'].unique())]
+            frame = pd.concat([known, batch], ignore_index=True)
+        scored = self.risk_model.calculate_scores(self.pipeline.run(frame, copy=False))
+        scored = scored[scored['_position'].to_numpy() >= 0].sort_values('_position')
+
+        self._remember(batch.assign(_position=-1))
+        return scored.drop(columns='_position').reset_index(drop=True)
+
+    def _remember(self, batch: pd.DataFrame) -> None:
+        """Добавляет пачку в историю и вытесняет транзакции старше lookback (кроме последней у клиента)."""
+        history = batch if self.history is None else pd.concat([self.history, batch], ignore_index=True)
+        date_time = history['date_time']
+        keep = (date_time >= date_time.max() - self.lookback).to_numpy()
+        keep[date_time.groupby(history['client_id']).idxmax().to_numpy()] = True
+        self.history = history[keep].reset_index(drop=True)
+
+
+def replay_transactions(scorer: RealtimeScorer, df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Прогоняет историю через онлайн-скоринг в порядке (client_id, date_time), как в пакетном режиме.
+    Возвращает отсортированный DataFrame с результатами score() для каждой строки.
+    """
+    df = FeatureFrame(df, sort=True).df
+    results = [scorer.score(transaction) for transaction in df.to_dict('records')]
+    return pd.DataFrame(results, index=df.index)
+
+
+def verify_replay(df: pd.DataFrame, risk_model: RiskScoringModel, pipeline: FeaturePipeline = None) -> pd.DataFrame:
+    """
+    Проверка онлайн-скоринга: та же история считается пакетно (score_transactions()) и через RealtimeScorer,
+    возвращаются строки, где признаки или оценки расходятся (пустой DataFrame — всё совпало).
+
+    Транзакции, у которых есть более поздняя по порядку транзакция клиента с тем же временем, не сравниваются:
+    в пакетном режиме она входит в их окно, а онлайн она ещё не поступила.
+    """
+    pipeline = pipeline or default_pipeline()
+    batch = score_transactions(df, risk_model, pipeline=pipeline)
+    online = replay_transactions(RealtimeScorer(risk_model, pipeline), df)
+
+    comparable = ~batch.duplicated(['client_id', 'date_time'], keep='last').to_numpy()
+    mismatch = np.zeros(len(batch), dtype=bool)
+    for column in online.columns:
+        mismatch |= batch[column].to_numpy() != online[column].to_numpy()
+    mismatch &= comparable
+    return pd.concat([batch.loc[mismatch, ['transaction_id', *online.columns]],
+                      online.loc[mismatch].add_prefix('online_')], axis=1)
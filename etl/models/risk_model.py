@@ -1,5 +1,119 @@
-import pandas as pd
+import hashlib
 import json
+import os
+import threading
+from dataclasses import dataclass
+from types import MappingProxyType
+
+import pandas as pd
+import numpy as np
+
+from etl.config.logger_config import setup_logger
+
+logger = setup_logger('config/etl.log')
+
+
+@dataclass(frozen=True)
+class RiskPlan:
+    """
+    Скомпилированные правила модели: всё, что нужно для скоринга, рассчитано один раз при загрузке JSON.
+
+    - content_hash: sha256 содержимого JSON-файла;
+    - config: исходная конфигурация (только для чтения: MappingProxyType, списки — кортежами);
+    - map: признаки в порядке JSON-файла {column: {'score': ..., 'reason_flags': ...}}, только для чтения;
+    - columns: столбцы флагов (все признаки, кроме client_age);
+    - weights: вектор весов columns (int64, если все веса целые, иначе float64), только для чтения;
+    - flag_bits: бит reason_mask для каждого из columns;
+    - age_bit: бит client_age (None — усиливающего фактора нет);
+    - multiplier, addition: параметры усиливающего фактора client_age.
+
+    План неизменяем: модель заменяет его целиком, поэтому расчёт, начатый со старым планом,
+    не увидит наполовину обновлённых правил. План разделяется через кэш, поэтому и его словари
+    доступны только для чтения.
+    """
+    content_hash: str
+    config: MappingProxyType
+    map: MappingProxyType
+    columns: tuple
+    weights: np.ndarray
+    flag_bits: tuple
+    age_bit: int = None
+    multiplier: float = 1
+    addition: float = 0
+
+    @classmethod
+    def compile(cls, config: dict, content_hash: str) -> 'RiskPlan':
+        """Строит план по конфигурации JSON; ошибка в правилах — ValueError."""
+        feature_map = {}
+        for group in config.values():
+            for name, info in group.items():
+                feature_map[info.get("column")] = {"score": info.get("score"), "reason_flags": name}
+
+        columns = tuple(col for col in feature_map if col != 'client_age')
+        weights = np.array([feature_map[col]['score'] for col in columns])
+        if not np.issubdtype(weights.dtype, np.integer):
+            weights = weights.astype(np.float64)
+        weights.setflags(write=False)
+
+        bits = {col: bit for bit, col in enumerate(feature_map)}
+        multiplier, addition = feature_map['client_age']['score'] if 'client_age' in feature_map else (1, 0)
+        return cls(content_hash=content_hash, config=_freeze(config), map=_freeze(feature_map), columns=columns,
+                   weights=weights,
+                   flag_bits=tuple(bits[col] for col in columns), age_bit=bits.get('client_age'),
+                   multiplier=multiplier, addition=addition)
+
+    def __reduce__(self):
+        # MappingProxyType не сериализуется pickle — план пересобирается из конфигурации
+        return self.compile, (_thaw(self.config), self.content_hash)
+
+    @classmethod
+    def from_config(cls, config: dict) -> 'RiskPlan':
+        """План по конфигурации в памяти (структура как в JSON-файле), например для сравнения вариантов весов."""
+        content = json.dumps(config, ensure_ascii=False, sort_keys=True).encode('utf-8')
+        return cls.compile(config, hashlib.sha256(content).hexdigest())
+
+
+def _freeze(value):
+    """Копия JSON-структуры только для чтения: словари — MappingProxyType, списки — кортежи."""
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _thaw(value):
+    """Изменяемая копия структуры из _freeze(): обычные словари и списки."""
+    if isinstance(value, MappingProxyType):
+        return {key: _thaw(item) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return [_thaw(item) for item in value]
+    return value
+
+
+# Кэш скомпилированных планов: по одному (текущему) плану на JSON-файл
+_PLAN_CACHE = {}
+_PLAN_LOCK = threading.Lock()
+
+
+def load_plan(json_path: str, max_reasons: int) -> RiskPlan:
+    """
+    Читает JSON-файл и возвращает его план: пока содержимое файла не изменилось, план не компилируется заново.
+    Признаков больше, чем битов в reason_mask (max_reasons), — ошибка (ValueError).
+    """
+    with open(json_path, 'rb') as f:
+        content = f.read()
+    content_hash = hashlib.sha256(content).hexdigest()
+    key = os.path.abspath(json_path)
+    with _PLAN_LOCK:
+        plan = _PLAN_CACHE.get(key)
+    if plan is None or plan.content_hash != content_hash:
+        plan = RiskPlan.compile(json.loads(content.decode('utf-8')), content_hash)
+        with _PLAN_LOCK:
+            _PLAN_CACHE[key] = plan
+    if len(plan.map) > max_reasons:
+        raise ValueError(f"Слишком много признаков для битовой маски: {len(plan.map)} > {max_reasons}")
+    return plan
 
 
 class RiskScoringModel:
@@ -10,8 +124,19 @@ class RiskScoringModel:
 
     - risk_score: суммарный скоринговый балл;
     - risk_status: статус транзакции;
-    - reason_flags: список причин.
+    - reason_mask: битовая маска причин (бит i — i-й признак в порядке JSON-файла).
     """
+    # Маска хранится в витрине как INTEGER
+    MAX_REASONS = 31
+
+    # Статусы (по возрастанию риска) и пороги баллов: > REVIEW_SCORE — проверка, >= SUSPICIOUS_SCORE — подозрительная
+    STATUSES = ('Обычная', 'Требует проверки', 'Подозрительная')
+    REVIEW_SCORE = 50
+    SUSPICIOUS_SCORE = 80
+
+    # Возраст, с которого применяется усиливающий фактор client_age
+    OLD_AGE = 60
+
     def __init__(self, json_path: str):
         """
         Инициализация модели.
@@ -19,85 +144,284 @@ class RiskScoringModel:
         Параметры:
         - json_path: путь к JSON-файлу с весами признаков
         """
-        with open(json_path, 'r', encoding='utf-8') as f:
-            self.config = json.load(f)
+        self.json_path = json_path
+        self._mtime = os.stat(json_path).st_mtime_ns
+        self.plan = load_plan(json_path, self.MAX_REASONS)
 
-        self.map = self.extract_feature_scores()
+    @property
+    def config(self) -> dict:
+        """Копия конфигурации правил (план разделяется через кэш и не меняется)."""
+        return _thaw(self.plan.config)
+
+    @property
+    def map(self) -> dict:
+        """Копия признаков {column: {'score': ..., 'reason_flags': ...}}."""
+        return _thaw(self.plan.map)
 
     def extract_feature_scores(self) -> dict:
         """
         Возвращает словарь признаков в формате:
         { 'column': {'score': value, 'reason': feature_name}, ... }
         """
-        result = {}
-        data = self.config
+        return {col: dict(info) for col, info in self.plan.map.items()}
 
-        for group in data.values():
-            for name, info in group.items():
-                column = info.get("column")
-                score = info.get("score")
+    def reload(self) -> bool:
+        """
+        Перечитывает JSON-файл и атомарно подменяет план (одно присваивание self.plan).
 
-                result[column] = {"score": score, "reason_flags": name}
-        return result
+        Возвращает True, если правила изменились. Если файл недоступен или содержит ошибку,
+        модель продолжает работать со старым планом, а ошибка пишется в лог.
+        """
+        try:
+            mtime = os.stat(self.json_path).st_mtime_ns
+            plan = load_plan(self.json_path, self.MAX_REASONS)
+        except (OSError, ValueError, AttributeError, TypeError) as e:
+            logger.error(f"Не удалось перечитать правила {self.json_path}, используется прежняя версия: {e}")
+            return False
+        self._mtime = mtime
+        if plan is self.plan:
+            return False
+        self.plan = plan
+        logger.info(f"Правила риска перечитаны из {self.json_path}, версия {plan.content_hash[:12]}.")
+        return True
+
+    def reload_if_changed(self) -> bool:
+        """
+        Дешёвая проверка для долгоживущего процесса: файл перечитывается, только если изменилось его mtime.
+        """
+        try:
+            if os.stat(self.json_path).st_mtime_ns == self._mtime:
+                return False
+        except OSError as e:
+            logger.error(f"Файл правил {self.json_path} недоступен, используется прежняя версия: {e}")
+            return False
+        return self.reload()
 
     def calculate_scores(self, df: pd.DataFrame) -> pd.DataFrame:
         """
         Добавляет в DataFrame столбцы:
           - risk_score: суммарный балл по булевым столбцам;
-          - risk_status: один из ['Обычная', 'Требует проверки', 'Подозрительная'], выбираемый по критериям.
+          - reason_mask: битовая маска причин риска (текст — render_reasons());
+          - risk_status: один из ['Обычная', 'Требует проверки', 'Подозрительная'], выбираемый по критериям;
+          - is_suspicious: статус транзакции отличается от 'Обычная'.
+
+        Все расчёты векторные: флаги признаков — матрица (строки x признаки), баллы — её произведение
+        на вектор весов, усиливающий фактор возраста применяется по маскам.
         """
-        df = df.copy()
-        df['risk_score'] = 0
+        # План фиксируется один раз на вызов: перезагрузка правил не затронет уже начатый расчёт
+        plan = self.plan
 
-        # Формирование массива причин каждой транзакции
-        def reasons(row: pd.Series):
-            k = []
-            score_total = 0
+        # Существующие столбцы не изменяются, поэтому достаточно поверхностной копии
+        df = df.copy(deep=False)
 
-            for col_name, d_info in self.map.items():
-                reason = d_info["reason_flags"]
-                score = d_info['score']
+        # Матрица сработавших признаков и вектор их весов
+        flags = np.zeros((len(df), len(plan.columns)), dtype=bool)
+        for j, col in enumerate(plan.columns):
+            flags[:, j] = df[col].to_numpy(dtype=bool)
+        score = flags.astype(plan.weights.dtype) @ plan.weights
 
-                if not col_name == 'client_age':
-                    if row[col_name]:
-                        score_total += score
-                        k.append(reason)
-                else:
-                    if row['client_age'] >= 60:
-                        k.append(reason)
-            k = ', '.join(k)
+        # Считаем усиливающие факторы при их наличии
+        is_old = np.zeros(len(df), dtype=bool)
+        if plan.age_bit is not None:
+            is_old = (df['client_age'] >= self.OLD_AGE).to_numpy()
+            any_flag = flags.any(axis=1)
+            score = np.where(is_old & any_flag, score * plan.multiplier,
+                             np.where(is_old, score + plan.addition, score))
+        df['risk_score'] = np.asarray(score).astype(np.int64)
 
-            if not k:
-                return k, 0
-            return k, score_total
+        # Причины кодируются битовой маской: бит i — i-й признак в порядке JSON-файла
+        mask = np.zeros(len(df), dtype=np.int64)
+        for j, bit in enumerate(plan.flag_bits):
+            mask |= flags[:, j].astype(np.int64) << bit
+        if plan.age_bit is not None:
+            mask |= is_old.astype(np.int64) << plan.age_bit
+        df['reason_mask'] = mask
 
-        df[['reason_flags', 'risk_score']] = df.apply(reasons, axis=1, result_type='expand')
+        # Определяем статус транзакции
+        risk_score = df['risk_score'].to_numpy()
+        status = np.select([risk_score >= self.SUSPICIOUS_SCORE,
+                            (risk_score > self.REVIEW_SCORE) & (risk_score < self.SUSPICIOUS_SCORE)], [2, 1], default=0)
+        df['risk_status'] = np.array(self.STATUSES, dtype=object)[status]
+        df['is_suspicious'] = status != 0
 
-        # Считаем усиливающие факторы при их наличии
-        def high_age(row: pd.Series):
-            current_score = row['risk_score']
-            if row['client_age'] >= 60:
-                score = self.map['client_age']['score']
-                cols_to_check = list(self.map.keys())
-                cols_to_check.remove('client_age')
-
-                if row[cols_to_check].any():
-                    current_score *= score[0]
-                else:
-                    current_score += score[1]
-            return int(current_score)
-        df['risk_score'] = df.apply(high_age, axis=1)
+        return df
 
-        # Определяем статус транзакции
-        def assign_status(row: pd.Series):
-            if row['risk_score'] >= 80:
-                return 'Подозрительная'
-            elif 50 < row['risk_score'] < 80:
-                return 'Требует проверки'
-            else:
-                return 'Обычная'
-
-        df['risk_status'] = df.apply(assign_status, axis=1)
-        df['is_suspicious'] = df.apply(lambda x: x['risk_status'] != 'Обычная', axis=1)
-
-        return df
\ No newline at end of file
+    def score_one(self, features: dict) -> dict:
+        """
+        Оценка одной транзакции по словарю признаков {столбец: значение} — те же правила, что в calculate_scores(),
+        без построения DataFrame (для онлайн-скоринга).
+
+        Возвращает словарь с ключами risk_score, reason_mask, risk_status, is_suspicious.
+        """
+        plan = self.plan
+        hits = [bool(features[col]) for col in plan.columns]
+        score = sum(weight for hit, weight in zip(hits, plan.weights.tolist()) if hit)
+
+        client_age = features.get('client_age') if plan.age_bit is not None else None
+        is_old = client_age is not None and not pd.isna(client_age) and client_age >= self.OLD_AGE
+        if is_old:
+            score = score * plan.multiplier if any(hits) else score + plan.addition
+        risk_score = int(score)
+
+        mask = sum(1 << bit for hit, bit in zip(hits, plan.flag_bits) if hit)
+        if is_old:
+            mask |= 1 << plan.age_bit
+
+        status = 2 if risk_score >= self.SUSPICIOUS_SCORE else 1 if risk_score > self.REVIEW_SCORE else 0
+        return {'risk_score': risk_score, 'reason_mask': mask, 'risk_status': self.STATUSES[status],
+                'is_suspicious': status != 0}
+
+    def score_configurations(self, df: pd.DataFrame, configs: dict, labels=None,
+                             thresholds: dict = None) -> pd.DataFrame:
+        """
+        Оценка «что если»: скоринг уже рассчитанных признаков сразу по N вариантам правил за один проход.
+
+        Флаги признаков (комбинации x признаки) умножаются на матрицу весов (признаки x варианты) — одно
+        матричное умножение вместо N запусков calculate_scores(). Та же матрица дополнена индикаторами
+        признаков варианта, поэтому условие «сработал хотя бы один признак» для client_age получается
+        тем же умножением. Баллы, усиливающий фактор и статусы считаются так же, как в calculate_scores().
+        Умножаются только уникальные комбинации (флаги, возрастной фактор, метка) с весом — числом строк,
+        поэтому время почти не зависит от числа вариантов, а память — от длины истории.
+
+        Параметры:
+        - df: DataFrame с признаками (результат конвейера признаков) и client_age;
+        - configs: {имя варианта: RiskPlan, конфигурация (dict как в JSON-файле) или путь к JSON-файлу};
+        - labels: эталонная разметка «подозрительная» (bool на строку); по умолчанию — решения текущих правил модели;
+        - thresholds: {имя варианта: (REVIEW_SCORE, SUSPICIOUS_SCORE)} для перебора порогов
+          (по умолчанию — пороги модели).
+
+        Возвращает DataFrame (строка — вариант): количество транзакций в каждом статусе (STATUSES)
+        и матрица ошибок по is_suspicious относительно labels: tp, fp, fn, tn.
+        """
+        plans = {name: self._as_plan(config) for name, config in configs.items()}
+        thresholds = thresholds or {}
+        n_configs = len(plans)
+
+        # Общий набор столбцов флагов и матрица [веса | индикаторы признаков варианта]
+        columns = list(dict.fromkeys(col for plan in plans.values() for col in plan.columns))
+        position = {col: i for i, col in enumerate(columns)}
+        matrix = np.zeros((len(columns), 2 * n_configs), dtype=np.float64)
+        for k, plan in enumerate(plans.values()):
+            rows = [position[col] for col in plan.columns]
+            matrix[rows, k] = plan.weights
+            matrix[rows, n_configs + k] = 1
+
+        has_age = np.array([plan.age_bit is not None for plan in plans.values()])
+        multiplier = np.array([float(plan.multiplier) for plan in plans.values()])
+        addition = np.array([float(plan.addition) for plan in plans.values()])
+        review = np.array([thresholds.get(name, (self.REVIEW_SCORE, self.SUSPICIOUS_SCORE))[0] for name in plans])
+        suspicious = np.array([thresholds.get(name, (self.REVIEW_SCORE, self.SUSPICIOUS_SCORE))[1] for name in plans])
+
+        # Строки различаются только набором флагов, возрастным фактором и меткой — кодируем их битами
+        # и считаем баллы для уникальных комбинаций (их не больше 2 ** (признаков + 2)) с их количеством
+        code = np.zeros(len(df), dtype=np.int64)
+        for j, col in enumerate(columns):
+            code |= df[col].to_numpy(dtype=bool).astype(np.int64) << j
+        if has_age.any():
+            code |= (df['client_age'] >= self.OLD_AGE).to_numpy().astype(np.int64) << len(columns)
+        if labels is None:
+            labels = self.calculate_scores(df)['is_suspicious']
+        code |= np.asarray(labels, dtype=bool).astype(np.int64) << (len(columns) + 1)
+        code, count = np.unique(code, return_counts=True)
+
+        bits = (code[:, None] >> np.arange(len(columns) + 2)) & 1
+        product = bits[:, :len(columns)].astype(np.float64) @ matrix
+        score, any_flag = product[:, :n_configs], product[:, n_configs:] > 0
+        old = bits[:, [len(columns)]].astype(bool) & has_age
+        score = np.where(old & any_flag, score * multiplier, np.where(old, score + addition, score)).astype(np.int64)
+        status = np.where(score >= suspicious, 2, np.where(score > review, 1, 0))
+
+        status_counts = np.stack([((status == value) * count[:, None]).sum(axis=0)
+                                  for value in range(len(self.STATUSES))], axis=1)
+        predicted, actual = status != 0, bits[:, [len(columns) + 1]].astype(bool)
+        confusion = np.stack([((predicted & actual) * count[:, None]).sum(axis=0),
+                              ((predicted & ~actual) * count[:, None]).sum(axis=0),
+                              ((~predicted & actual) * count[:, None]).sum(axis=0),
+                              ((~predicted & ~actual) * count[:, None]).sum(axis=0)], axis=1)
+        return pd.DataFrame(np.hstack([status_counts, confusion]), index=pd.Index(list(plans), name='config'),
+                            columns=[*self.STATUSES, 'tp', 'fp', 'fn', 'tn'])
+
+    def _as_plan(self, config) -> RiskPlan:
+        """Вариант правил для score_configurations(): готовый план, dict конфигурации или путь к JSON-файлу."""
+        if isinstance(config, RiskPlan):
+            plan = config
+        elif isinstance(config, dict):
+            plan = RiskPlan.from_config(config)
+        else:
+            return load_plan(config, self.MAX_REASONS)
+        if len(plan.map) > self.MAX_REASONS:
+            raise ValueError(f"Слишком много признаков для битовой маски: {len(plan.map)} > {self.MAX_REASONS}")
+        return plan
+
+    def compile_sql(self, relation: str) -> str:
+        """
+        Компилирует правила модели в SQL (PostgreSQL): возвращает SELECT, который добавляет к строкам
+        relation (подзапрос с признаками из JSON-файла и client_age) столбцы risk_score, reason_mask,
+        risk_status, is_suspicious — с той же семантикой, что и calculate_scores():
+
+        - флаг признака — значение столбца, приведённое к boolean (NULL — не сработал);
+        - усиливающий фактор client_age: при возрасте >= OLD_AGE балл умножается на множитель,
+          если сработал хотя бы один признак, иначе к нему прибавляется надбавка;
+        - итоговый балл — отбрасывание дробной части float8, как astype(int64) в numpy.
+        """
+        plan = self.plan
+        columns, weights = plan.columns, plan.weights.tolist()
+
+        def flag(alias: str, col: str) -> str:
+            return f"COALESCE(({alias}.{col})::int <> 0, FALSE)"
+
+        def number(value) -> str:
+            return f"{float(value)!r}::float8" if isinstance(value, float) else str(int(value))
+
+        base = ' + '.join(f"CASE WHEN {flag('r', col)} THEN {number(w)} ELSE 0 END" for col, w in zip(columns, weights))
+        any_flag = ' OR '.join(flag('r', col) for col in columns) or 'FALSE'
+        is_old = f"COALESCE(r.client_age >= {self.OLD_AGE}, FALSE)" if plan.age_bit is not None else 'FALSE'
+
+        mask_terms = []
+        for bit, col in enumerate(plan.map):
+            hit = 'b._is_old' if col == 'client_age' else flag('b', col)
+            mask_terms.append(f"CASE WHEN {hit} THEN {1 << bit} ELSE 0 END")
+
+        score = 'b._base_score::float8'
+        if plan.age_bit is not None:
+            multiplier, addition = plan.multiplier, plan.addition
+            score = (f"CASE WHEN b._is_old AND b._any_flag THEN b._base_score::float8 * {float(multiplier)!r}::float8 "
+                     f"WHEN b._is_old THEN b._base_score::float8 + {float(addition)!r}::float8 "
+                     f"ELSE b._base_score::float8 END")
+
+        review, suspicious = self.REVIEW_SCORE, self.SUSPICIOUS_SCORE
+        status = (f"CASE WHEN s.risk_score >= {suspicious} THEN '{self.STATUSES[2]}' "
+                  f"WHEN s.risk_score > {review} AND s.risk_score < {suspicious} THEN '{self.STATUSES[1]}' "
+                  f"ELSE '{self.STATUSES[0]}' END")
+        return (
+            f"SELECT s.*, {status} AS risk_status, s.risk_score > {review} AS is_suspicious FROM (\n"
+            f"  SELECT b.*, trunc({score})::bigint AS risk_score, {' + '.join(mask_terms) or '0'} AS reason_mask FROM (\n"
+            f"    SELECT r.*, ({base or '0'}) AS _base_score, ({any_flag}) AS _any_flag, {is_old} AS _is_old\n"
+            f"    FROM ({relation}) AS r\n"
+            f"  ) AS b\n"
+            f") AS s"
+        )
+
+    def reason_table(self) -> pd.DataFrame:
+        """
+        Справочник причин для битовой маски: bit, mask (2 ** bit), reason, feature_column.
+        """
+        feature_map = self.plan.map
+        return pd.DataFrame({
+            'bit': range(len(feature_map)),
+            'mask': [1 << bit for bit in range(len(feature_map))],
+            'reason': [info['reason_flags'] for info in feature_map.values()],
+            'feature_column': list(feature_map),
+        })
+
+    def render_reasons(self, reason_mask: pd.Series) -> pd.Series:
+        """
+        Переводит битовые маски причин в текст через запятую (в порядке признаков JSON-файла).
+        Строки собираются только для уникальных масок.
+        """
+        reasons = [info['reason_flags'] for info in self.plan.map.values()]
+        codes, inverse = np.unique(np.asarray(reason_mask, dtype=np.int64), return_inverse=True)
+        texts = np.array([', '.join(r for bit, r in enumerate(reasons) if code >> bit & 1) for code in codes.tolist()],
+                         dtype=object)
+        index = reason_mask.index if isinstance(reason_mask, pd.Series) else None
+        return pd.Series(texts[inverse], index=index, name='reason_flags', dtype=object)
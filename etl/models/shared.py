@@ -0,0 +1,118 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+
+class SharedColumns:
+    """
+    Колоночный блок в разделяемой памяти (multiprocessing.shared_memory): по одному сегменту на столбец.
+
+    Родительский процесс создаёт блок (create() / from_arrays()), воркеры подключаются к нему по spec
+    (attach()) и получают numpy-массивы поверх тех же страниц памяти — без pickle и копирования.
+    Сегменты освобождает только создатель блока: close() + unlink().
+    """
+    def __init__(self, segments: dict, owner: bool):
+        self._segments = segments
+        self._owner = owner
+        self._arrays = {name: np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+                        for name, (shm, dtype, shape) in segments.items()}
+
+    @classmethod
+    def create(cls, columns: dict) -> 'SharedColumns':
+        """
+        Выделяет пустые столбцы.
+
+        Параметры:
+        - columns: {имя: (dtype, длина)}.
+        """
+        segments = {}
+        try:
+            for name, (dtype, length) in columns.items():
+                dtype = np.dtype(dtype)
+                shm = shared_memory.SharedMemory(create=True, size=max(dtype.itemsize * length, 1))
+                segments[name] = (shm, dtype.str, (length,))
+        except Exception:
+            for shm, _, _ in segments.values():
+                shm.close()
+                shm.unlink()
+            raise
+        return cls(segments, owner=True)
+
+    @classmethod
+    def from_arrays(cls, arrays: dict) -> 'SharedColumns':
+        """Копирует массивы {имя: np.ndarray} в новый блок разделяемой памяти."""
+        block = cls.create({name: (values.dtype, len(values)) for name, values in arrays.items()})
+        for name, values in arrays.items():
+            block[name][:] = values
+        return block
+
+    @classmethod
+    def attach(cls, spec: dict) -> 'SharedColumns':
+        """Подключается к существующему блоку по его spec (в процессе-воркере)."""
+        segments = {}
+        for name, (shm_name, dtype, shape) in spec.items():
+            segments[name] = (shared_memory.SharedMemory(name=shm_name), dtype, shape)
+        return cls(segments, owner=False)
+
+    @property
+    def spec(self) -> dict:
+        """Описание блока для передачи воркерам: {имя: (имя сегмента, dtype, shape)}."""
+        return {name: (shm.name, dtype, shape) for name, (shm, dtype, shape) in self._segments.items()}
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self._arrays[name]
+
+    def __iter__(self):
+        return iter(self._arrays)
+
+    def close(self) -> None:
+        """Отключается от блока; создатель блока также удаляет сегменты."""
+        self._arrays = {}
+        for shm, _, _ in self._segments.values():
+            shm.close()
+            if self._owner:
+                shm.unlink()
+        self._segments = {}
+
+    def __enter__(self) -> 'SharedColumns':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def to_shared_columns(df: pd.DataFrame, order: np.ndarray = None) -> tuple:
+    """
+    Раскладывает столбцы DataFrame в разделяемую память (строки в порядке order).
+
+    Числовые, логические и datetime64 столбцы копируются как есть, остальные (строки, объекты)
+    кодируются: в блоке лежат коды int32, а уникальные значения возвращаются отдельно (они небольшие).
+
+    Возвращает кортеж (SharedColumns, categories), где categories = {имя столбца: уникальные значения}.
+    """
+    arrays, categories = {}, {}
+    for name in df.columns:
+        column = df[name]
+        if isinstance(column.dtype, np.dtype) and column.dtype.kind in 'biufM':
+            values = column.to_numpy()
+        else:
+            codes, uniques = pd.factorize(column, use_na_sentinel=True)
+            values = codes.astype(np.int32)
+            categories[name] = uniques
+        arrays[name] = values if order is None else values[order]
+    return SharedColumns.from_arrays(arrays), categories
+
+
+def frame_view(block: SharedColumns, categories: dict, start: int, stop: int) -> pd.DataFrame:
+    """
+    DataFrame над строками [start; stop) блока без копирования числовых столбцов:
+    столбцы — срезы массивов разделяемой памяти, закодированные столбцы — pd.Categorical по кодам.
+    """
+    columns = {}
+    for name in block:
+        values = block[name][start:stop]
+        if name in categories:
+            values = pd.Categorical.from_codes(values, categories=categories[name])
+        columns[name] = values
+    return pd.DataFrame(columns, copy=False)
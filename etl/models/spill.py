@@ -0,0 +1,130 @@
+import math
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from .parallel import client_partitions
+
+# Во сколько раз пиковая память обработки части (признаки, скоринг, справочная информация витрины)
+# больше объёма её извлечённых строк
+PEAK_FACTOR = 12
+
+
+def partitions_for_budget(total_rows: int, row_bytes: float, memory_mb: float) -> int:
+    """
+    Число частей, при котором обработка одной части укладывается в memory_mb (МБ):
+    объём строк части с запасом PEAK_FACTOR на признаки и витрину.
+    """
+    return max(1, math.ceil(total_rows * row_bytes * PEAK_FACTOR / (memory_mb * 2 ** 20)))
+
+
+class SpillPartitions:
+    """
+    Сброс транзакций на диск по частям — хэшу client_id (client_partitions()), как в score_transactions().
+
+    Строки дописываются на диск порциями (write()) в любом порядке: все транзакции клиента попадают в одну
+    часть. finalize() по очереди сортирует каждую часть по (client_id, date_time, transaction_id) и сохраняет её
+    столбцами (.npy), после чего части читаются по одной (read(), итерация) — в памяти одновременно только одна часть.
+    Поддерживаются числа, даты и bool; nullable-столбцы с NULL хранятся как float64 с NaN. Каталог удаляется в close().
+    """
+    def __init__(self, n_parts: int, directory: str = None):
+        """
+        Параметры:
+        - n_parts: число частей;
+        - directory: каталог, в котором создаётся временный каталог частей (None — системный).
+        """
+        self.n_parts = n_parts
+        self.path = tempfile.mkdtemp(prefix='spill_', dir=directory)
+        self.rows = [0] * n_parts
+        self.columns = None
+        self._batches = 0
+        self._finalized = False
+
+    def _part_path(self, part: int) -> str:
+        return os.path.join(self.path, f'part_{part:04d}')
+
+    @staticmethod
+    def _column_array(df: pd.DataFrame, column: str) -> np.ndarray:
+        """
+        Столбец порции без object-типа. Столбец, целиком состоящий из NULL (nullable-столбец в порции без значений),
+        приходит как object и становится float64 с NaN — как у pd.read_sql для целочисленного столбца с NULL;
+        числа в object (например, Decimal) приводятся к числовому типу. Остальные object-столбцы — ошибка (ValueError).
+        """
+        values = df[column]
+        if values.dtype != object:
+            return values.to_numpy()
+        if values.isna().all():
+            return np.full(len(values), np.nan)
+        try:
+            return pd.to_numeric(values).to_numpy(dtype=float)
+        except (TypeError, ValueError):
+            raise ValueError(f"Столбец '{column}' имеет тип object и не может быть сброшен на диск.") from None
+
+    def write(self, df: pd.DataFrame) -> None:
+        """Раскладывает порцию строк по частям и дописывает их на диск (np.savez на часть)."""
+        if self._finalized:
+            raise ValueError("Части уже отсортированы (finalize()), дописывать строки нельзя.")
+        if self.columns is None:
+            self.columns = list(df.columns)
+
+        parts = client_partitions(df['client_id'].to_numpy(), self.n_parts)
+        order = np.argsort(parts, kind='stable')
+        bounds = np.searchsorted(parts[order], np.arange(self.n_parts + 1))
+        arrays = {column: self._column_array(df, column)[order] for column in self.columns}
+
+        for part in np.flatnonzero(np.diff(bounds)):
+            start, stop = bounds[part], bounds[part + 1]
+            os.makedirs(self._part_path(part), exist_ok=True)
+            np.savez(os.path.join(self._part_path(part), f'batch_{self._batches:06d}.npz'),
+                     **{column: values[start:stop] for column, values in arrays.items()})
+            self.rows[part] += int(stop - start)
+        self._batches += 1
+
+    def finalize(self) -> None:
+        """Сортирует каждую часть по (client_id, date_time, transaction_id), сохраняет её столбцами и удаляет порции."""
+        for part in range(self.n_parts):
+            if not self.rows[part]:
+                continue
+            path = self._part_path(part)
+            batches = sorted(name for name in os.listdir(path) if name.startswith('batch_'))
+            arrays = {column: [] for column in self.columns}
+            for name in batches:
+                with np.load(os.path.join(path, name), allow_pickle=False) as batch:
+                    for column in self.columns:
+                        arrays[column].append(batch[column])
+            # Порции с NULL и без них (float64 и int64) сводятся к общему типу
+            arrays = {column: np.concatenate(values) for column, values in arrays.items()}
+
+            # Устойчивая сортировка — тот же порядок строк, что и у FeatureFrame(sort=True)
+            order = np.lexsort((arrays['transaction_id'], arrays['date_time'], arrays['client_id']))
+            for column, values in arrays.items():
+                np.save(os.path.join(path, f'{column}.npy'), values[order], allow_pickle=False)
+            for name in batches:
+                os.remove(os.path.join(path, name))
+        self._finalized = True
+
+    def read(self, part: int) -> pd.DataFrame:
+        """Отсортированная часть part в DataFrame."""
+        if not self._finalized:
+            raise ValueError("Части ещё не отсортированы — сначала finalize().")
+        path = self._part_path(part)
+        return pd.DataFrame({column: np.load(os.path.join(path, f'{column}.npy'), allow_pickle=False)
+                             for column in self.columns})
+
+    def __iter__(self):
+        """Непустые части по очереди."""
+        for part in range(self.n_parts):
+            if self.rows[part]:
+                yield self.read(part)
+
+    def close(self) -> None:
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def __enter__(self) -> 'SpillPartitions':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -0,0 +1,155 @@
+from numbers import Real
+
+import numpy as np
+import pandas as pd
+
+from .risk_model import RiskScoringModel
+from .pipeline import (UNKNOWN_TYPES, FeaturePipeline, add_client_age, add_large_amounts, add_night_transactions,
+                       add_geolocation, add_operation_rate, add_small_sums, add_none_type)
+
+# Столбцы транзакций, которые возвращаются вместе с признаками (как в fetch_merged_transactions.sql)
+BASE_COLUMNS = [
+    't.id AS transaction_id', 't.client_id', 't.account_id', 't.date_time', 't.amount', 't.transaction_type_id',
+    't.source_city_id', 't.destination_city_id', 't.source_region_id', 't.destination_region_id',
+]
+
+# Справочники, которые нужны отдельным признакам
+JOINS = {
+    'clients': 'JOIN {schema}.clients AS cl\n    ON t.client_id = cl.client_id',
+    'transaction_types': 'JOIN {schema}.transaction_types AS tt\n    ON t.transaction_type_id = tt.id',
+    'src_city': 'JOIN {schema}.cities AS src_city\n    ON t.source_city_id = src_city.city_id',
+}
+
+# Порядок транзакций клиента; id разрешает транзакции с одинаковым временем (для LAG)
+SEQUENCE_WINDOW = 'w_seq AS (PARTITION BY t.client_id ORDER BY t.date_time, t.id)'
+
+
+def _number(value) -> str:
+    """Числовой литерал SQL; параметры шагов подставляются в текст запроса, поэтому только числа."""
+    if isinstance(value, bool) or not isinstance(value, Real):
+        raise ValueError(f"Ожидалось число, получено {value!r}.")
+    return repr(value) if isinstance(value, float) else str(int(value))
+
+
+def _string(value: str) -> str:
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def _range_window(minutes) -> str:
+    """Окно [date_time - minutes; date_time] по клиенту; CURRENT ROW в режиме RANGE включает транзакции с тем же временем."""
+    return (f"OVER (PARTITION BY t.client_id ORDER BY t.date_time "
+            f"RANGE BETWEEN INTERVAL '{_number(minutes)} minutes' PRECEDING AND CURRENT ROW)")
+
+
+# Генераторы SQL для шагов конвейера: (выражение, нужные join-ы, нужен ли w_seq)
+def _sql_client_age(**_) -> tuple:
+    return "date_part('year', age(current_date, cl.birth_date))::int", {'clients'}, False
+
+
+def _sql_large_amounts(threshold: float = 100_000) -> tuple:
+    return f"(t.amount > {_number(threshold)})::int", set(), False
+
+
+def _sql_night_transactions(start_hour: int = 0, end_hour: int = 5) -> tuple:
+    return (f"(EXTRACT(HOUR FROM t.date_time) BETWEEN {_number(start_hour)} AND {_number(end_hour)})::int",
+            set(), False)
+
+
+def _sql_geolocation(distance_km: float = 500, max_hours: float = 1, **_) -> tuple:
+    # Формула гаверсинусов в float8 — как haversine_np(): предыдущая точка клиента — LAG по w_seq
+    lat, lon = 'src_city.latitude::float8', 'src_city.longitude::float8'
+    prev_lat, prev_lon = f'LAG({lat}) OVER w_seq', f'LAG({lon}) OVER w_seq'
+    # a ограничено сверху единицей, как в haversine_np(): иначе sqrt(1 - a) от отрицательного числа — ошибка
+    a = (f"LEAST(1, power(sin((radians({lat}) - radians({prev_lat})) / 2), 2) + "
+         f"cos(radians({prev_lat})) * cos(radians({lat})) * power(sin((radians({lon}) - radians({prev_lon})) / 2), 2))")
+    distance = f"6371 * 2 * atan2(sqrt({a}), sqrt(1 - ({a})))"
+    hours_diff = "EXTRACT(EPOCH FROM t.date_time - LAG(t.date_time) OVER w_seq) / 3600"
+    return (f"COALESCE(({distance} > {_number(distance_km)} AND {hours_diff} <= {_number(max_hours)})::int, 0)",
+            {'src_city'}, True)
+
+
+def _sql_operation_rate(n_threshold: int = 7, time_window: int = 120) -> tuple:
+    return f"(COUNT(*) {_range_window(time_window)} > {_number(n_threshold)})::int", set(), False
+
+
+def _sql_small_sums(min_amt: float = 0, max_amt: float = 10000, total_threshold: float = 20000,
+                    time_window: int = 60) -> tuple:
+    # Окно по всем транзакциям клиента, но суммируются только мелкие (FILTER) — то же, что окна по мелким
+    small = f"t.amount BETWEEN {_number(min_amt)} AND {_number(max_amt)}"
+    window_sum = f"SUM(t.amount) FILTER (WHERE {small}) {_range_window(time_window)}"
+    return f"({small} AND {window_sum} > {_number(total_threshold)})::int", set(), False
+
+
+def _sql_none_type() -> tuple:
+    unknown = ', '.join(_string(value) for value in UNKNOWN_TYPES)
+    return f"(tt.t_type IN ({unknown}) OR tt.t_type IS NULL)::int", {'transaction_types'}, False
+
+
+# Шаг конвейера -> (столбец признака, генератор SQL)
+SQL_STEPS = {
+    add_client_age: ('client_age', _sql_client_age),
+    add_large_amounts: ('risk_big_sum', _sql_large_amounts),
+    add_night_transactions: ('risk_night_time', _sql_night_transactions),
+    add_geolocation: ('risk_geolocation_change', _sql_geolocation),
+    add_operation_rate: ('oper_rate', _sql_operation_rate),
+    add_small_sums: ('small_sum', _sql_small_sums),
+    add_none_type: ('none_type', _sql_none_type),
+}
+
+
+def compile_pipeline_sql(pipeline: FeaturePipeline, schema: str = 'core', flags_only: bool = False) -> str:
+    """
+    Генерирует SQL, который рассчитывает признаки зарегистрированных в pipeline шагов внутри PostgreSQL
+    (оконные функции по client_id) с теми же параметрами, что и в Python.
+
+    Результат упорядочен по (client_id, date_time) и содержит столбцы транзакций (BASE_COLUMNS)
+    и признаков; при flags_only=True — только transaction_id и признаки.
+    Шаг без SQL-эквивалента — ошибка (ValueError).
+    """
+    columns = ['t.id AS transaction_id'] if flags_only else list(BASE_COLUMNS)
+    joins, sequence = set(), False
+    for step, params in pipeline.steps:
+        if step not in SQL_STEPS:
+            raise ValueError(f"Для шага '{step.__name__}' нет SQL-реализации.")
+        name, compile_step = SQL_STEPS[step]
+        expression, step_joins, step_sequence = compile_step(**params)
+        columns.append(f'{expression} AS {name}')
+        joins |= step_joins
+        sequence |= step_sequence
+
+    sql = 'SELECT\n    ' + ',\n    '.join(columns) + f'\nFROM {schema}.transactions AS t'
+    for join in JOINS:
+        if join in joins:
+            sql += '\n' + JOINS[join].format(schema=schema)
+    if sequence:
+        sql += f'\nWINDOW {SEQUENCE_WINDOW}'
+    return sql + '\nORDER BY t.client_id, t.date_time, t.id'
+
+
+def compile_scoring_sql(pipeline: FeaturePipeline, risk_model: RiskScoringModel, schema: str = 'core') -> str:
+    """
+    SQL, который внутри PostgreSQL считает признаки pipeline, добавляет blacklist страны получателя
+    (как DimensionCache.enrich_transactions()) и оценивает риск правилами risk_model (compile_sql()).
+    """
+    relation = (
+        f"SELECT f.*, dst_country.blacklist\n"
+        f"FROM ({compile_pipeline_sql(pipeline, schema)}) AS f\n"
+        f"JOIN {schema}.cities AS dst_city\n    ON f.destination_city_id = dst_city.city_id\n"
+        f"JOIN {schema}.countries AS dst_country\n    ON dst_city.country_id = dst_country.country_id"
+    )
+    return risk_model.compile_sql(relation)
+
+
+def verify_sql_scores(df_scored: pd.DataFrame, risk_model: RiskScoringModel) -> pd.DataFrame:
+    """
+    Режим проверки: пересчитывает риск в Python (calculate_scores()) по тем же признакам, что вернул
+    SQL из compile_scoring_sql(), и возвращает строки, где оценки расходятся (пустой DataFrame — всё совпало).
+    """
+    risk_columns = ['risk_score', 'reason_mask', 'risk_status', 'is_suspicious']
+    df_python = risk_model.calculate_scores(df_scored.drop(columns=risk_columns))
+
+    mismatch = np.zeros(len(df_scored), dtype=bool)
+    for column in risk_columns:
+        mismatch |= df_scored[column].to_numpy() != df_python[column].to_numpy()
+    return pd.concat([df_scored.loc[mismatch, ['transaction_id', *risk_columns]],
+                      df_python.loc[mismatch, risk_columns].add_prefix('python_')], axis=1)
@@ -0,0 +1,124 @@
+import inspect
+from itertools import product
+
+import numpy as np
+import pandas as pd
+
+from .dimensions import CityDistances
+from .kernels import city_geolocation_change, geolocation_change, window_bounds_multi, window_sums, to_cents
+from .pipeline import FeatureFrame, add_geolocation, add_operation_rate, add_small_sums
+
+
+def parameter_grid(step, grid: dict) -> list:
+    """
+    Раскрывает сетку параметров шага конвейера в список наборов параметров (декартово произведение).
+
+    Параметры:
+    - step: шаг конвейера (add_operation_rate, add_small_sums, add_geolocation);
+    - grid: {параметр: значение или список значений}; не указанные параметры берутся по умолчанию из сигнатуры шага.
+    """
+    defaults = {name: param.default for name, param in inspect.signature(step).parameters.items()
+                if param.default is not inspect.Parameter.empty and name != 'cities'}
+    unknown = set(grid) - set(defaults)
+    if unknown:
+        raise ValueError(f"У шага '{step.__name__}' нет параметров {sorted(unknown)}.")
+
+    values = {}
+    for name, default in defaults.items():
+        value = grid.get(name, default)
+        values[name] = list(value) if isinstance(value, (list, tuple, np.ndarray)) else [value]
+    return [dict(zip(values, combination)) for combination in product(*values.values())]
+
+
+def sweep_column(column: str, params: dict) -> str:
+    """Имя столбца признака для набора параметров, например: oper_rate(n_threshold=7, time_window=120)."""
+    return f"{column}(" + ', '.join(f'{name}={value}' for name, value in params.items()) + ')'
+
+
+def sweep_operation_rate(frame: FeatureFrame, grid: dict) -> dict:
+    """
+    Флаги 'oper_rate' для всех наборов параметров сетки. Границы окон ищутся один раз на каждую длину окна,
+    число транзакций в окне — общее для всех порогов n_threshold.
+    """
+    frame.require_sorted('operation_rate')
+    sets = parameter_grid(add_operation_rate, grid)
+    windows = sorted({params['time_window'] for params in sets})
+    lefts, right = window_bounds_multi(frame.array('client_id'), frame.array('date_time'),
+                                       [pd.Timedelta(minutes=window).value for window in windows])
+    counts = {window: right - left for window, left in zip(windows, lefts)}
+    return {sweep_column('oper_rate', params): (counts[params['time_window']] > params['n_threshold']).astype(int)
+            for params in sets}
+
+
+def sweep_small_sums(frame: FeatureFrame, grid: dict) -> dict:
+    """
+    Флаги 'small_sum' для всех наборов параметров сетки. Для каждого диапазона мелких сумм (min_amt, max_amt)
+    префиксные суммы в копейках считаются один раз, границы окон — один раз на длину окна,
+    суммы в окне — общие для всех порогов total_threshold.
+    """
+    frame.require_sorted('small_sums')
+    sets = parameter_grid(add_small_sums, grid)
+    amount = frame.array('amount')
+    columns = {}
+    for min_amt, max_amt in dict.fromkeys((params['min_amt'], params['max_amt']) for params in sets):
+        group = [params for params in sets if (params['min_amt'], params['max_amt']) == (min_amt, max_amt)]
+        small = (amount >= min_amt) & (amount <= max_amt)
+        cents = to_cents(amount[small])
+        windows = sorted({params['time_window'] for params in group})
+        lefts, right = window_bounds_multi(frame.array('client_id')[small], frame.array('date_time')[small],
+                                           [pd.Timedelta(minutes=window).value for window in windows])
+        sums = {window: window_sums(cents, left, right) for window, left in zip(windows, lefts)}
+
+        for params in group:
+            small_sum = np.zeros(len(amount), dtype=int)
+            small_sum[small] = sums[params['time_window']] > params['total_threshold'] * 100
+            columns[sweep_column('small_sum', params)] = small_sum
+    return columns
+
+
+def sweep_geolocation(frame: FeatureFrame, grid: dict, cities: CityDistances = None) -> dict:
+    """
+    Флаги 'risk_geolocation_change' для всех наборов параметров сетки: расстояние и время до предыдущей
+    транзакции клиента считаются один раз, каждый набор параметров — только сравнение с порогами.
+    """
+    frame.require_sorted('geolocation')
+    sets = parameter_grid(add_geolocation, grid)
+    if cities is not None:
+        _, distance, hours_diff = city_geolocation_change(frame.array('client_id'), frame.array('date_time'),
+                                                          cities.codes(frame.array('source_city_id')),
+                                                          cities.distances)
+    else:
+        _, distance, hours_diff = geolocation_change(frame.array('client_id'), frame.array('date_time'),
+                                                     frame.array('sender_latitude'), frame.array('sender_longitude'))
+    return {sweep_column('risk_geolocation_change', params):
+            ((distance > params['distance_km']) & (hours_diff <= params['max_hours'])).astype(int)
+            for params in sets}
+
+
+def run_sweeps(df: pd.DataFrame, operation_rate: dict = None, small_sums: dict = None, geolocation: dict = None,
+               cities: CityDistances = None, copy: bool = True) -> pd.DataFrame:
+    """
+    Режим калибровки: флаги детекторов для сеток параметров за одну сортировку истории клиентов.
+
+    Возвращает DataFrame, отсортированный по (client_id, date_time), как FeaturePipeline.run(),
+    с одним столбцом на каждый набор параметров (имена — sweep_column()). Каждый столбец совпадает
+    с результатом соответствующего шага конвейера с этими параметрами.
+
+    Параметры:
+    - operation_rate, small_sums, geolocation: сетки параметров шагов (см. parameter_grid()), None — шаг не считается;
+    - cities: справочник городов для смены геолокации (None — расстояния по координатам);
+    - copy: False — не копировать df, если он уже отсортирован.
+
+    Пример:
+        run_sweeps(df, operation_rate={'n_threshold': [5, 7, 9], 'time_window': [60, 120]},
+                   small_sums={'total_threshold': [15000, 20000], 'time_window': [30, 60]})
+    """
+    frame = FeatureFrame(df, sort=True, copy=copy)
+    columns = {}
+    if operation_rate is not None:
+        columns.update(sweep_operation_rate(frame, operation_rate))
+    if small_sums is not None:
+        columns.update(sweep_small_sums(frame, small_sums))
+    if geolocation is not None:
+        columns.update(sweep_geolocation(frame, geolocation, cities))
+    return pd.concat([frame.df, pd.DataFrame(columns, index=frame.df.index)], axis=1)
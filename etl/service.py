@@ -0,0 +1,391 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+from Database.database import DBExtractor
+from etl.config.logger_config import setup_logger
+from models.dimensions import DimensionCache
+from models.parallel import score_transactions
+from models.pipeline import default_pipeline
+from models.realtime import MicroBatchScorer
+from models.risk_model import RiskScoringModel
+
+logger = setup_logger('config/etl.log')
+
+# Обязательные поля транзакции в запросе: всё, что читают признаки и правила.
+# t_type и blacklist сервис берёт из справочников по transaction_type_id и destination_city_id.
+REQUIRED_FIELDS = ('transaction_id', 'client_id', 'date_time', 'amount', 'transaction_type_id',
+                   'source_city_id', 'destination_city_id')
+
+# Размер блока чтения из сокета
+READ_BLOCK = 1 << 16
+
+
+class _Connection:
+    """Состояние соединения клиента: writer и число транзакций, ожидающих вердикта."""
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.pending = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+
+class ScoringService:
+    """
+    Локальный asyncio-сервис скоринга: транзакции принимаются по TCP построчно в JSON (NDJSON),
+    копятся в микро-батчи и оцениваются векторно (MicroBatchScorer); на каждую строку запроса
+    возвращается строка-вердикт с тем же transaction_id (порядок ответов может отличаться от порядка запросов):
+    transaction_id, risk_score, reason_mask, reason_flags, risk_status, is_suspicious — или error.
+
+    Батч закрывается, когда набрано max_batch транзакций или с прихода первой прошло max_delay_ms.
+    Пока считается один батч, копится следующий, поэтому при нагрузке батчи растут сами,
+    а задержка ограничена временем ожидания и расчёта одного батча.
+    Запросы читаются блоками, вердикты батча пишутся в каждое соединение одним вызовом write():
+    накладные расходы event loop приходятся на блок и батч, а не на транзакцию.
+    Очередь ограничена max_pending транзакциями: при переполнении соединения перестают читать запросы,
+    пока батчи её не разгрузят, и клиентов сдерживает TCP (очередь может превысить предел на один блок чтения).
+    """
+    def __init__(self, scorer: MicroBatchScorer, max_batch: int = 2048, max_delay_ms: float = 5,
+                 max_pending: int = None):
+        """
+        Параметры:
+        - scorer: векторный скоринг микро-батчей;
+        - max_batch, max_delay_ms: размер батча и время его ожидания;
+        - max_pending: предел очереди транзакций без вердикта (по умолчанию 8 батчей).
+        """
+        self.scorer = scorer
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000
+        self.max_pending = max_pending or 8 * max_batch
+        self.pending = deque()
+        self.ready = asyncio.Event()
+        self.has_room = asyncio.Event()
+        self.has_room.set()
+        # Один поток: батчи считаются строго по очереди, история клиентов обновляется последовательно
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.batches = 0
+        self.scored = 0
+
+    async def start(self, host: str, port: int) -> asyncio.AbstractServer:
+        """Запускает приём соединений и обработчик батчей."""
+        self._batcher = asyncio.create_task(self._batch_loop())
+        server = await asyncio.start_server(self._handle_connection, host, port)
+        logger.info(f"Сервис скоринга слушает {host}:{port} (батч до {self.max_batch}, "
+                    f"ожидание до {self.max_delay * 1000:g} мс).")
+        return server
+
+    def stop(self) -> None:
+        self._batcher.cancel()
+        self.executor.shutdown(wait=False)
+        if self.batches:
+            logger.info(f"Сервис скоринга остановлен: {self.scored} транзакций, {self.batches} батчей, "
+                        f"в среднем {self.scored / self.batches:.1f} транзакций в батче.")
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        connection = _Connection(writer)
+        tail = b''
+        try:
+            while data := await reader.read(READ_BLOCK):
+                *lines, tail = (tail + data).split(b'\n')
+                await self._enqueue(lines, connection)
+            # Клиент закрыл запись: последний запрос мог прийти без завершающего перевода строки
+            if tail.strip():
+                await self._enqueue([tail], connection)
+            await connection.idle.wait()
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _enqueue(self, lines: list, connection: _Connection) -> None:
+        """Разбирает строки запросов: транзакции ставит в очередь батчей, на некорректные сразу отвечает ошибкой."""
+        transactions, errors = _parse_lines(lines)
+        for transaction in transactions:
+            self.pending.append((transaction, connection))
+        connection.pending += len(transactions)
+        if errors:
+            connection.writer.write(b''.join(errors))
+        if transactions:
+            connection.idle.clear()
+            self.ready.set()
+        await connection.writer.drain()
+        # Очередь переполнена — следующий блок соединения читается после того, как батчи её разгрузят
+        while len(self.pending) >= self.max_pending:
+            self.has_room.clear()
+            await self.has_room.wait()
+
+    async def _batch_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.ready.wait()
+            deadline = loop.time() + self.max_delay
+            while len(self.pending) < self.max_batch and (timeout := deadline - loop.time()) > 0:
+                self.ready.clear()
+                try:
+                    await asyncio.wait_for(self.ready.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+
+            batch = [self.pending.popleft() for _ in range(min(self.max_batch, len(self.pending)))]
+            if not self.pending:
+                self.ready.clear()
+            if len(self.pending) < self.max_pending:
+                self.has_room.set()
+            transactions = [transaction for transaction, _ in batch]
+            replies = await loop.run_in_executor(self.executor, self._score_safe, transactions)
+
+            # Вердикты группируются по соединениям и отправляются одним write()
+            by_connection = {}
+            for (_, connection), reply in zip(batch, replies):
+                by_connection.setdefault(connection, []).append(reply)
+            for connection, connection_replies in by_connection.items():
+                if not connection.writer.is_closing():
+                    connection.writer.write(b''.join(connection_replies))
+                connection.pending -= len(connection_replies)
+                if not connection.pending:
+                    connection.idle.set()
+            self.batches += 1
+            self.scored += len(batch)
+
+    def _score_safe(self, transactions: list) -> list:
+        """
+        Скоринг батча; если батч не удалось оценить (например, тип транзакции или город отсутствует в справочнике),
+        транзакции оцениваются по одной, и ошибку получают только некорректные.
+        История клиентов меняется только после успешной оценки, поэтому повтор не искажает состояние.
+        """
+        try:
+            return self._score(transactions)
+        except Exception as e:
+            if len(transactions) == 1:
+                return [_encode({'transaction_id': transactions[0]['transaction_id'], 'error': str(e)})]
+            logger.error(f"Ошибка скоринга батча из {len(transactions)} транзакций, оцениваются по одной: {e}")
+            return [reply for transaction in transactions for reply in self._score_safe([transaction])]
+
+    def _score(self, transactions: list) -> list:
+        """
+        Скоринг батча (в потоке executor): строки-вердикты NDJSON в порядке транзакций.
+        Текст причин и статус кодируются в JSON один раз на уникальное значение, а не на каждую строку.
+        """
+        # Правила риска перечитываются на лету, если JSON-файл изменился (проверка mtime — дешёвая)
+        self.scorer.risk_model.reload_if_changed()
+        scored = self.scorer.score_batch(transactions)
+        masks = scored['reason_mask'].to_numpy()
+        codes, inverse = np.unique(masks, return_inverse=True)
+        reasons = [json.dumps(text, ensure_ascii=False)
+                   for text in self.scorer.risk_model.render_reasons(pd.Series(codes)).tolist()]
+        statuses = {status: json.dumps(status, ensure_ascii=False) for status in RiskScoringModel.STATUSES}
+        return [(f'{{"transaction_id": {json.dumps(transaction_id)}, "risk_score": {score}, "reason_mask": {mask}, '
+                 f'"reason_flags": {reasons[reason]}, "risk_status": {statuses[status]}, '
+                 f'"is_suspicious": {"true" if suspicious else "false"}}}\n').encode('utf-8')
+                for transaction_id, score, mask, reason, status, suspicious in zip(
+                    scored['transaction_id'].tolist(), scored['risk_score'].tolist(), masks.tolist(),
+                    inverse.tolist(), scored['risk_status'].tolist(), scored['is_suspicious'].tolist())]
+
+
+def _parse_lines(lines: list) -> tuple:
+    """
+    Разбирает строки NDJSON: возвращает (транзакции, строки-ответы об ошибках).
+    Блок разбирается одним вызовом json.loads; при ошибке — построчно, чтобы ответить на каждую плохую строку.
+    """
+    lines = [line for line in lines if line.strip()]
+    try:
+        transactions = json.loads(b'[' + b','.join(lines) + b']')
+        if all(isinstance(transaction, dict) and all(field in transaction for field in REQUIRED_FIELDS)
+               for transaction in transactions):
+            return transactions, []
+    except ValueError:
+        pass
+
+    transactions, errors = [], []
+    for line in lines:
+        try:
+            transaction = json.loads(line)
+            if not isinstance(transaction, dict):
+                raise ValueError("ожидался JSON-объект")
+            missing = [field for field in REQUIRED_FIELDS if field not in transaction]
+            if missing:
+                raise ValueError(f"нет полей {missing}")
+        except ValueError as e:
+            errors.append(_encode({'error': f"Некорректная транзакция: {e}"}))
+            continue
+        transactions.append(transaction)
+    return transactions, errors
+
+
+def _encode(message: dict) -> bytes:
+    return json.dumps(message, ensure_ascii=False, default=lambda value: value.item()).encode('utf-8') + b'\n'
+
+
+async def _load_connection(host: str, port: int, transactions: list, inflight: int, latencies: list,
+                           verdicts: list) -> int:
+    """
+    Одно соединение генератора нагрузки: не более inflight запросов без ответа; запросы отправляются
+    блоками по мере освобождения окна. Задержки и вердикты дописываются в latencies и verdicts;
+    возвращает число ошибок.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    window = {'free': inflight}
+    freed = asyncio.Event()
+    sent, errors = {}, 0
+
+    async def send() -> None:
+        position = 0
+        while position < len(transactions):
+            await freed.wait()
+            freed.clear()
+            chunk = transactions[position:position + window['free']]
+            window['free'] -= len(chunk)
+            position += len(chunk)
+            now = time.perf_counter()
+            for transaction in chunk:
+                sent[transaction['transaction_id']] = now
+            writer.write(b''.join(json.dumps(transaction, ensure_ascii=False).encode('utf-8') + b'\n'
+                                  for transaction in chunk))
+            await writer.drain()
+
+    freed.set()
+    sender = asyncio.create_task(send())
+    received, tail = 0, b''
+    while received < len(transactions):
+        data = await reader.read(READ_BLOCK)
+        if not data:
+            raise ConnectionError('Сервис закрыл соединение.')
+        *lines, tail = (tail + data).split(b'\n')
+        now = time.perf_counter()
+        for line in lines:
+            verdict = json.loads(line)
+            latencies.append(now - sent.pop(verdict['transaction_id']))
+            if 'error' in verdict:
+                errors += 1
+            else:
+                verdicts.append(verdict)
+        received += len(lines)
+        window['free'] += len(lines)
+        freed.set()
+    await sender
+    writer.close()
+    return errors
+
+
+async def run_load(host: str, port: int, df: pd.DataFrame, connections: int = 8, inflight: int = 256) -> dict:
+    """
+    Генератор нагрузки: отправляет транзакции df (в порядке date_time) по connections соединениям.
+    Клиент закреплён за одним соединением, так что его транзакции приходят в сервис по порядку.
+
+    Возвращает {'transactions', 'seconds', 'throughput', 'p50_ms', 'p99_ms', 'errors', 'verdicts'}.
+    """
+    df = df.sort_values('date_time', kind='stable')
+    records = df.assign(date_time=df['date_time'].astype(str)).to_dict('records')
+    parts = [[] for _ in range(connections)]
+    for record in records:
+        parts[record['client_id'] % connections].append(record)
+
+    latencies, verdicts = [], []
+    start_time = time.perf_counter()
+    errors = await asyncio.gather(*(_load_connection(host, port, part, inflight, latencies, verdicts)
+                                    for part in parts if part))
+    seconds = time.perf_counter() - start_time
+    p50, p99 = np.percentile(np.array(latencies) * 1000, [50, 99])
+    return {'transactions': len(records), 'seconds': seconds, 'throughput': len(records) / seconds,
+            'p50_ms': p50, 'p99_ms': p99, 'errors': sum(errors), 'verdicts': verdicts}
+
+
+def build_scorer(extractor: DBExtractor, dimensions: DimensionCache) -> MicroBatchScorer:
+    return MicroBatchScorer(RiskScoringModel(os.getenv('RISK_JSON')),
+                            default_pipeline(dimensions.cities, dimensions.clients),
+                            lookback_minutes=int(os.getenv('DM_LOOKBACK_MINUTES', 120)), dimensions=dimensions)
+
+
+async def serve(scorer: MicroBatchScorer, host: str, port: int, max_batch: int, max_delay_ms: float,
+                max_pending: int = None) -> None:
+    service = ScoringService(scorer, max_batch, max_delay_ms, max_pending)
+    server = await service.start(host, port)
+    print(f'✅ Сервис скоринга запущен на {host}:{port}.')
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.stop()
+
+
+async def load_test(extractor: DBExtractor, dimensions: DimensionCache, host: str, port: int, n_rows: int,
+                    connections: int, inflight: int, scorer: MicroBatchScorer = None, max_batch: int = 2048,
+                    max_delay_ms: float = 5) -> None:
+    """
+    Нагрузочный тест на истории из core: пропускная способность и задержки p50/p99 сервиса
+    в сравнении с пакетным score_transactions() на тех же транзакциях, а также сверка вердиктов с ним.
+    Если передан scorer, сервис запускается в этом же процессе.
+    """
+    df = dimensions.enrich_transactions(extractor.fetch_merged_transactions())
+    df = df.sort_values('date_time', kind='stable').head(n_rows)
+
+    service = None
+    if scorer is not None:
+        service = ScoringService(scorer, max_batch, max_delay_ms)
+        server = await service.start(host, port)
+    try:
+        stats = await run_load(host, port, df, connections, inflight)
+    finally:
+        if service is not None:
+            server.close()
+            service.stop()
+
+    # Эталон: пакетный расчёт тех же транзакций
+    risk_model = RiskScoringModel(os.getenv('RISK_JSON'))
+    start_time = time.perf_counter()
+    batch = score_transactions(df, risk_model, pipeline=default_pipeline(dimensions.cities, dimensions.clients))
+    batch_seconds = time.perf_counter() - start_time
+
+    verdicts = pd.DataFrame(stats.pop('verdicts')).set_index('transaction_id')
+    batch = batch.set_index('transaction_id').loc[verdicts.index]
+    mismatches = int((verdicts[['risk_score', 'reason_mask', 'risk_status']] !=
+                      batch[['risk_score', 'reason_mask', 'risk_status']]).any(axis=1).sum())
+
+    print(f"📊 Сервис: {stats['transactions']} транзакций за {stats['seconds']:.2f} сек. "
+          f"({stats['throughput']:,.0f} транзакций/сек.), задержка p50 {stats['p50_ms']:.1f} мс, "
+          f"p99 {stats['p99_ms']:.1f} мс, ошибок: {stats['errors']}")
+    print(f"---- пакетный режим: {len(df) / batch_seconds:,.0f} транзакций/сек.")
+    print(f"---- вердикты совпадают с пакетным режимом: {'✅' if not mismatches else f'❌ ({mismatches} расхождений)'}")
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description='Сервис скоринга транзакций с микро-батчами и генератор нагрузки.')
+    parser.add_argument('command', choices=['serve', 'load', 'bench'],
+                        help='serve — запустить сервис; load — нагрузка на запущенный сервис; '
+                             'bench — сервис и нагрузка в одном процессе.')
+    parser.add_argument('--host', default=os.getenv('SERVICE_HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=int(os.getenv('SERVICE_PORT', 8765)))
+    parser.add_argument('--max-batch', type=int, default=int(os.getenv('SERVICE_MAX_BATCH', 2048)))
+    parser.add_argument('--max-delay-ms', type=float, default=float(os.getenv('SERVICE_MAX_DELAY_MS', 5)))
+    parser.add_argument('--max-pending', type=int, default=int(os.getenv('SERVICE_MAX_PENDING', 0)) or None,
+                        help='Предел очереди транзакций без вердикта (по умолчанию 8 батчей).')
+    parser.add_argument('--rows', type=int, default=50_000, help='Количество транзакций для нагрузки.')
+    parser.add_argument('--connections', type=int, default=8, help='Количество соединений генератора нагрузки.')
+    parser.add_argument('--inflight', type=int, default=256, help='Запросов без ответа на одно соединение.')
+    args = parser.parse_args()
+
+    extractor = DBExtractor(dbname=os.getenv('DB_NAME'), user=os.getenv('DB_USER'), password=os.getenv('DB_PASS'),
+                            host=os.getenv('DB_HOST'), port=os.getenv('DB_PORT'))
+    dimensions = DimensionCache().refresh(extractor)
+
+    if args.command == 'serve':
+        asyncio.run(serve(build_scorer(extractor, dimensions), args.host, args.port, args.max_batch,
+                          args.max_delay_ms, args.max_pending))
+    else:
+        scorer = build_scorer(extractor, dimensions) if args.command == 'bench' else None
+        asyncio.run(load_test(extractor, dimensions, args.host, args.port, args.rows, args.connections,
+                              args.inflight, scorer, args.max_batch, args.max_delay_ms))
+
+
+if __name__ == '__main__':
+    main()